@@ -0,0 +1,349 @@
+# Generator of synthetic FAT12/16/32 images for benchmarks
+import argparse
+import hashlib
+import json
+import random
+import struct
+from math import ceil
+
+BS = 32
+EOC = {'FAT12': 0xFFF, 'FAT16': 0xFFFF, 'FAT32': 0x0FFFFFFF}
+
+
+def lfn_checksum(short: bytes) -> int:
+    """Checksum of 8.3 name stored in every LFN part"""
+    s = 0
+    for c in short:
+        s = (((s & 1) << 7) + (s >> 1) + c) & 0xFF
+    return s
+
+
+def lfn_entries(name: str, short: bytes) -> bytes:
+    """LFN parts of name in on-disk order, last part goes first"""
+    chars = name.encode('utf-16-le')
+    units = [chars[i:i+2] for i in range(0, len(chars), 2)]
+    if len(units) % 13:
+        units.append(b'\x00\x00')
+    while len(units) % 13:
+        units.append(b'\xff\xff')
+    csum = lfn_checksum(short)
+    out = []
+    count = len(units) // 13
+    for n in range(count):
+        part = units[n*13:(n+1)*13]
+        seq = n + 1
+        if seq == count:
+            seq |= 0x40
+        rec = bytes([seq]) + b''.join(part[:5]) + bytes([0x0F, 0, csum]) + \
+            b''.join(part[5:11]) + b'\x00\x00' + b''.join(part[11:13])
+        out.append(rec)
+    return b''.join(out[::-1])
+
+
+def short_entry(short: bytes, attr: int, cluster: int, size: int) -> bytes:
+    """32 bytes 8.3 entry, every file is dated 15-6-2020 12:30"""
+    date = ((2020 - 1980) << 9) | (6 << 5) | 15
+    time = (12 << 11) | (30 << 5)
+    return struct.pack('<11sBBBHHHHHHHI', short, attr, 0, 0, time, date, date,
+                       cluster >> 16, time, date, cluster & 0xFFFF, size)
+
+
+class Node(object):
+    """File or directory of generated tree"""
+
+    def __init__(self, name, is_dir, size=0, parent=None):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.parent = parent
+        self.children = []
+        self.clusters = []
+        self.deleted = False
+        self.short = None
+        self.lfn = False
+
+    @property
+    def path(self):
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(parts[::-1])
+
+
+def make_short(name: str, used: set, lfn: bool) -> bytes:
+    """Unique 8.3 name in directory, names with LFN get ~N tail"""
+    if '.' in name:
+        base, ext = name.rsplit('.', 1)
+    else:
+        base, ext = name, ''
+    base = ''.join(c for c in base.upper() if c.isalnum())[:8] or 'X'
+    ext = ''.join(c for c in ext.upper() if c.isalnum())[:3]
+    if lfn or len(name) > 12:
+        n = 1
+        while True:
+            tail = '~%d' % n
+            cand = (base[:8 - len(tail)] + tail).ljust(8).encode() + ext.ljust(3).encode()
+            if cand not in used:
+                break
+            n += 1
+    else:
+        cand = base.ljust(8).encode() + ext.ljust(3).encode()
+        n = 1
+        while cand in used:
+            tail = '~%d' % n
+            cand = (base[:8 - len(tail)] + tail).ljust(8).encode() + ext.ljust(3).encode()
+            n += 1
+    used.add(cand)
+    return cand
+
+
+def file_content(node: Node, seed: int) -> bytes:
+    """Content is derived from path, so it can be checked after extraction"""
+    out = hashlib.sha256(('%s:%s' % (seed, node.path)).encode()).digest()
+    return (out * (node.size // len(out) + 1))[:node.size]
+
+
+def build(args) -> tuple:
+    """
+    Build image in memory, returns (image, manifest).
+    Manifest has path, size, deleted flag and sha256 of every file.
+    """
+    rnd = random.Random(args.seed)
+    fs = args.fat
+    cluster_size = args.cluster_size
+    sector = 512
+    spc = cluster_size // sector
+
+    root = Node('', True)
+    dirs = [root]
+    files = []
+    for i in range(args.files):
+        parent = rnd.choice(dirs)
+        depth = 0
+        n = parent
+        while n.parent is not None:
+            depth += 1
+            n = n.parent
+        if args.dirs and len(dirs) < args.dirs + 1 and depth < args.depth and rnd.random() < 0.3:
+            d = Node('dir%05d' % len(dirs) if rnd.random() >= args.lfn else 'Directory %d long' % len(dirs),
+                     True, parent=parent)
+            parent.children.append(d)
+            dirs.append(d)
+            parent = d
+        if rnd.random() < args.lfn:
+            name = 'file number %d with long name.dat' % i
+        else:
+            name = 'F%07d.BIN' % i
+        size = rnd.randint(args.min_size, args.max_size)
+        f = Node(name, False, size, parent)
+        parent.children.append(f)
+        files.append(f)
+
+    for node in files + dirs[1:]:
+        if rnd.random() < args.deleted:
+            node.deleted = True
+
+    def mark(node):
+        for c in node.children:
+            c.deleted = True
+            mark(c)
+    for d in dirs[1:]:
+        if d.deleted:
+            mark(d)
+
+    # assign short names and compute dir sizes
+    for d in dirs:
+        used = set()
+        for c in d.children:
+            c.lfn = c.name != c.name.upper() or len(c.name) > 12 or ' ' in c.name
+            c.short = make_short(c.name, used, c.lfn)
+
+    def dir_bytes(d):
+        n = 0 if d is root else 2
+        for c in d.children:
+            n += 1 + (ceil((len(c.name) + 1) / 13) if c.lfn else 0)
+        return (n + 1) * BS
+
+    # cluster counts
+    data_needed = 0
+    for d in dirs:
+        if d is root and fs != 'FAT32':
+            continue
+        data_needed += ceil(dir_bytes(d) / cluster_size)
+    for f in files:
+        data_needed += max(1, ceil(f.size / cluster_size)) if f.size else 0
+    total_clusters = max(int(data_needed * (1 + args.slack)) + 16, {'FAT12': 16, 'FAT16': 4200, 'FAT32': 66000}[fs])
+    limit = {'FAT12': 4084, 'FAT16': 65524, 'FAT32': 0x0FFFFFF5}[fs]
+    if total_clusters > limit:
+        raise SystemExit('too many clusters for %s' % fs)
+
+    entry_bits = {'FAT12': 12, 'FAT16': 16, 'FAT32': 32}[fs]
+    fat_bytes = ceil((total_clusters + 2) * entry_bits / 8)
+    fat_sectors = ceil(fat_bytes / sector)
+    root_entries = 0 if fs == 'FAT32' else max(512, ceil(dir_bytes(root) / BS / 16) * 16)
+    reserved = 32 if fs == 'FAT32' else 1
+    root_sectors = root_entries * BS // sector
+    data_start_sector = reserved + 2 * fat_sectors + root_sectors
+    total_sectors = data_start_sector + total_clusters * spc
+
+    # allocation: free list with fragmentation
+    free = list(range(2, total_clusters + 2))
+    fat = [0] * (total_clusters + 2)
+    fat[0] = {'FAT12': 0xFF8, 'FAT16': 0xFFF8, 'FAT32': 0x0FFFFFF8}[fs]
+    fat[1] = EOC[fs]
+    cursor = [0]
+    used = set()
+
+    def alloc(n):
+        out = []
+        while len(out) < n:
+            if rnd.random() < args.fragment and len(out) > 0:
+                # jump forward leaving a gap used later by other files
+                cursor[0] += rnd.randint(1, 8)
+            while cursor[0] < len(free) and free[cursor[0]] in used:
+                cursor[0] += 1
+            if cursor[0] >= len(free):
+                # wrap around to holes
+                cursor[0] = 0
+                while free[cursor[0]] in used:
+                    cursor[0] += 1
+            c = free[cursor[0]]
+            used.add(c)
+            out.append(c)
+            cursor[0] += 1
+        for a, b in zip(out, out[1:]):
+            fat[a] = b
+        fat[out[-1]] = EOC[fs]
+        return out
+
+    order = dirs[1:] + files
+    if fs == 'FAT32':
+        order = [root] + order
+    rnd.shuffle(order)
+    for node in order:
+        if node.is_dir:
+            node.clusters = alloc(ceil(dir_bytes(node) / cluster_size))
+        elif node.size:
+            node.clusters = alloc(ceil(node.size / cluster_size))
+
+    img = bytearray(total_sectors * sector)
+
+    # boot sector
+    bs = bytearray(sector)
+    bs[0:3] = b'\xEB\x3C\x90'
+    bs[3:11] = b'mkimage '
+    struct.pack_into('<HBHBHHBHHHI', bs, 11, sector, spc, reserved, 2, root_entries,
+                     total_sectors if total_sectors < 0x10000 and fs != 'FAT32' else 0,
+                     0xF8, fat_sectors if fs != 'FAT32' else 0, 32, 64, 0)
+    struct.pack_into('<I', bs, 32, total_sectors if total_sectors >= 0x10000 or fs == 'FAT32' else 0)
+    if fs == 'FAT32':
+        struct.pack_into('<IHHIHH', bs, 36, fat_sectors, 0, 0, root.clusters[0], 1, 6)
+        struct.pack_into('<BBBI11s8s', bs, 64, 0x80, 0, 0x29, 0x1234, b'NO NAME    ', b'FAT32   ')
+    else:
+        struct.pack_into('<BBBI11s8s', bs, 36, 0x80, 0, 0x29, 0x1234, b'NO NAME    ', (fs + '   ').encode())
+    bs[510:512] = b'\x55\xAA'
+    img[0:sector] = bs
+
+    def cluster_addr(c):
+        return (data_start_sector + (c - 2) * spc) * sector
+
+    def write_chain(clusters, data):
+        for i, c in enumerate(clusters):
+            chunk = data[i * cluster_size:(i + 1) * cluster_size]
+            a = cluster_addr(c)
+            img[a:a + len(chunk)] = chunk
+
+    # directories
+    for d in dirs:
+        out = b''
+        if d is not root:
+            first = d.clusters[0]
+            parent = 0 if d.parent is root else d.parent.clusters[0]
+            out += short_entry(b'.          ', 0x10, first, 0)
+            out += short_entry(b'..         ', 0x10, parent, 0)
+        for c in d.children:
+            rec = b''
+            if c.lfn:
+                rec += lfn_entries(c.name, c.short)
+            cl = c.clusters[0] if c.clusters else 0
+            rec += short_entry(c.short, 0x10 if c.is_dir else 0x20, cl, 0 if c.is_dir else c.size)
+            if c.deleted:
+                rec = b''.join(b'\xe5' + rec[i+1:i+BS] for i in range(0, len(rec), BS))
+            out += rec
+        if d is root and fs != 'FAT32':
+            a = (reserved + 2 * fat_sectors) * sector
+            img[a:a + len(out)] = out
+        else:
+            write_chain(d.clusters, out)
+
+    for f in files:
+        if f.size:
+            write_chain(f.clusters, file_content(f, args.seed))
+
+    # free chains of deleted entries (contents of deleted dirs stay reachable only via the dir)
+    def release(node):
+        for c in node.clusters:
+            fat[c] = 0
+    for node in files + dirs[1:]:
+        if node.deleted:
+            release(node)
+
+    # FAT tables
+    if fs == 'FAT12':
+        raw = bytearray(fat_sectors * sector)
+        for i in range(0, len(fat) - 1 if len(fat) % 2 else len(fat), 2):
+            a, b = fat[i], fat[i + 1] if i + 1 < len(fat) else 0
+            raw[i * 3 // 2:i * 3 // 2 + 3] = bytes([a & 0xFF, ((a >> 8) & 0x0F) | ((b & 0x0F) << 4), b >> 4])
+        if len(fat) % 2:
+            i = len(fat) - 1
+            a = fat[i]
+            raw[i * 3 // 2:i * 3 // 2 + 2] = bytes([a & 0xFF, (a >> 8) & 0x0F])
+    else:
+        fmt = '<%d%s' % (len(fat), 'H' if fs == 'FAT16' else 'I')
+        raw = bytearray(fat_sectors * sector)
+        struct.pack_into(fmt, raw, 0, *fat)
+    for n in range(2):
+        a = (reserved + n * fat_sectors) * sector
+        img[a:a + len(raw)] = raw
+
+    manifest = []
+    for f in files:
+        deleted = f.deleted
+        p = f.parent
+        while p is not None:
+            deleted = deleted or p.deleted
+            p = p.parent
+        manifest.append({'path': f.path, 'size': f.size, 'deleted': deleted,
+                         'sha256': hashlib.sha256(file_content(f, args.seed)).hexdigest()})
+    return bytes(img), manifest
+
+
+def main():
+    p = argparse.ArgumentParser(description='Generate synthetic FAT12/16/32 images for benchmarks')
+    p.add_argument('output')
+    p.add_argument('--fat', choices=['FAT12', 'FAT16', 'FAT32'], default='FAT16')
+    p.add_argument('--files', type=int, default=100, help='Number of files')
+    p.add_argument('--dirs', type=int, default=20, help='Maximum number of directories')
+    p.add_argument('--depth', type=int, default=3, help='Maximum depth of directories')
+    p.add_argument('--lfn', type=float, default=0.5, help='Share of entries with long names')
+    p.add_argument('--fragment', type=float, default=0.0, help='Chance of gap after every allocated cluster')
+    p.add_argument('--deleted', type=float, default=0.0, help='Share of deleted entries')
+    p.add_argument('--min-size', type=int, default=0)
+    p.add_argument('--max-size', type=int, default=20000)
+    p.add_argument('--cluster-size', type=int, default=2048)
+    p.add_argument('--slack', type=float, default=0.2, help='Share of free clusters over used ones')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--manifest', metavar='file', help='Save json manifest of files')
+    args = p.parse_args()
+    img, manifest = build(args)
+    with open(args.output, 'wb') as f:
+        f.write(img)
+    if args.manifest:
+        with open(args.manifest, 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
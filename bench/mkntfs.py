@@ -0,0 +1,429 @@
+# Generator of synthetic NTFS images for benchmarks
+import argparse
+import hashlib
+import json
+import random
+import struct
+from datetime import datetime
+
+SECTOR = 512
+CLUSTER = 4096
+RECORD = 1024
+INDEX_BLOCK = 4096
+FIXUP = 0x4242
+FILETIME = int((datetime(2021, 3, 4, 5, 6, 8) - datetime(1601, 1, 1)).total_seconds()) * 10**7
+SYSTEM = ['$MFT', '$MFTMirr', '$LogFile', '$Volume', '$AttrDef', '.', '$Bitmap', '$Boot',
+          '$BadClus', '$Secure', '$UpCase', '$Extend', None, None, None, None]
+
+
+def align(n: int, a: int = 8) -> int:
+    return (n + a - 1) // a * a
+
+
+def encode_runs(runs: list) -> bytes:
+    out = b''
+    prev = 0
+    for lcn, count in runs:
+        length = count.to_bytes((count.bit_length() + 7) // 8 or 1, 'little')
+        if lcn is None:
+            out += bytes([len(length)]) + length
+            continue
+        delta = lcn - prev
+        size = 1
+        while not -(1 << (8*size - 1)) <= delta < (1 << (8*size - 1)):
+            size += 1
+        out += bytes([size << 4 | len(length)]) + length + delta.to_bytes(size, 'little', signed=True)
+        prev = lcn
+    return out + b'\x00'
+
+
+def resident(type: int, value: bytes, id: int, name: str = '') -> bytes:
+    name_raw = name.encode('utf-16-le')
+    value_offset = align(0x18 + len(name_raw))
+    length = align(value_offset + len(value))
+    head = struct.pack('<IIBBHHHIHBB', type, length, 0, len(name), 0x18, 0, id, len(value), value_offset, 0, 0)
+    body = head + name_raw
+    body = body.ljust(value_offset, b'\x00') + value
+    return body.ljust(length, b'\x00')
+
+
+def non_resident(type: int, runs: list, size: int, id: int, name: str = '', start_vcn: int = 0) -> bytes:
+    name_raw = name.encode('utf-16-le')
+    runs_offset = align(0x40 + len(name_raw))
+    encoded = encode_runs(runs)
+    length = align(runs_offset + len(encoded))
+    clusters = sum(count for _, count in runs)
+    head = struct.pack('<IIBBHHH', type, length, 1, len(name), 0x40, 0, id)
+    head += struct.pack('<QQHH4xQQQ', start_vcn, start_vcn + clusters - 1, runs_offset, 0,
+                        clusters * CLUSTER, size, size)
+    body = (head + name_raw).ljust(runs_offset, b'\x00') + encoded
+    return body.ljust(length, b'\x00')
+
+
+def protect(block: bytearray, usa_offset: int) -> bytearray:
+    """Apply update sequence: save last two bytes of every 512 and put check value there"""
+
+    count = len(block) // 512
+    struct.pack_into('<HH', block, 4, usa_offset, count + 1)
+    struct.pack_into('<H', block, usa_offset, FIXUP)
+    for i in range(count):
+        end = (i + 1) * 512 - 2
+        block[usa_offset + 2 + 2*i:usa_offset + 4 + 2*i] = block[end:end + 2]
+        struct.pack_into('<H', block, end, FIXUP)
+    return block
+
+
+def record(number: int, flags: int, attributes: list, base: int = 0) -> bytearray:
+    rec = bytearray(RECORD)
+    body = b''.join(attributes) + struct.pack('<I', 0xFFFFFFFF)
+    assert 0x38 + len(body) <= RECORD - 8, 'record %d overflows' % number
+    struct.pack_into('<4sHHQHHHHIIQHHI', rec, 0, b'FILE', 0x30, 3, 0, 1, 1, 0x38, flags,
+                     0x38 + len(body) + 4, RECORD, base, len(attributes) + 1, 0, number)
+    rec[0x38:0x38 + len(body)] = body
+    return protect(rec, 0x30)
+
+
+def standard_information() -> bytes:
+    return struct.pack('<QQQQI', FILETIME, FILETIME, FILETIME, FILETIME, 0x20).ljust(0x30, b'\x00')
+
+
+def file_name(parent: int, name: str, namespace: int, size: int, is_dir: bool) -> bytes:
+    raw = name.encode('utf-16-le')
+    return struct.pack('<QQQQQQQIIBB', parent | 1 << 48, FILETIME, FILETIME, FILETIME, FILETIME,
+                       align(size, CLUSTER), size, 0x10000000 if is_dir else 0x20, 0,
+                       len(raw) // 2, namespace) + raw
+
+
+def index_entry(number: int, key: bytes, subnode: int = None, last: bool = False) -> bytes:
+    length = align(0x10 + len(key)) + (8 if subnode is not None else 0)
+    flags = (1 if subnode is not None else 0) | (2 if last else 0)
+    out = struct.pack('<QHHB3x', number | 1 << 48 if not last else 0, length, len(key), flags) + key
+    out = out.ljust(length - (8 if subnode is not None else 0), b'\x00')
+    if subnode is not None:
+        out += struct.pack('<Q', subnode)
+    return out
+
+
+def node(entries: bytes, offset: int, allocated: int, flags: int) -> bytes:
+    return struct.pack('<IIIB3x', offset, offset + len(entries), allocated, flags)
+
+
+class Node(object):
+    def __init__(self, name, is_dir, parent=None, size=0):
+        self.name = name
+        self.is_dir = is_dir
+        self.parent = parent
+        self.size = size
+        self.children = []
+        self.number = None
+        self.deleted = False
+        self.short = None
+        self.runs = []
+        self.extension = None
+
+    @property
+    def path(self):
+        parts = []
+        node = self
+        while node.parent is not None:
+            parts.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(parts[::-1])
+
+
+def content(node, seed):
+    digest = hashlib.sha256(('%s:%s' % (seed, node.path)).encode()).digest()
+    return (digest * (node.size // 32 + 1))[:node.size]
+
+
+def build(args):
+    rnd = random.Random(args.seed)
+    root = Node('', True)
+    root.number = 5
+    dirs = [root]
+    files = []
+    for i in range(args.files):
+        parent = rnd.choice(dirs)
+        if len(dirs) <= args.dirs and rnd.random() < 0.3:
+            d = Node('Folder %d' % len(dirs) if rnd.random() < 0.5 else 'dir%d' % len(dirs), True, parent)
+            parent.children.append(d)
+            dirs.append(d)
+            parent = d
+        name = 'Document number %d.txt' % i if rnd.random() < 0.5 else 'f%d.bin' % i
+        f = Node(name, False, parent, rnd.choice([0, rnd.randint(1, 600), rnd.randint(600, args.max_size)]))
+        parent.children.append(f)
+        files.append(f)
+
+    for f in files:
+        f.deleted = rnd.random() < args.deleted
+        if ' ' in f.name:
+            f.short = (f.name.replace(' ', '')[:6] + '~1.TXT').upper()
+    for d in dirs[1:]:
+        if ' ' in d.name:
+            d.short = (d.name.replace(' ', '')[:6] + '~1').upper()
+
+    # record numbers, one extension record for fragmented file
+    nodes = dirs[1:] + files
+    number = 24
+    for n in nodes:
+        n.number = number
+        number += 1
+    records = number + len(nodes) // 4 + 8
+    fragmented = [f for f in files if f.size > 3 * CLUSTER and not f.deleted]
+    if fragmented:
+        fragmented[0].extension = number
+        records += 1
+
+    # clusters: boot, MFT in two runs, then data
+    cursor = [16]
+
+    def alloc(count):
+        first = cursor[0]
+        cursor[0] += count
+        return first
+
+    mft_clusters = (records * RECORD + CLUSTER - 1) // CLUSTER
+    half = mft_clusters // 2
+    mft_runs = [(alloc(half), half)]
+    alloc(3)
+    mft_runs.append((alloc(mft_clusters - half), mft_clusters - half))
+    mirror = alloc(1)
+
+    for f in files:
+        if f.size <= 400:
+            continue
+        count = (f.size + CLUSTER - 1) // CLUSTER
+        if count > 2 and rnd.random() < args.fragment:
+            part = rnd.randint(1, count - 1)
+            f.runs = [(alloc(part), part)]
+            alloc(rnd.randint(1, 4))
+            f.runs.append((alloc(count - part), count - part))
+        elif count > 3 and rnd.random() < 0.1:
+            # hole in middle of file
+            f.runs = [(alloc(1), 1), (None, 1), (alloc(count - 2), count - 2)]
+        else:
+            f.runs = [(alloc(count), count)]
+
+    # index blocks of directories are allocated later
+    out_records = {}
+    index_clusters = {}
+
+    def directory_index(d):
+        items = []
+        for c in d.children:
+            if c.deleted:
+                continue
+            if c.short:
+                items.append((c.short, c, 2))
+                items.append((c.name, c, 1))
+            else:
+                items.append((c.name, c, 3))
+        if d is root:
+            for i, name in enumerate(SYSTEM):
+                if name is not None:
+                    items.append((name, None, 3, i))
+        items = [x if len(x) == 4 else x + (x[1].number,) for x in items]
+        items.sort(key=lambda x: x[0].upper())
+        keys = [index_entry(n, file_name(d.number, name, ns, c.size if c else 0, c.is_dir if c else False))
+                for name, c, ns, n in items]
+
+        small = sum(len(k) for k in keys) < 400
+        if small:
+            entries = b''.join(keys) + index_entry(0, b'', last=True)
+            value = struct.pack('<IIIB3x', 0x30, 1, INDEX_BLOCK, 1) + node(entries, 0x10, 0x10 + len(entries), 0) + entries
+            return [resident(0x90, value, 3, '$I30')]
+
+        # B-tree: leaves, then internal nodes until separators fit in root
+        blocks = []
+        current = []
+        separators = []
+        for k in keys:
+            if sum(len(x) for x in current) + len(k) > INDEX_BLOCK - 0x60 and current:
+                separators.append(k)
+                blocks.append(current)
+                current = []
+                continue
+            current.append(k)
+        blocks.append(current)
+        children = list(range(len(blocks)))
+
+        def with_subnode(key, vcn):
+            length = struct.unpack_from('<H', key, 8)[0]
+            fixed = bytearray(key[:length])
+            struct.pack_into('<H', fixed, 8, length + 8)
+            fixed[12] |= 1
+            return bytes(fixed) + struct.pack('<Q', vcn)
+
+        def entries_of(seps, kids):
+            return [with_subnode(sep, kid) for sep, kid in zip(seps, kids)]
+
+        while sum(len(x) + 8 for x in separators) > 300:
+            groups, group_seps, upper_seps = [], [], []
+            group, gseps = [children[0]], []
+            for sep, kid in zip(separators, children[1:]):
+                if sum(len(x) + 8 for x in gseps) + len(sep) + 8 > INDEX_BLOCK - 0x80:
+                    groups.append(group)
+                    group_seps.append(gseps)
+                    upper_seps.append(sep)
+                    group, gseps = [kid], []
+                else:
+                    gseps.append(sep)
+                    group.append(kid)
+            groups.append(group)
+            group_seps.append(gseps)
+            children = []
+            for group, gseps in zip(groups, group_seps):
+                blocks.append(entries_of(gseps, group) + [('END', group[-1])])
+                children.append(len(blocks) - 1)
+            separators = upper_seps
+
+        # spare block which is not in bitmap, it must be ignored
+        count = len(blocks) + 1
+        first = alloc(count)
+        index_clusters[d.number] = (first, blocks)
+        root_entries = b''.join(entries_of(separators, children))
+        root_entries += index_entry(0, b'', subnode=children[-1], last=True)
+        value = struct.pack('<IIIB3x', 0x30, 1, INDEX_BLOCK, 1) + node(root_entries, 0x10, 0x10 + len(root_entries), 1) + root_entries
+        bitmap = bytearray(align(count, 64) // 8)
+        for i in range(len(blocks)):
+            bitmap[i // 8] |= 1 << (i % 8)
+        return [resident(0x90, value, 3, '$I30'),
+                non_resident(0xA0, [(first, count)], count * INDEX_BLOCK, 4, '$I30'),
+                resident(0xB0, bytes(bitmap), 5, '$I30')]
+
+    img_clusters = [0]
+
+    def make_file_record(n):
+        names = []
+        if n.short:
+            names.append(resident(0x30, file_name(n.parent.number, n.short, 2, n.size, n.is_dir), 1))
+            names.append(resident(0x30, file_name(n.parent.number, n.name, 1, n.size, n.is_dir), 2))
+        else:
+            names.append(resident(0x30, file_name(n.parent.number, n.name, 3, n.size, n.is_dir), 2))
+        attrs = [resident(0x10, standard_information(), 0)] + names
+        flags = 0 if n.deleted else 1
+        if n.is_dir:
+            attrs += directory_index(n)
+            flags |= 2
+        elif n.size <= 400:
+            attrs.append(resident(0x80, content(n, args.seed), 6))
+        elif n.extension is not None:
+            # data split between base and extension record
+            first, second = n.runs[:1], n.runs[1:]
+            vcn = first[0][1]
+            listing = b''
+            for type, num, start, id in [(0x10, n.number, 0, 0), (0x30, n.number, 0, 2),
+                                         (0x80, n.number, 0, 6), (0x80, n.extension, vcn, 0)]:
+                listing += struct.pack('<IHBBQQH', type, 0x20, 0, 0x1A, start, num | 1 << 48, id).ljust(0x20, b'\x00')
+            attrs.insert(1, resident(0x20, listing, 7))
+            attrs.append(non_resident(0x80, first, n.size, 6))
+            ext = non_resident(0x80, second, n.size, 0, start_vcn=vcn)
+            out_records[n.extension] = record(n.extension, 1, [ext], base=n.number | 1 << 48)
+        else:
+            attrs.append(non_resident(0x80, n.runs, n.size, 6))
+        out_records[n.number] = record(n.number, flags, attrs)
+
+    # system records
+    for i, name in enumerate(SYSTEM):
+        if i == 5:
+            continue
+        attrs = [resident(0x10, standard_information(), 0)]
+        if name is not None:
+            attrs.append(resident(0x30, file_name(5, name, 3, 0, False), 1))
+        if i == 0:
+            attrs.append(non_resident(0x80, mft_runs, records * RECORD, 6))
+        out_records[i] = record(i, 1, attrs)
+
+    for n in nodes:
+        make_file_record(n)
+    root_attrs = [resident(0x10, standard_information(), 0), resident(0x30, file_name(5, '.', 3, 0, True), 1)]
+    root_attrs += directory_index(root)
+    out_records[5] = record(5, 3, root_attrs)
+
+    total = cursor[0] + 8
+    img = bytearray(total * CLUSTER)
+
+    # boot sector
+    boot = bytearray(SECTOR)
+    boot[0:3] = b'\xEB\x52\x90'
+    boot[3:11] = b'NTFS    '
+    struct.pack_into('<HB', boot, 0x0B, SECTOR, CLUSTER // SECTOR)
+    boot[0x15] = 0xF8
+    struct.pack_into('<QQQ', boot, 0x28, total * CLUSTER // SECTOR - 1, mft_runs[0][0], mirror)
+    boot[0x40] = 0xF6
+    boot[0x44] = 1
+    struct.pack_into('<Q', boot, 0x48, 0x1122334455667788)
+    boot[510:512] = b'\x55\xAA'
+    img[0:SECTOR] = boot
+
+    # MFT records through its runs
+    mft = bytearray(mft_clusters * CLUSTER)
+    for number, rec in out_records.items():
+        mft[number * RECORD:(number + 1) * RECORD] = rec
+    pos = 0
+    for lcn, count in mft_runs:
+        img[lcn * CLUSTER:(lcn + count) * CLUSTER] = mft[pos:pos + count * CLUSTER]
+        pos += count * CLUSTER
+    img[mirror * CLUSTER:mirror * CLUSTER + 4 * RECORD] = mft[:4 * RECORD]
+
+    # index blocks
+    for number, (first, blocks) in index_clusters.items():
+        for i, entries in enumerate(blocks + [[]]):
+            block = bytearray(INDEX_BLOCK)
+            if entries and entries[-1][0] == 'END':
+                body = b''.join(entries[:-1]) + index_entry(0, b'', subnode=entries[-1][1], last=True)
+            else:
+                body = b''.join(entries) + index_entry(0, b'', last=True)
+            struct.pack_into('<4sHHQQ', block, 0, b'INDX', 0x28, 9, 0, i)
+            block[0x18:0x28] = node(body, 0x28, INDEX_BLOCK - 0x18, 0)
+            block[0x40:0x40 + len(body)] = body
+            if i == len(blocks):
+                # stale block, it is not in bitmap
+                block[0x40:0x50] = b'\xAA' * 16
+            img[(first + i) * CLUSTER:(first + i + 1) * CLUSTER] = protect(block, 0x28)
+
+    for f in files:
+        data = content(f, args.seed)
+        vcn = 0
+        for lcn, count in f.runs:
+            piece = data[vcn * CLUSTER:(vcn + count) * CLUSTER]
+            if lcn is not None:
+                img[lcn * CLUSTER:lcn * CLUSTER + len(piece)] = piece
+            vcn += count
+
+    manifest = []
+    for f in files:
+        data = content(f, args.seed)
+        # sparse cluster reads back as zeros
+        vcn = 0
+        expected = bytearray(data)
+        for lcn, count in f.runs:
+            if lcn is None:
+                expected[vcn * CLUSTER:(vcn + count) * CLUSTER] = bytes(len(expected[vcn * CLUSTER:(vcn + count) * CLUSTER]))
+            vcn += count
+        manifest.append({'path': f.path, 'size': f.size, 'deleted': f.deleted, 'record': f.number,
+                         'short': f.short, 'sha256': hashlib.sha256(bytes(expected)).hexdigest()})
+    return bytes(img), manifest
+
+
+def main():
+    p = argparse.ArgumentParser(description='Generate synthetic NTFS images for benchmarks')
+    p.add_argument('output')
+    p.add_argument('--files', type=int, default=100, help='Number of files')
+    p.add_argument('--dirs', type=int, default=10, help='Maximum number of directories')
+    p.add_argument('--deleted', type=float, default=0.1, help='Share of deleted files')
+    p.add_argument('--fragment', type=float, default=0.3, help='Share of files split in two runs')
+    p.add_argument('--max-size', type=int, default=40000)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--manifest', metavar='file', help='Save json manifest of files')
+    args = p.parse_args()
+    img, manifest = build(args)
+    with open(args.output, 'wb') as f:
+        f.write(img)
+    if args.manifest:
+        with open(args.manifest, 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# Benchmarks of parsing, listing, extracting and writing on generated images
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+
+from lib.fat import FAT
+from lib.importer import write_file
+
+# generated images, options are the ones of mkimage.py
+IMAGES = {
+    'fat12-small': dict(fat='FAT12', files=300, dirs=20, depth=3, lfn=0.5, fragment=0.0,
+                        deleted=0.1, min_size=0, max_size=8000, cluster_size=2048),
+    'fat16-lfn':   dict(fat='FAT16', files=20000, dirs=200, depth=4, lfn=0.8, fragment=0.0,
+                        deleted=0.1, min_size=0, max_size=4000, cluster_size=2048),
+    'fat16-frag':  dict(fat='FAT16', files=2000, dirs=50, depth=3, lfn=0.5, fragment=0.3,
+                        deleted=0.1, min_size=0, max_size=60000, cluster_size=2048),
+    'fat32-large': dict(fat='FAT32', files=4000, dirs=100, depth=4, lfn=0.5, fragment=0.05,
+                        deleted=0.1, min_size=0, max_size=120000, cluster_size=4096),
+}
+
+# cases are run in own process, so peak RSS belongs to one case
+CASES = ['init', 'resolve', 'json', 'ndjson', 'extract', 'write']
+
+# file written by write case
+WRITE_SIZE = 1 << 20
+
+
+def make_args(image: str, **kwargs) -> Namespace:
+    """Arguments of main.py for FAT object"""
+
+    args = Namespace(file=image, info=False, list=None, json=False, ndjson=False, extract=False,
+                     deleted=False, manifest=None, write=None, index=None, in_place=False,
+                     overlay=None, workers=None, backend=None, carve=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def quiet(func) -> None:
+    """Run CLI method with output and progress dropped, methods of FAT end with exit()"""
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        func()
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def run_case(case: str, image: str, manifest: list) -> dict:
+    """Do one case in this process, returns time and amount of work"""
+
+    live = [x for x in manifest if not x['deleted']]
+
+    if case == 'init':
+        start = time.perf_counter()
+        for _ in range(100):
+            FAT(make_args(image)).image.close()
+        return {'seconds': time.perf_counter() - start, 'items': 100, 'unit': 'opens'}
+
+    if case == 'resolve':
+        fat = FAT(make_args(image))
+        start = time.perf_counter()
+        found = fat.resolve_many([x['path'] for x in live])
+        seconds = time.perf_counter() - start
+        assert all(found.values()), 'path is not resolved'
+        return {'seconds': seconds, 'items': len(live), 'unit': 'paths'}
+
+    if case in ('json', 'ndjson'):
+        fat = FAT(make_args(image, list='/', json=case == 'json', ndjson=case == 'ndjson', deleted=True))
+        start = time.perf_counter()
+        quiet(fat.print_catalogs)
+        return {'seconds': time.perf_counter() - start, 'items': len(manifest), 'unit': 'entries'}
+
+    if case == 'extract':
+        workdir = tempfile.mkdtemp(prefix='fatbench-')
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            fat = FAT(make_args(os.path.join(cwd, image), list='/', extract=True))
+            start = time.perf_counter()
+            quiet(fat.print_catalogs)
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+        return {'seconds': seconds, 'items': sum(x['size'] for x in live), 'unit': 'bytes'}
+
+    if case == 'write':
+        workdir = tempfile.mkdtemp(prefix='fatbench-')
+        try:
+            copy = shutil.copy(image, os.path.join(workdir, 'image.img'))
+            source = os.path.join(workdir, 'benchmark.bin')
+            with open(source, 'wb') as f:
+                f.write(os.urandom(WRITE_SIZE))
+            fat = FAT(make_args(copy, write=source, in_place=True))
+            start = time.perf_counter()
+            quiet(lambda: write_file(fat))
+            seconds = time.perf_counter() - start
+        finally:
+            shutil.rmtree(workdir)
+        return {'seconds': seconds, 'items': WRITE_SIZE, 'unit': 'bytes'}
+
+    raise ValueError(f'Unknown case {case}')
+
+
+def spawn_case(case: str, image: str, manifest: str) -> dict:
+    """Run case in child process, peak RSS is taken from wait4()"""
+
+    proc = subprocess.Popen([sys.executable, __file__, '--child', case, image, manifest],
+                            stdout=subprocess.PIPE)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    if status != 0:
+        raise RuntimeError(f'Case {case} on {image} failed')
+
+    result = json.loads(output)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    result['rss'] = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return result
+
+
+def prepare(name: str, workdir: str) -> tuple:
+    """
+    Generate image once, returns (image path, manifest path).
+    Generator runs in own process, else peak RSS of this process
+    is inherited by children and spoils their numbers.
+    """
+    image = os.path.join(workdir, name + '.img')
+    manifest = os.path.join(workdir, name + '.json')
+    if not os.path.exists(image) or not os.path.exists(manifest):
+        options = []
+        for key, value in dict(IMAGES[name], slack=0.5, seed=1).items():
+            options += ['--' + key.replace('_', '-'), str(value)]
+        subprocess.run([sys.executable, os.path.join(BENCH, 'mkimage.py'), image,
+                        '--manifest', manifest] + options, check=True)
+    return image, manifest
+
+
+def throughput(result: dict) -> str:
+    rate = result['items'] / result['seconds'] if result['seconds'] else 0
+    if result['unit'] == 'bytes':
+        return f'{rate / 2**20:10.1f} MiB/s'
+    return f"{rate:10.0f} {result['unit']}/s"
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Cases slower or bigger than baseline by more than threshold"""
+
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        if result['seconds'] > old['seconds'] * (1 + threshold):
+            regressions.append(f"{key}: time {old['seconds']:.4f}s -> {result['seconds']:.4f}s")
+        if result['rss'] > old['rss'] * (1 + threshold):
+            regressions.append(f"{key}: rss {old['rss'] >> 20} MiB -> {result['rss'] >> 20} MiB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of fat_ntfs_dumper on generated images')
+    parser.add_argument('--images', nargs='+', choices=list(IMAGES), default=list(IMAGES))
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every case, best time is taken')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'fatbench'),
+                        help='Where generated images are kept between runs')
+    parser.add_argument('--save', metavar='name', help='Save results as bench/baselines/<name>.json')
+    parser.add_argument('--compare', metavar='name', help='Compare results with saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown (default: 0.2)')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        case, image, manifest = args.child
+        with open(manifest) as f:
+            print(json.dumps(run_case(case, image, json.load(f))))
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {}
+    for name in args.images:
+        image, manifest = prepare(name, args.workdir)
+        for case in args.cases:
+            # writing to FAT32 is not realized
+            if case == 'write' and IMAGES[name]['fat'] == 'FAT32':
+                continue
+
+            runs = [spawn_case(case, image, manifest) for _ in range(args.repeat)]
+            result = min(runs, key=lambda x: x['seconds'])
+            result['rss'] = max(x['rss'] for x in runs)
+            results[f'{name}/{case}'] = result
+            print(f"{name:12} {case:8} {result['seconds']:9.4f}s {throughput(result)} "
+                  f"{result['rss'] / 2**20:8.1f} MiB", flush=True)
+
+    if args.save:
+        os.makedirs(os.path.join(BENCH, 'baselines'), exist_ok=True)
+        with open(os.path.join(BENCH, 'baselines', args.save + '.json'), 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(os.path.join(BENCH, 'baselines', args.compare + '.json')) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print('[!] Regression', line)
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# Batch mode: many images processed by pool of processes with one combined report
+import glob
+import io
+import json
+import os
+import signal
+import sys
+import time
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+
+from lib.stats import stats
+from lib.util import (carve_files, check_volume, get_info_about_catalogs, get_info_about_filesystem,
+                      hash_files, print_extent_map, resolve_manifest)
+
+
+class ImageTimeout(Exception):
+    """Image is not processed in time given by --timeout"""
+
+
+def expand_images(patterns: list) -> list:
+    """
+    Paths of images from glob patterns, `@file` takes paths from file,
+    one per line. Order is kept, repeated paths are dropped.
+    """
+    images = []
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            with open(pattern[1:]) as f:
+                images.extend(line.strip() for line in f if line.strip())
+        elif glob.has_magic(pattern):
+            images.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            # missing file is reported as error of this image
+            images.append(pattern)
+
+    return list(dict.fromkeys(x for x in images if not os.path.isdir(x)))
+
+
+def operation_of(args) -> tuple:
+    """(name, function) of operation chosen by flags, info by default"""
+
+    if args.manifest:
+        return 'manifest', resolve_manifest
+    if args.carve:
+        return 'carve', carve_files
+    if args.hash:
+        return 'hash', hash_files
+    if args.extents:
+        return 'extents', print_extent_map
+    if args.check:
+        return 'check', check_volume
+    if args.list:
+        return 'list', get_info_about_catalogs
+    return 'info', get_info_about_filesystem
+
+
+def parse_output(text: str, many: bool) -> tuple:
+    """Json documents and other lines of captured output"""
+
+    documents = []
+    lines = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            documents.append(json.loads(line))
+        except ValueError:
+            lines.append(line)
+
+    if not many and len(documents) == 1:
+        return documents[0], lines
+    return documents or None, lines
+
+
+def on_alarm(signum, frame):
+    raise ImageTimeout()
+
+
+def process_image(image: str, args: Namespace) -> dict:
+    """
+    Run operation on one image in worker. Output is captured and parsed,
+    exit() of CLI methods and exceptions become error of this image only.
+    """
+    args = Namespace(**vars(args))
+    args.file    = image
+    # parallelism is given by pool, not by threads inside image
+    args.workers = 1
+    args.output  = os.path.join(args.output or 'extracted', image.strip('/').replace('/', '_'))
+    name, func = operation_of(args)
+    if name == 'list' and not args.json:
+        args.ndjson = True
+    elif name != 'list':
+        args.json = True
+
+    if args.stats:
+        stats.enable()
+        stats.reset()
+
+    record = {'image': image, 'operation': name, 'status': 'ok'}
+    out, err = io.StringIO(), io.StringIO()
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    if args.timeout:
+        signal.setitimer(signal.ITIMER_REAL, args.timeout)
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    try:
+        with redirect_stdout(out), redirect_stderr(err):
+            func(args)
+    except ImageTimeout:
+        record.update(status='timeout', error=f'Image is not processed in {args.timeout}s')
+    except SystemExit:
+        # CLI methods print reason and call exit() on errors
+        messages = [x for x in out.getvalue().splitlines() if x.startswith('[!]')]
+        record.update(status='error', error=messages[-1][4:] if messages else 'exit')
+    except Exception as e:
+        record.update(status='error', error=f'{type(e).__name__}: {e}')
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+    record['seconds'] = round(time.perf_counter() - wall, 6)
+    record['cpu'] = round(time.process_time() - cpu, 6)
+    record['result'], lines = parse_output(out.getvalue(), name == 'list')
+    if record['status'] == 'timeout':
+        # output is cut at random place
+        record['result'] = None
+    messages = [x for x in lines + err.getvalue().splitlines() if x.startswith('[!]') or x.startswith('[*] Partition')]
+    if messages:
+        record['messages'] = messages
+    if args.stats:
+        record['stats'] = stats.report()
+    return record
+
+
+def run_pool(images: list, args: Namespace, workers: int):
+    """
+    Yield (image, record) as images are done. When worker dies, the pool
+    breaks for every image in flight, they are run again one by one,
+    so only image which kills worker is reported as crashed.
+    """
+    broken = []
+    with ProcessPoolExecutor(max_workers=max(min(workers, len(images)), 1)) as pool:
+        futures = {pool.submit(process_image, image, args): image for image in images}
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                yield image, future.result()
+            except BrokenProcessPool:
+                broken.append(image)
+
+    if len(images) == 1 and broken:
+        yield images[0], {'image': images[0], 'operation': operation_of(args)[0], 'status': 'crashed',
+                          'error': 'Worker process died'}
+        return
+
+    for image in broken:
+        yield from run_pool([image], args, 1)
+
+
+def run_batch(args: Namespace) -> None:
+    """Process images from --batch patterns and print combined json or json lines report"""
+
+    if args.write or args.import_dir or args.mkdir:
+        print('[!] Writing is not supported in batch mode')
+        exit(0)
+
+    images = expand_images(args.batch)
+    if not images:
+        print('[!] No images found')
+        exit(0)
+
+    workers = args.workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    records = {}
+    for image, record in run_pool(images, args, workers):
+        records[image] = record
+        if args.ndjson:
+            print(json.dumps(record), flush=True)
+        else:
+            print(f"\r[*] Images {len(records)}/{len(images)}", end='', file=sys.stderr, flush=True)
+    if not args.ndjson:
+        print(file=sys.stderr)
+
+    statuses = [x['status'] for x in records.values()]
+    summary = {
+        'images': len(images),
+        'ok': statuses.count('ok'),
+        'error': statuses.count('error'),
+        'timeout': statuses.count('timeout'),
+        'crashed': statuses.count('crashed'),
+        'workers': workers,
+        'seconds': round(time.perf_counter() - started, 6),
+        'image_seconds': round(sum(x.get('seconds', 0) for x in records.values()), 6),
+        'slowest': [{'image': x['image'], 'seconds': x['seconds']} for x in
+                    sorted(records.values(), key=lambda x: -x.get('seconds', 0))[:5] if 'seconds' in x],
+    }
+
+    if args.ndjson:
+        print(json.dumps({'summary': summary}))
+    else:
+        print(json.dumps({'summary': summary, 'images': [records[x] for x in images]}))
@@ -0,0 +1,39 @@
+# Bounded caches shared by threads
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded mapping, least recently used item goes first. Shared by threads"""
+
+    def __init__(self, limit: int, on_evict=None):
+        self.limit    = max(limit, 1)
+        self.items    = OrderedDict()
+        self.lock     = threading.Lock()
+        self.on_evict = on_evict
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.limit:
+                _, old = self.items.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict(old)
+
+    def drop(self, match) -> None:
+        with self.lock:
+            for key in [x for x in self.items if match(x)]:
+                del self.items[key]
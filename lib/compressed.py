@@ -0,0 +1,615 @@
+# Random access to images compressed with gzip or zstd through seek points saved next to image
+import bisect
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from lib.cache import LRUCache
+from lib.image import Image
+from lib.stats import stats
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# distance between seek points in uncompressed stream and deflate history needed at point
+SPAN       = 1 << 20
+WINDOW     = 32 << 10
+
+# empty stored block written by sync and full flush, next block starts on byte boundary
+SYNC       = b'\x00\x00\xff\xff'
+
+# compressed bytes read at once and biggest piece of output of one call
+INPUT      = 64 << 10
+OUTPUT     = 128 << 10
+
+# blocks of uncompressed image kept in cache, 64 MiB
+BLOCK      = 64 << 10
+BLOCKS     = 1024
+
+
+def compression_of(filename: str) -> str:
+    """Container of image by magic bytes: 'gzip', 'zstd' or None for raw image"""
+
+    try:
+        with open(filename, 'rb') as f:
+            head = f.read(4)
+    except OSError:
+        return None
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def default_seek_index_path(filename: str) -> str:
+    return os.path.abspath(filename) + '.seekidx'
+
+
+def gzip_header(fd: int, pos: int) -> int:
+    """Length of gzip member header at pos or None when there is no member"""
+
+    head = os.pread(fd, 10, pos)
+    if len(head) < 10 or not head.startswith(GZIP_MAGIC):
+        return None
+    flags = head[3]
+    n = 10
+    if flags & 0x04:
+        n += 2 + int.from_bytes(os.pread(fd, 2, pos + n), 'little')
+    # file name and comment end with zero byte
+    for flag in (0x08, 0x10):
+        if flags & flag:
+            while True:
+                chunk = os.pread(fd, 256, pos + n)
+                if not chunk:
+                    return None
+                i = chunk.find(0)
+                if i != -1:
+                    n += i + 1
+                    break
+                n += len(chunk)
+    if flags & 0x02:
+        n += 2
+    return n
+
+
+def zstd_frames(fd: int, size: int) -> list:
+    """
+    (start, end, content size) of zstd frames found by headers of frames and blocks,
+    content size is None when frame does not declare it. Skippable frames are passed.
+    """
+    frames = []
+    pos = 0
+    while pos + 4 <= size:
+        head = os.pread(fd, 18, pos)
+        magic = int.from_bytes(head[:4], 'little')
+        if 0x184D2A50 <= magic <= 0x184D2A5F:
+            pos += 8 + int.from_bytes(head[4:8], 'little')
+            continue
+        if head[:4] != ZSTD_MAGIC or len(head) < 6:
+            break
+
+        descriptor = head[4]
+        single = descriptor >> 5 & 1
+        fcs = (1 if single else 0, 2, 4, 8)[descriptor >> 6]
+        n = 5 + (0 if single else 1) + (0, 1, 2, 4)[descriptor & 3]
+        content = None
+        if fcs:
+            content = int.from_bytes(head[n:n + fcs], 'little') + (256 if fcs == 2 else 0)
+        start = pos
+        pos += n + fcs
+        while True:
+            block = int.from_bytes(os.pread(fd, 3, pos), 'little')
+            # rle block keeps one byte, other blocks keep their size
+            pos += 3 + (1 if block >> 1 & 3 == 1 else block >> 3)
+            if block & 1 or pos >= size:
+                break
+        if descriptor & 0x04:
+            pos += 4
+        frames.append((start, min(pos, size), content))
+    return frames
+
+
+class SeekIndex(object):
+    """
+    SQLite file next to compressed image with seek points: offsets in
+    uncompressed and compressed stream and deflate history before point.
+    It is keyed by size and mtime of image, stale index is rebuilt.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db   = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS points (output INTEGER PRIMARY KEY, input INTEGER, window BLOB);
+        ''')
+
+    def __meta(self) -> dict:
+        return dict(self.db.execute('SELECT key, value FROM meta'))
+
+    def is_fresh(self, size: int, mtime: int) -> bool:
+        meta = self.__meta()
+        return meta.get('version') == str(self.VERSION) and \
+               meta.get('size') == str(size) and \
+               meta.get('mtime') == str(mtime)
+
+    def load(self) -> tuple:
+        """Uncompressed size and (output, input, compressed window) of every point"""
+
+        points = self.db.execute('SELECT output, input, window FROM points ORDER BY output').fetchall()
+        return int(self.__meta()['output']), points
+
+    def rebuild(self, size: int, mtime: int, output: int, points: list) -> None:
+        with self.db:
+            self.db.execute('DELETE FROM meta')
+            self.db.execute('DELETE FROM points')
+            self.db.executemany('INSERT INTO points VALUES (?, ?, ?)', points)
+            # meta is written last, interrupted build stays stale
+            self.db.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('version', str(self.VERSION)),
+                ('size', str(size)),
+                ('mtime', str(mtime)),
+                ('output', str(output)),
+            ])
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class GzipStream(object):
+    """
+    Forward reader of gzip members from seek point. Decompressor is
+    either restored from copy or started with history of point.
+    """
+
+    def __init__(self, fd: int, pos: int, out: int, window: bytes = b'', decompressor=None):
+        self.fd       = fd
+        self.pos      = pos
+        self.out      = out
+        self.tail     = b''
+        self.pending  = False
+        self.members  = 0
+        self.start    = None
+        if decompressor is not None:
+            self.d = decompressor.copy()
+        else:
+            self.d = zlib.decompressobj(-15, zdict=window) if window else zlib.decompressobj(-15)
+
+    def position(self) -> int:
+        """Offset of first compressed byte not consumed by decompressor"""
+        return self.pos - len(self.tail)
+
+    def read(self, limit: int = None) -> bytes:
+        """Next piece of output, b'' at end of stream or when input up to limit is consumed"""
+
+        if limit is not None and self.pos > limit:
+            self.tail = self.tail[:len(self.tail) - (self.pos - limit)]
+            self.pos = limit
+
+        while self.d is not None:
+            if self.d.eof:
+                self.__next_member()
+                continue
+            if not self.tail and not self.pending:
+                if limit is not None and self.pos >= limit:
+                    return b''
+                self.tail = os.pread(self.fd, INPUT if limit is None else min(INPUT, limit - self.pos), self.pos)
+                self.pos += len(self.tail)
+                if not self.tail:
+                    # image is cut
+                    self.d = None
+                    break
+
+            data = self.d.decompress(self.tail, OUTPUT)
+            self.tail = self.d.unconsumed_tail
+            # full output may leave more of it inside decompressor
+            self.pending = len(data) == OUTPUT
+            if data:
+                self.out += len(data)
+                return data
+        return b''
+
+    def __next_member(self) -> None:
+        """Skip trailer of member and header of next one, if any"""
+
+        end = self.pos - len(self.d.unused_data) + 8
+        length = gzip_header(self.fd, end)
+        if length is None:
+            self.d = None
+            return
+        self.pos     = end + length
+        self.tail    = b''
+        self.pending = False
+        self.d       = zlib.decompressobj(-15)
+        self.members += 1
+        self.start   = (self.out, self.pos)
+
+    def checkpoint(self):
+        """Copy of decompressor, it resumes stream from position()"""
+        return self.d.copy()
+
+    def close(self) -> None:
+        self.d = None
+
+
+class ZstdStream(object):
+    """
+    Forward reader of zstd frames from start of frame, decompressed by
+    zstandard module or, when it is not installed, by zstd program.
+    With end of frame given only this frame is read.
+    """
+
+    def __init__(self, filename: str, pos: int, out: int, end: int = None):
+        self.out     = out
+        self.file    = open(filename, 'rb')
+        self.file.seek(pos)
+        self.process = None
+        if zstandard is not None:
+            self.reader = zstandard.ZstdDecompressor().stream_reader(self.file, read_across_frames=end is None)
+            return
+
+        self.process = subprocess.Popen([shutil.which('zstd'), '-dcq'],
+                                        stdin=self.file if end is None else subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.reader = self.process.stdout
+        if end is not None:
+            threading.Thread(target=self.__feed, args=(end - pos,), daemon=True).start()
+
+    def __feed(self, count: int) -> None:
+        """Give program only bytes of one frame"""
+
+        try:
+            while count > 0:
+                data = self.file.read(min(INPUT, count))
+                if not data:
+                    break
+                self.process.stdin.write(data)
+                count -= len(data)
+            self.process.stdin.close()
+        except (OSError, ValueError):
+            # stream is closed before frame is read to the end
+            pass
+
+    def read(self, limit: int = None) -> bytes:
+        data = self.reader.read(OUTPUT)
+        self.out += len(data)
+        return data
+
+    def close(self) -> None:
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        self.reader.close()
+        self.file.close()
+
+
+class CompressedImage(Image):
+    """
+    Read-only image inside compressed container. Uncompressed image is cut
+    into blocks kept in LRU cache, missing block is decompressed from nearest
+    seek point before it, sequential reads continue stream of previous read.
+    Seek points are found by one pass over image and saved next to it.
+    """
+
+    def __init__(self, filename: str, writable: bool = False):
+        if writable:
+            print(f'[!] {filename} is compressed, change it through --overlay or edited copy')
+            exit(0)
+        super().__init__(filename)
+        self.packed      = self.size
+        self.copy_method = 'write'
+        self.blocks      = LRUCache(BLOCKS)
+        self.lock        = threading.Lock()
+        # offsets of points in uncompressed image and (input, compressed window, decompressor) of them
+        self.offsets     = []
+        self.points      = []
+        self.stream      = None
+        self.buffer      = bytearray()
+        self.skip        = 0
+        self.shown       = 0
+
+        self.size = self.__load_points()
+
+    def seek_points(self) -> tuple:
+        """Uncompressed size and (output, input, window, decompressor) of points, one pass over image"""
+        raise NotImplementedError
+
+    def stream_at(self, point: int):
+        """Stream of output starting at point number"""
+        raise NotImplementedError
+
+    def progress(self, done: int, final: bool = False) -> None:
+        """Indexing takes one pass over whole image, show how far it is"""
+
+        now = time.monotonic()
+        if final or now - self.shown > 0.5:
+            self.shown = now
+            print(f'\r[*] Indexing {os.path.basename(self.filename)}: {done * 100 // max(self.packed, 1)}%',
+                  end='', file=sys.stderr, flush=True)
+
+    def advise(self, saved: int, size: int, advice: str) -> None:
+        """Every miss far from saved point decompresses up to it, say how to get more points"""
+
+        if size > 2 * SPAN and saved * SPAN * 4 < size:
+            print(f'\n[*] {os.path.basename(self.filename)} has few seek points, {advice}',
+                  end='', file=sys.stderr)
+
+    @stats.timed('seek_index')
+    def __load_points(self) -> int:
+        """Points from saved index, index is built when it is missing or stale"""
+
+        st = os.stat(self.filename)
+        try:
+            index = SeekIndex(default_seek_index_path(self.filename))
+            fresh = index.is_fresh(st.st_size, st.st_mtime_ns)
+        except (sqlite3.Error, OSError):
+            # directory of image is read-only or index is broken, points live only in memory
+            index, fresh = None, False
+
+        if fresh:
+            size, points = index.load()
+            points = [(out, pos, window, None) for out, pos, window in points]
+        else:
+            size, points = self.seek_points()
+            print(file=sys.stderr)
+            # history of points is kept compressed, it is needed only when point is used
+            points = [(out, pos, zlib.compress(window) if window else b'', decompressor)
+                      for out, pos, window, decompressor in points]
+            if index is not None:
+                try:
+                    index.rebuild(st.st_size, st.st_mtime_ns, size,
+                                  [x[:3] for x in points if x[3] is None])
+                except sqlite3.Error:
+                    pass
+
+        if index is not None:
+            index.close()
+        for point in points:
+            self.__add_point(*point)
+        return size
+
+    def __add_point(self, out: int, pos: int, window: bytes, decompressor) -> None:
+        i = bisect.bisect_left(self.offsets, out)
+        if i < len(self.offsets) and self.offsets[i] == out:
+            return
+        self.offsets.insert(i, out)
+        self.points.insert(i, (pos, window, decompressor))
+
+    def read(self, offset: int, size: int) -> bytes:
+        size = max(min(size, self.size - offset), 0)
+        if size == 0:
+            return b''
+        first = offset // BLOCK
+        last = (offset + size - 1) // BLOCK
+        data = b''.join(self.__block(block) for block in range(first, last + 1))
+        start = offset - first * BLOCK
+        return data[start:start + size]
+
+    def __block(self, block: int) -> bytes:
+        data = self.blocks.get(block)
+        if data is not None:
+            return data
+        with self.lock:
+            # other thread may have decompressed it while we waited
+            data = self.blocks.get(block)
+            if data is None:
+                data = self.__decompress(block)
+        return data
+
+    def __decompress(self, block: int) -> bytes:
+        """
+        Run stream up to block. Blocks passed on the way are dropped to keep
+        cache for touched ones, blocks after it in the same piece are cached.
+        """
+        start = block * BLOCK
+        i = bisect.bisect_right(self.offsets, start) - 1
+        if self.stream is None or not self.offsets[i] <= self.__done() <= start:
+            # stream is behind nearest point or after block, start from point
+            if self.stream is not None:
+                self.stream.close()
+            self.stream = self.stream_at(i)
+            self.buffer = bytearray()
+            self.skip   = -self.offsets[i] % BLOCK
+
+        found = None
+        while found is None:
+            data = self.stream.read()
+            if not data:
+                # end of image, last block is short
+                if self.buffer and self.__done() == start:
+                    found = bytes(self.buffer)
+                    self.blocks.put(block, found)
+                self.buffer = bytearray()
+                return found or b''
+
+            stats.count('bytes_decompressed', len(data))
+            if self.skip:
+                cut = min(self.skip, len(data))
+                self.skip -= cut
+                data = data[cut:]
+            self.buffer += data
+
+            first = self.__done() // BLOCK
+            count = len(self.buffer) // BLOCK
+            view = memoryview(self.buffer)
+            for k in range(max(block - first, 0), count):
+                piece = bytes(view[k * BLOCK:(k + 1) * BLOCK])
+                self.blocks.put(first + k, piece)
+                if first + k == block:
+                    found = piece
+            view.release()
+            stats.count('blocks_decompressed', count)
+            del self.buffer[:count * BLOCK]
+            self.__remember()
+        return found
+
+    def __done(self) -> int:
+        """Start of first block which is not complete in buffer"""
+        return self.stream.out - len(self.buffer) if not self.skip else self.stream.out + self.skip
+
+    def __remember(self) -> None:
+        """Keep copy of decompressor when stream went far from every point"""
+
+        checkpoint = getattr(self.stream, 'checkpoint', None)
+        if checkpoint is None or self.stream.d is None:
+            return
+        out = self.stream.out
+        i = bisect.bisect_right(self.offsets, out) - 1
+        if out - self.offsets[i] >= SPAN:
+            self.__add_point(out, self.stream.position(), None, checkpoint())
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        super().close()
+
+
+class GzipImage(CompressedImage):
+    """
+    Image in gzip file. Seek points are starts of members and places after
+    empty stored blocks of sync flush (gzip --rsyncable, pigz), they are saved
+    with 32 KiB of history. Plain single-member file has no such places, copies
+    of decompressor are kept for it in memory instead.
+    """
+
+    def seek_points(self) -> tuple:
+        length = gzip_header(self.fd, 0)
+        if length is None:
+            print(f'[!] {self.filename} is not gzip file')
+            exit(0)
+
+        stream = GzipStream(self.fd, length, 0)
+        points = [(0, length, b'', None)]
+        history = b''
+        members = 0
+        wanted = SPAN
+        probe = None
+        seen = bytearray()
+        limit = None
+
+        while True:
+            if limit is None and probe is None and stream.out >= wanted:
+                pos = stream.position()
+                i = os.pread(self.fd, INPUT, pos).find(SYNC)
+                if i == -1:
+                    points.append((stream.out, pos, None, stream.checkpoint()))
+                    wanted = stream.out + SPAN
+                else:
+                    limit = pos + i + len(SYNC)
+
+            data = stream.read(limit)
+            if stream.members != members:
+                # new member starts with empty history
+                members = stream.members
+                history = b''
+                probe = None
+                limit = None
+                if stream.start[0] >= wanted:
+                    points.append((*stream.start, b'', None))
+                    wanted = stream.start[0] + SPAN
+
+            if limit is not None and not data:
+                if stream.d is None:
+                    break
+                if stream.position() == limit and not stream.pending:
+                    probe = self.__probe(stream.out, limit, history)
+                limit = None
+                continue
+            if not data:
+                break
+
+            if probe is not None:
+                seen += data
+                point, expected = probe
+                if len(seen) >= len(expected):
+                    if seen[:len(expected)] == expected:
+                        points.append(point)
+                        wanted = point[0] + SPAN
+                    probe = None
+                    seen = bytearray()
+            history = (history + data)[-WINDOW:]
+            self.progress(stream.pos)
+
+        self.progress(self.packed, True)
+        self.advise(sum(1 for x in points if x[3] is None), stream.out,
+                    'only this run reads it fast, compress it with `gzip --rsyncable` or `pigz` to save them')
+        return stream.out, points
+
+    def __probe(self, out: int, pos: int, history: bytes):
+        """
+        Place after sync marker is seek point when inflate started there with history
+        gives the same bytes as the stream. Marker may be part of other data.
+        """
+        window = history[-WINDOW:]
+        d = zlib.decompressobj(-15, zdict=window) if window else zlib.decompressobj(-15)
+        try:
+            expected = d.decompress(os.pread(self.fd, INPUT, pos), 4096)
+        except zlib.error:
+            return None
+        if not expected:
+            return None
+        return (out, pos, window, None), expected
+
+    def stream_at(self, point: int):
+        pos, window, decompressor = self.points[point]
+        return GzipStream(self.fd, pos, self.offsets[point], zlib.decompress(window) if window else b'', decompressor)
+
+
+class ZstdImage(CompressedImage):
+    """
+    Image in zstd file. Seek points are starts of frames found by their
+    headers (pzstd and seekable format write many frames), index holds no
+    history. Frames which do not declare their size are measured once.
+    """
+
+    def __init__(self, filename: str, writable: bool = False):
+        if zstandard is None and shutil.which('zstd') is None:
+            print('[!] Reading of zstd image needs zstandard module or zstd program')
+            exit(0)
+        super().__init__(filename, writable)
+
+    def seek_points(self) -> tuple:
+        points = []
+        out = 0
+        for pos, end, content in zstd_frames(self.fd, self.packed):
+            if out - (points[-1][0] if points else -SPAN) >= SPAN:
+                points.append((out, pos, b'', None))
+            if content is None:
+                # frame written by stream does not know its size, measure it
+                stream = ZstdStream(self.filename, pos, out, end)
+                while stream.read():
+                    pass
+                stream.close()
+                content = stream.out - out
+            out += content
+            self.progress(end)
+
+        if not points:
+            print(f'[!] {self.filename} is not zstd file')
+            exit(0)
+        self.progress(self.packed, True)
+        self.advise(len(points), out, 'compress it with `pzstd` to get frame for every piece of image')
+        return out, points
+
+    def stream_at(self, point: int):
+        return ZstdStream(self.filename, self.points[point][0], self.offsets[point])
+
+
+CONTAINERS = {
+    'gzip': GzipImage,
+    'zstd': ZstdImage,
+}
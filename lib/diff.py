@@ -0,0 +1,327 @@
+# Bulk comparison of two snapshots of one FAT volume
+import json
+import sys
+from array import array
+from operator import ne
+
+from lib.entry import Entry
+from lib.layout import positions
+from lib.stats import stats
+
+# entries of FAT compared at once, equal chunks are skipped as whole
+CHUNK    = 1 << 16
+
+# records with directory bit which are not LFN parts
+DIR_FLAG = bytes(1 if x & 0x10 and x & 0x3F != 0x0F else 0 for x in range(256))
+
+# fields of entry compared between snapshots, access date changes on every read
+FIELDS   = ('name', 'attr', 'short_name', 'size', 'cluster', 'created', 'modified')
+
+
+def changed_entries(old: array, new: array) -> list:
+    """
+    Indexes of FAT entries which differ between tables. Tables are compared
+    by chunks as buffers, only chunks which differ are compared entry by entry.
+    """
+    changed = []
+    for start in range(0, min(len(old), len(new)), CHUNK):
+        a, b = old[start:start + CHUNK], new[start:start + CHUNK]
+        if a != b:
+            changed.extend(start + x for x in positions(bytes(map(ne, a, b))))
+    return changed
+
+
+def subdirectories(data: bytes, fat32: bool) -> list:
+    """
+    First clusters of live subdirectories in raw directory table. Attribute
+    bytes of all records are checked at once, only directories are unpacked.
+    """
+    end = data[::0x20].find(0)
+    if end == -1:
+        end = len(data) // 0x20
+
+    clusters = []
+    for i in positions(data[0xB:end * 0x20:0x20].translate(DIR_FLAG)):
+        record = data[i * 0x20:(i + 1) * 0x20]
+        # deleted entries, `.` and `..`
+        if record[0] in (0xE5, 0x2E):
+            continue
+        cluster = int.from_bytes(record[0x1A:0x1C], 'little')
+        if fat32:
+            cluster |= int.from_bytes(record[0x14:0x16], 'little') << 16
+        clusters.append(cluster)
+    return clusters
+
+
+def changed_fields(old, new) -> list:
+    """Names of fields which differ between two versions of entry"""
+
+    return [field for field in FIELDS if getattr(old, field) != getattr(new, field)]
+
+
+class Changes(object):
+    """
+    Changes found between snapshots. Entries are kept with node of their
+    parent directory, paths are made only for output.
+    """
+
+    def __init__(self, dirty: set):
+        self.dirty     = dirty
+        self.explained = set()
+        self.added     = []
+        self.removed   = []
+        self.modified  = []
+        self.moved     = []
+        self.unowned   = []
+        self.compared  = 0
+        self.parsed    = 0
+
+
+def dir_chain(fs, cluster: int) -> list:
+    """Clusters of directory table, cluster 0 is root"""
+
+    if cluster == 0:
+        return fs.chain(fs.root_cluster) if fs.fs_type == 'FAT32' else []
+    return fs.chain(cluster)
+
+
+def live_entries(entities: list) -> dict:
+    """Entries by case folded name without deleted ones, `.`, `..` and volume label"""
+
+    return {el.name.casefold(): el for el in entities
+            if not el.deleted and el.name not in ('.', '..') and el.type != '?'}
+
+
+def node_path(fs, node: list) -> str:
+    """Path of directory node, unknown name is found in parent on first use"""
+
+    parent, cluster, name, _ = node
+    if parent is None:
+        return name
+    if name is None:
+        if parent[3] is None:
+            parent[3] = {el.cluster: el.name for el in reversed(fs.load_dir(parent[1]))
+                         if el.type == 'd' and not el.deleted and el.name not in ('.', '..')}
+        name = node[2] = parent[3].get(cluster, f'<cluster {cluster}>')
+    return node_path(fs, parent) + '/' + name
+
+
+class SnapshotDiff(object):
+    """
+    Entries added, removed, modified and moved between old and new snapshot
+    of volume. FAT tables and directory tables are compared as buffers,
+    only directories which differ are parsed, cost follows size of change.
+    """
+
+    def __init__(self, new, old):
+        self.new     = new
+        self.old     = old
+        self.changes = Changes(set(changed_entries(old.decode_fat(), new.decode_fat())))
+
+    def compare(self) -> Changes:
+        changes = self.changes
+
+        # pairs of directory nodes [parent, cluster, name, names] of new and old snapshot
+        queue = [([None, 0, '', None], [None, 0, '', None])]
+        seen = set()
+        while queue:
+            while queue:
+                new, old = queue.pop()
+                if (new[1], old[1]) not in seen:
+                    seen.add((new[1], old[1]))
+                    self.__diff_pair(new, old, queue)
+            # moved directories are compared with their old place
+            self.__match_moves(queue)
+
+        self.__expand_dirs()
+        leftover = changes.dirty - changes.explained
+        if leftover:
+            self.__diff_chains(leftover)
+        return changes
+
+    def __diff_pair(self, new: list, old: list, queue: list) -> None:
+        """Compare directory in both snapshots, parse it only when its table differs"""
+
+        changes = self.changes
+        new_data, old_data = self.new.read_dir(new[1]), self.old.read_dir(old[1])
+        changes.compared += 1
+        if new_data == old_data:
+            # same table has same subdirectories, names are found only if needed for output
+            for cluster in subdirectories(new_data, self.new.fs_type == 'FAT32'):
+                queue.append(([new, cluster, None, None], [old, cluster, None, None]))
+            return
+
+        changes.parsed += 1
+        changes.explained.update(dir_chain(self.new, new[1]), dir_chain(self.old, old[1]))
+        new_entries = live_entries(self.new.load_dir(new[1]))
+        old_entries = live_entries(self.old.load_dir(old[1]))
+
+        for key, el in new_entries.items():
+            was = old_entries.get(key)
+            if was is None or was.type != el.type:
+                changes.added.append((new, el))
+                if was is not None:
+                    changes.removed.append((old, was))
+                continue
+
+            fields = changed_fields(was, el)
+            if el.type == 'd':
+                queue.append(([new, el.cluster, el.name, None], [old, was.cluster, was.name, None]))
+            elif changes.dirty and el.cluster and 'cluster' not in fields and \
+                    self.new.chain(el.cluster) != self.old.chain(was.cluster):
+                fields.append('chain')
+
+            if fields:
+                changes.modified.append((new, el, old, was, fields))
+                self.__explain(el, was)
+
+        for key, was in old_entries.items():
+            if key not in new_entries:
+                changes.removed.append((old, was))
+
+    def __match_moves(self, queue: list) -> None:
+        """Removed and added entries with same first cluster are one moved entry"""
+
+        changes = self.changes
+        removed = {}
+        for node, was in changes.removed:
+            if was.cluster:
+                removed.setdefault((was.cluster, was.type), []).append((node, was))
+
+        added = []
+        for node, el in changes.added:
+            candidates = removed.get((el.cluster, el.type)) if el.cluster else None
+            if not candidates:
+                added.append((node, el))
+                continue
+
+            old_node, was = candidates.pop(0)
+            changes.moved.append((node, el, old_node, was, changed_fields(was, el)))
+            self.__explain(el, was)
+            if el.type == 'd':
+                queue.append(([node, el.cluster, el.name, None], [old_node, was.cluster, was.name, None]))
+
+        changes.added = added
+        changes.removed = [x for candidates in removed.values() for x in candidates] + \
+                          [(node, was) for node, was in changes.removed if not was.cluster]
+
+    def __expand_dirs(self) -> None:
+        """Everything below added or removed directory is added or removed too"""
+
+        changes = self.changes
+        for fs, entries in ((self.new, changes.added), (self.old, changes.removed)):
+            seen = set()
+            for node, el in list(entries):
+                changes.explained.update(fs.chain(el.cluster) if el.cluster else [])
+                if el.type == 'd' and el.cluster not in seen:
+                    seen.add(el.cluster)
+                    for child in self.__subtree(fs, node, el, seen):
+                        entries.append(child)
+                        changes.explained.update(fs.chain(child[1].cluster) if child[1].cluster else [])
+
+    def __subtree(self, fs, node: list, entity, seen: set):
+        """Yield (node of parent, entry) for every live entry below directory"""
+
+        parent = [node, entity.cluster, entity.name, None]
+        for el in live_entries(fs.get_elements(entity)).values():
+            yield parent, el
+            if el.type == 'd' and el.cluster not in seen:
+                seen.add(el.cluster)
+                yield from self.__subtree(fs, parent, el, seen)
+
+    def __diff_chains(self, leftover: set) -> None:
+        """
+        FAT entries changed under entries which are equal in both snapshots.
+        Owners of such chains are found by walk over whole volume, it is
+        needed only when FAT was changed apart from directories.
+        """
+        new, old, changes = self.new, self.old, self.changes
+        new.init_entities()
+        for path, el in new.walk_paths(new.files, ''):
+            if not leftover:
+                break
+            if el.deleted or not el.cluster:
+                continue
+
+            clusters = new.chain(el.cluster)
+            if leftover.isdisjoint(clusters):
+                continue
+            was = old.resolve(path)
+            old_clusters = old.chain(was.cluster) if type(was) == Entry and was.cluster else []
+            leftover.difference_update(clusters, old_clusters)
+            if clusters != old_clusters:
+                node = [None, 0, path.rsplit('/', 1)[0], None]
+                changes.modified.append((node, el, node, was, ['chain']))
+
+        # changed chains which belong to no entry, like lost chains
+        changes.unowned = new.extents(sorted(leftover))
+
+    def __explain(self, el, was) -> None:
+        """Changes of FAT under chains of changed entry are explained by it"""
+
+        if el.cluster:
+            self.changes.explained.update(self.new.chain(el.cluster))
+        if was is not None and type(was) == Entry and was.cluster:
+            self.changes.explained.update(self.old.chain(was.cluster))
+
+
+@stats.timed('diff')
+def print_diff(new, old) -> None:
+    """Print changes since old snapshot as text, json report (-j) or json lines (--ndjson)"""
+
+    layout = ('fs_type', 'cluster_size', 'clusters_count', 'data_addr', 'root_addr')
+    if any(getattr(new, x) != getattr(old, x) for x in layout):
+        print('[!] Images are not snapshots of one volume')
+        exit(0)
+
+    changes = SnapshotDiff(new, old).compare()
+
+    records = []
+    for node, el in changes.added:
+        records.append({'change': 'added', **el.to_record(node_path(new, node) + '/' + el.name)})
+    for node, was in changes.removed:
+        records.append({'change': 'removed', **was.to_record(node_path(old, node) + '/' + was.name)})
+    for node, el, old_node, was, fields in changes.modified:
+        records.append({'change': 'modified', **el.to_record(node_path(new, node) + '/' + el.name),
+                        'fields': fields})
+    for node, el, old_node, was, fields in changes.moved:
+        records.append({'change': 'moved', **el.to_record(node_path(new, node) + '/' + el.name),
+                        'from': node_path(old, old_node) + '/' + was.name, 'fields': fields})
+    records.sort(key=lambda x: x['path'])
+
+    summary = {
+        'added': len(changes.added),
+        'removed': len(changes.removed),
+        'modified': len(changes.modified),
+        'moved': len(changes.moved),
+        'fat_entries_changed': len(changes.dirty),
+        'dirs_compared': changes.compared,
+        'dirs_parsed': changes.parsed,
+        'unowned_clusters': sum(count for _, count in changes.unowned),
+    }
+
+    if new.ndjson:
+        for record in records:
+            sys.stdout.write(json.dumps(record) + '\n')
+        print(json.dumps({'summary': summary, 'unowned': changes.unowned}))
+        return
+
+    if new.json:
+        print(json.dumps({'summary': summary, 'changes': records, 'unowned': changes.unowned}))
+        return
+
+    marks = {'added': '+', 'removed': '-', 'modified': '~', 'moved': '>'}
+    for record in records:
+        line = f"{marks[record['change']]} {record['path']} {record['type']}"
+        if record['change'] == 'moved':
+            line += f" from {record['from']}"
+        if record.get('fields'):
+            line += f" ({', '.join(record['fields'])})"
+        print(line)
+    for start, count in changes.unowned:
+        print(f'? clusters {start}-{start + count - 1} changed without owner')
+
+    print(f"Added: {summary['added']}, removed: {summary['removed']}, modified: {summary['modified']}, "
+          f"moved: {summary['moved']}, changed FAT entries: {summary['fat_entries_changed']}, "
+          f"directories compared: {summary['dirs_compared']}, parsed: {summary['dirs_parsed']}")
+
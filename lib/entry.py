@@ -0,0 +1,130 @@
+# Compact representation of directory entries
+import struct
+import sys
+
+FILE_ATTRIBUTE   = 0x20
+DIR_ATTRIBUTE    = 0x10
+VOLUME_ATTRIBUTE = 0x08
+
+# short and long name views of 32 bytes directory record
+DIR_ENTRY        = struct.Struct('<11sBBBHHHHHHHI')
+LFN_ENTRY        = struct.Struct('<B10sBBB12sH4s')
+LFN_ATTRIBUTE    = 0x0F
+
+
+def lfn_checksum(name: bytes) -> int:
+    """Checksum of 8.3 name stored in every LFN part"""
+
+    checksum = 0
+    for c in name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+    return checksum
+
+
+class Entry(object):
+    """
+    Directory entry with integer fields and interned names.
+    Timestamps are kept packed as in FAT: date << 16 | time.
+    Json shape of entry is made only for output, see to_dict().
+    """
+
+    __slots__ = ('attr', 'name', 'short_name', 'size', 'cluster',
+                 'created', 'modified', 'accessed', 'deleted', 'elements')
+
+    def __init__(self, attr: int, name: str, short_name: str, size: int, cluster: int,
+                 created: int = 0, modified: int = 0, accessed: int = 0, deleted: bool = False):
+        self.attr       = attr
+        self.name       = sys.intern(name)
+        self.short_name = sys.intern(short_name)
+        self.size       = size
+        self.cluster    = cluster
+        self.created    = created
+        self.modified   = modified
+        self.accessed   = accessed
+        self.deleted    = deleted
+
+        # children of directory, None until directory is parsed
+        if self.type == 'd' and name not in ('.', '..'):
+            self.elements = None
+        else:
+            self.elements = []
+
+    @property
+    def type(self) -> str:
+        """Directory bit wins over hidden, system and archive bits, volume label is neither"""
+
+        if self.attr & DIR_ATTRIBUTE:
+            return 'd'
+        elif self.attr & VOLUME_ATTRIBUTE:
+            return '?'
+        return 'f'
+
+    @property
+    def create_time(self) -> str:
+        return format_date(self.created >> 16)
+
+    def to_row(self) -> list:
+        """Flat list of fields, used for storing entry in index"""
+        return [self.attr, self.name, self.short_name, self.size, self.cluster,
+                self.created, self.modified, self.accessed, self.deleted]
+
+    @classmethod
+    def from_row(cls, row: list):
+        return cls(*row)
+
+    def to_record(self, path: str) -> dict:
+        """Flat record of entry for json lines output"""
+
+        return {
+            'path': path,
+            'type': self.type,
+            'name': self.name,
+            'short_name': self.short_name,
+            'size': self.size,
+            'cluster': self.cluster,
+            'created': format_timestamp(self.created),
+            'modified': format_timestamp(self.modified),
+            'accessed': format_timestamp(self.accessed),
+            'deleted': self.deleted
+        }
+
+    def to_dict(self, recursive: bool = True) -> dict:
+        """Entry in json shape of previous versions"""
+
+        obj = {
+            'Type': self.type,
+            '8DOT3Name': self.short_name,
+            'Name' : self.name,
+            'Size' : str(self.size),
+            'CreateTime' : self.create_time,
+            'Cluster' : hex(self.cluster),
+            'isDeleted' : self.deleted
+        }
+
+        if recursive and self.type == 'd':
+            obj['Elements'] = [el.to_dict() for el in self.elements or []]
+
+        return obj
+
+
+def format_date(date: int) -> str:
+    """FAT date to day-month-year string"""
+
+    day   = str(date & 0x1f)
+    month = str((date>>5) & 0x0f)
+    year  = str(1980 + (date >> 9))
+
+    return day + '-' + month + '-' + year
+
+
+def format_timestamp(stamp: int) -> str:
+    """Packed FAT date and time to ISO 8601 string, None for empty date"""
+
+    date, time = stamp >> 16, stamp & 0xFFFF
+    if not date:
+        return None
+
+    return '%04d-%02d-%02dT%02d:%02d:%02d' % (
+        1980 + (date >> 9), (date >> 5) & 0x0f, date & 0x1f,
+        time >> 11, (time >> 5) & 0x3f, (time & 0x1f) * 2
+    )
@@ -1,50 +1,197 @@
 import json
 import os
-import pathlib
-from datetime import datetime
+import sys
+from array import array
 from math import ceil
 from string import printable
 
+from lib.entry import DIR_ENTRY, LFN_ATTRIBUTE, LFN_ENTRY, Entry, lfn_checksum
+from lib.freespace import FreeSpace
+from lib.image import clone_image, open_image
+from lib.index import MetadataIndex, default_index_path
+from lib.inventory import print_inventory
+from lib.layout import ExtentMap
+from lib.recovery import carve, recover_clusters
+from lib.stats import CountingImage, stats
+from lib.volume import FileSystem
 
-class FAT(object):
+NOT_PRINTABLE  = bytes(x for x in range(256) if chr(x) not in printable)
+
+# lookup tables for batch unpacking of FAT12 nibbles with bytes.translate
+LOW_NIBBLE     = bytes(x & 0x0F for x in range(256))
+HIGH_NIBBLE    = bytes(x >> 4 for x in range(256))
+LOW_NIBBLE_SHL = bytes((x & 0x0F) << 4 for x in range(256))
+
+# sectors of FAT hashed on warm open of index
+FAT_SAMPLES    = 16
+
+
+class FAT(FileSystem):
+    @stats.timed('boot')
     def __init__(self, args):
-        with open(args.file, 'rb') as f:
-            data = f.read()
-        
+        super().__init__(args)
+        self.image = self.__open_image(args)
+        data = self.image.read(0, 0x200)
+
         self.FILE_ATTRIBUTE   = 0x20
         self.DIR_ATTRIBUTE    = 0x10
 
-        self.catalog          = args.list
-        self.json             = args.json
-        self.extract          = args.extract
-        self.show_deleted     = args.deleted
-
         if args.write:
             self.file_for_write   = args.write
-            self.file_entity      = {}
 
-        self.data             = data
-        self.oem              = self.data[0x3:0xB].decode()
+        self.oem              = data[0x3:0xB].decode()
         self.sector_size      = int.from_bytes(data[0xB:0xD], 'little')
         self.cluster_size     = self.sector_size * data[0xD]
         self.reserved_sectors = int.from_bytes(data[0xE:0x10], 'little')
         self.number_of_fat    = data[0x10]
         self.number_of_root   = int.from_bytes(data[0x11:0x13], 'little')
         self.fat_size         = self.sector_size * int.from_bytes(data[0x16:0x18], 'little')
-        self.fs_type          = data[0x36:0x3B].decode()
+        self.root_cluster     = 0
+
+        if self.fat_size == 0:
+            # FAT32 keeps size of FAT and root directory cluster in extended BPB
+            self.fat_size     = self.sector_size * int.from_bytes(data[0x24:0x28], 'little')
+            self.root_cluster = int.from_bytes(data[0x2C:0x30], 'little')
+
         self.f_fat_table      = self.reserved_sectors*self.sector_size
         self.s_fat_table      = self.f_fat_table + self.fat_size
-        self.root_addr        = self.s_fat_table + self.fat_size
+        self.root_addr        = self.f_fat_table + self.fat_size * self.number_of_fat
         self.data_addr        = self.root_addr + (self.number_of_root * 0x20)
-        self.files            = [] 
-        self.tmp              = []
-
-        if self.fs_type == 'FAT12':
-            self.fat12_clusters = []
-
-        self.__init_entities()
+        self.clusters_count   = self.__count_clusters(data)
+        self.fs_type          = self.__detect_fs_type()
+        self.next_cluster     = None
+        self.free_index       = None
+        self.layout           = None
+        self.files            = None
+        self.index            = None
+        self.paths            = {}
+        self.registered       = set()
+
+        if self.fs_type == 'FAT32':
+            self.root_addr    = self.data_addr + self.cluster_size * (self.root_cluster - 2)
+
+        # values of FAT entries
+        self.bad_cluster      = {'FAT12': 0xFF7, 'FAT16': 0xFFF7, 'FAT32': 0x0FFFFFF7}[self.fs_type]
+        self.end_of_chain     = self.bad_cluster + 1
+        self.end_of_file      = {'FAT12': 0xFFF, 'FAT16': 0xFFFF, 'FAT32': 0x0FFFFFFF}[self.fs_type]
+
+        if getattr(args, 'index', None) is not None and not self.__writes(args):
+            self.__open_index(args.index or default_index_path(args.file, getattr(args, 'volume', None)), data)
+
+    def __open_image(self, args):
+        """Open image, with --stats bytes moved through it are counted"""
+
+        image = self.__open_backend(args)
+        if stats.enabled:
+            return CountingImage(image, stats)
+        return image
+
+    @staticmethod
+    def __writes(args) -> bool:
+        """Write, import and mkdir change image"""
+        return any(getattr(args, x, None) for x in ('write', 'import_dir', 'mkdir'))
+
+    def __open_backend(self, args):
+        """Open image, for writing choose in place, overlay or edited copy"""
+
+        backend = getattr(args, 'backend', None)
+        overlay = getattr(args, 'overlay', None)
+        volume  = getattr(args, 'volume', None)
+        if not self.__writes(args):
+            # workers of carver open image again from this source
+            self.source = (args.file, backend, False, overlay, volume)
+            return open_image(*self.source)
+
+        if overlay:
+            self.target = f'overlay `{overlay}`'
+            return open_image(args.file, backend, writable=True, overlay=overlay, volume=volume)
+
+        if getattr(args, 'in_place', False):
+            self.target = f'`{args.file}`'
+            return open_image(args.file, backend, writable=True, volume=volume)
+
+        # keep original image untouched, patch its copy
+        self.target = '`edited_fat.img`'
+        return open_image(clone_image(args.file, 'edited_fat.img'), backend, writable=True, volume=volume)
+
+    @stats.timed('index')
+    def __open_index(self, path: str, boot: bytes) -> None:
+        """
+        Use sidecar index of metadata, rebuild it when image was changed.
+        Whole FAT is read and hashed only when quick check fails.
+        """
+        stat = os.stat(self.image.filename)
+        sample = MetadataIndex.fingerprint(boot + self.__fsinfo(), self.__fat_samples())
+        index = MetadataIndex(path)
+
+        if not index.is_fresh(stat.st_size, stat.st_mtime_ns, sample):
+            fingerprint = MetadataIndex.fingerprint(boot, self.image.read(self.f_fat_table, self.fat_size))
+            if index.same_content(fingerprint):
+                index.touch(stat.st_size, stat.st_mtime_ns, sample)
+            else:
+                table = self.decode_fat()
+                index.rebuild(stat.st_size, stat.st_mtime_ns, sample, fingerprint,
+                              table, self.free_space().bitmap, self.__walk_dirs())
+
+        self.index = index
+
+    def __fsinfo(self) -> bytes:
+        """FSInfo sector of FAT32 with count of free clusters, it changes with every write"""
+
+        if self.fs_type != 'FAT32':
+            return b''
+        sector = int.from_bytes(self.image.read(0x30, 2), 'little')
+        if not 0 < sector < self.reserved_sectors:
+            return b''
+        return self.image.read(sector * self.sector_size, self.sector_size)
+
+    def __fat_samples(self) -> bytes:
+        """Sectors of first FAT spread evenly over it, the first and the last one too"""
+
+        sectors = self.fat_size // self.sector_size
+        picked = sorted({i * (sectors - 1) // (FAT_SAMPLES - 1) for i in range(FAT_SAMPLES)}) if sectors else []
+        return b''.join(self.image.read(self.f_fat_table + x * self.sector_size, self.sector_size) for x in picked)
+
+    def __walk_dirs(self):
+        """Parse every directory of volume, yields (cluster, entries)"""
+
+        queue = [0]
+        seen = {0}
+        while queue:
+            cluster = queue.pop()
+            entries = self.__parse_dir(cluster)
+            yield cluster, entries
+
+            for el in entries:
+                if el.type == 'd' and el.elements is None and el.cluster not in seen:
+                    seen.add(el.cluster)
+                    queue.append(el.cluster)
+
+    def info(self) -> dict:
+        """Parameters of file system for json output"""
+
+        return {
+            'fs_type': self.fs_type,
+            'oem': self.oem,
+            'sector_size': self.sector_size,
+            'cluster_size': self.cluster_size,
+            'reserved_sectors': self.reserved_sectors,
+            'number_of_fat': self.number_of_fat,
+            'root_entries': self.number_of_root,
+            'fat_size': self.fat_size,
+            'fat1_addr': self.f_fat_table,
+            'fat2_addr': self.s_fat_table,
+            'root_addr': self.root_addr,
+            'data_addr': self.data_addr,
+            'clusters': self.clusters_count,
+            'free_clusters': self.free_clusters(),
+        }
 
     def print_info(self) -> None:
+        if self.json:
+            print(json.dumps(self.info()))
+            return
+
         info =   'Информация о файловой системе\n\n'
         info += f'Имя OEM: {self.oem}\n'
         info += f'Размер сектора: {hex(self.sector_size)}\n'
@@ -57,39 +204,178 @@ class FAT(object):
         info += f'Адрес таблицы FAT1: {hex(self.f_fat_table)}\n'
         info += f'Адрес таблицы FAT2: {hex(self.s_fat_table)}\n'
         info += f'Адрес корневой директории: {hex(self.root_addr)}\n'
-        info += f'Адрес начала данных: {hex(self.data_addr)}'
+        info += f'Адрес начала данных: {hex(self.data_addr)}\n'
+        info += f'Количество кластеров: {hex(self.clusters_count)}\n'
+        info += f'Свободных кластеров: {hex(self.free_clusters())}'
 
         print(info)
+
+    def __count_clusters(self, data: bytes) -> int:
+        """Count clusters in data region, it defines type of FAT"""
+
+        total_sectors = int.from_bytes(data[0x13:0x15], 'little')
+        if total_sectors == 0:
+            total_sectors = int.from_bytes(data[0x20:0x24], 'little')
+
+        data_sectors = total_sectors - self.data_addr // self.sector_size
+        return max(data_sectors * self.sector_size // self.cluster_size, 0)
+
+    def __detect_fs_type(self) -> str:
+        """
+        http://elm-chan.org/docs/fat_e.html#fat_determination
+        """
+        if self.root_cluster:
+            return 'FAT32'
+        if self.clusters_count < 4085:
+            return 'FAT12'
+        if self.clusters_count < 65525:
+            return 'FAT16'
+        return 'FAT32'
+
+    def decode_fat(self) -> array:
+        """Decode first FAT once into array of next clusters"""
+
+        if self.next_cluster is not None:
+            return self.next_cluster
+
+        if self.index is not None:
+            self.next_cluster = self.index.load_fat()
+            return self.next_cluster
+
+        self.next_cluster = self.decode_table()
+        return self.next_cluster
+
+    @stats.timed('fat_decode')
+    def decode_table(self, addr: int = None) -> array:
+        """Read FAT at addr (default: first FAT) and unpack its entries"""
+
+        entries = self.clusters_count + 2
+        raw = self.image.read(self.f_fat_table if addr is None else addr, self.fat_size)
+
+        if self.fs_type == 'FAT12':
+            raw = raw[:(entries + 1) // 2 * 3].ljust((entries + 1) // 2 * 3, b'\x00')
+            b0, b1, b2 = raw[0::3], raw[1::3], raw[2::3]
+
+            # every 3 bytes hold two entries, spread them to 2+2 bytes
+            odd_low = int.from_bytes(b1.translate(HIGH_NIBBLE), 'little') | \
+                      int.from_bytes(b2.translate(LOW_NIBBLE_SHL), 'little')
+            packed = bytearray(len(b0) * 4)
+            packed[0::4] = b0
+            packed[1::4] = b1.translate(LOW_NIBBLE)
+            packed[2::4] = odd_low.to_bytes(len(b1), 'little')
+            packed[3::4] = b2.translate(HIGH_NIBBLE)
+
+            table = array('H')
+            table.frombytes(bytes(packed))
+        elif self.fs_type == 'FAT16':
+            table = array('H')
+            table.frombytes(raw[:entries * 2])
+        else:
+            table = array('I')
+            table.frombytes(raw[:entries * 4])
+
+        if sys.byteorder == 'big':
+            table.byteswap()
+
+        del table[entries:]
+
+        # high 4 bits of FAT32 entry are reserved
+        if self.fs_type == 'FAT32' and len(table) and max(table) > 0x0FFFFFFF:
+            table = array('I', [x & 0x0FFFFFFF for x in table])
+
+        return table
+
+    def free_clusters(self) -> int:
+        """Count free clusters in first FAT"""
+
+        return self.decode_fat()[2:].count(0)
+
+    def chain(self, cluster: int) -> list:
+        """Follow cluster chain from first cluster until end of chain"""
+
+        table = self.decode_fat()
+        clusters = []
+
+        # chain longer than table means loop in FAT
+        while 2 <= cluster < min(len(table), self.bad_cluster) and len(clusters) < len(table):
+            clusters.append(cluster)
+            cluster = table[cluster]
+
+        stats.count('clusters_followed', len(clusters))
+        return clusters
     
     def print_catalogs(self) -> None:
         """List specified catalog"""
-        path = [x for x in self.catalog.split('/') if x]
+        self.init_entities()
+        entity = self.resolve(self.catalog)
+
+        if self.ndjson:
+            self.print_records(entity)
+            return
 
         if self.json:
-            print(json.dumps(self.files))
-            exit(0)
+            if entity is None:
+                print('[!] File or dir not exist')
+                exit(0)
+            if type(entity) == Entry and entity.type != 'd':
+                print(json.dumps(entity.to_dict()))
+                return
+            entity = self.files if type(entity) == list else self.get_elements(entity)
+            self.__load_all(entity)
+            print(json.dumps([el.to_dict() for el in entity]))
+            return
+
+        self.__print_entity(entity)
+        return
+
+    def resolve(self, path: str, show_deleted: bool = None):
+        """
+        Find entity by full path with dict lookup per path component.
+        Long and 8.3 names are accepted, case is ignored as in FAT.
+        Only directories on the path are parsed. Deleted entries are in
+        parsed directories anyway, show_deleted is taken as for NTFS.
+        """
+        self.init_entities()
 
-        if len(path) == 0:
-            self.__print_entity(self.files)
-            exit(0)
-        else:
-            entity = self.__find_entity_by_path(path, self.files)
-            self.__print_entity(entity)
-            exit(0)
+        canonical = ''
+        entities = self.files
+        entity = self.files
+        for part in [x for x in path.split('/') if x]:
+            if entities is None:
+                return None
+            if canonical not in self.registered:
+                self.__register(entities, canonical)
+
+            entity = self.paths.get(canonical + '/' + part.casefold())
+            if entity is None:
+                return None
+
+            canonical += '/' + entity.name.casefold()
+            entities = self.get_elements(entity) if entity.type == 'd' else None
+
+        return entity
 
-    def __find_entity_by_path(self, path: list, entities: dict):
-        """Internal function for recursive find entity in self.files dict"""
+    def resolve_many(self, paths: list) -> dict:
+        """Resolve paths in bulk, directories shared by paths are parsed once"""
+
+        return {path: self.resolve(path) for path in paths}
+
+    def __register(self, entities: list, canonical: str) -> None:
+        """Add long and 8.3 names of directory entries to path index"""
 
         for entity in entities:
-            if entity['Name'] == path[0]:
-                if entity['Name'] == path[0]:
-                    path.pop(0)
+            if entity.name == '.' or entity.name == '..':
+                continue
+
+            for name in (entity.name, entity.short_name):
+                key = canonical + '/' + name.casefold()
+                # live entry wins over deleted one with same name
+                if key not in self.paths or self.paths[key].deleted:
+                    self.paths[key] = entity
+
+        self.registered.add(canonical)
 
-                    if len(path) == 0:
-                        return entity
 
-                    return self.__find_entity_by_path(path, entity['Elements'])
-    
     def __print_entity(self, entity) -> None:
         """Just print specified catalog or entity"""
         if entity is None:
@@ -98,484 +384,355 @@ class FAT(object):
 
         if not self.extract:
             print('Listing:', self.catalog, end='\n\n')
-        if type(entity) == dict:
-            try:
-                if entity['Type'] == 'f':
-                    self.__extract_entity(entity)
-                    exit(0)
-            except TypeError:
-                print('[!] File not exist')
-                exit(0)
+        elif type(entity) == list or entity.type == 'd':
+            self.extract_directory(entity)
+            return
 
-            try:
-                if entity['Type'] == 'd':
-                    entity = entity['Elements']
-            except TypeError:
-                print('[!] Directory not exists!')
-                exit(0)
+        if type(entity) == Entry:
+            if entity.type == 'd':
+                entity = self.get_elements(entity)
+            else:
+                self.__extract_entity(entity)
+                return
 
         for el in entity:
-            directory = ''
-            isdeleted = ''
-
-            if el['isDeleted']:
-                if not self.show_deleted:
-                    continue
-                isdeleted = ' (File deleted)'
-
-            if el['Type'] == 'd':
-                directory = '/'
-            info  = f"{el['Type']} {el['CreateTime']} {el['Name']}{directory} ({el['8DOT3Name']}) Cluster:{el['Cluster']} Size:{el['Size']}{isdeleted}"
-            print(info)
-    
-    def __extract_entity(self, entity) -> None:
-        clusters = [int(entity['Cluster'], 16)]
+            if el.deleted and not self.show_deleted:
+                continue
 
-        # Parse fat record
-        counter = clusters[0]
-        val = counter
-        N = clusters[0]
+            print(self.format_entity(el))
 
-        if self.fs_type == 'FAT16':
-            while val != 0xFFFF:
-                val = int.from_bytes(self.data[self.f_fat_table + counter*2:self.f_fat_table+(counter+1)*2], 'little') & 0xFFFF
-                counter += 1
-                clusters.append(val)
-
-                # For deleted files restore just one sector
-                # TODO: think about that
-                if entity['isDeleted'] == True:
-                    break
-
-                if len(clusters) < int(entity['Size']) / self.cluster_size and val == 0xFFFF:
-                    clusters.pop()
-                    val = 0
-        elif self.fs_type == 'FAT12':
-            self.__get_fat12_clusters()
-            clusters = self.fat12_clusters
-            clusters = clusters[N:]
-            clusters.insert(0, N)
-
-        # Remove 0xFFFF in end of sectors list
-        clusters.pop()
-        file_data = b''
-
-        # Read entity
-        remaing_data = int(entity['Size'])
-        for cluster in clusters:
-            # for fat12
-            if cluster == 0xfff:
-                continue
+    def clusters_of(self, entity: Entry) -> list:
+        """Chain of live entity, guessed contiguous clusters of deleted one"""
 
-            f_addr = self.data_addr + self.cluster_size * (cluster - 2)
+        if not entity.deleted:
+            return self.chain(entity.cluster)
 
-            if remaing_data > self.cluster_size:
-                s_addr = f_addr + self.cluster_size
-            else:
-                s_addr = f_addr + remaing_data
-
-            remaing_data -= self.cluster_size
-            file_data += self.data[f_addr : s_addr]
-        
-        if len(file_data) > 1024 or self.extract:
-            if not os.path.exists('extracted/'):
-                os.mkdir('extracted')
-            with open('extracted/'+entity['Name'], 'wb') as f:
-                f.write(file_data)
-
-            print(f'File {entity["Name"]} was save in extracted/')
-        else:
-            print(file_data)
-
-    def __parse_dir(self, start_addr: int, subdir: bool) -> None:
-        BS = 32
-        entry = []
-        RA = start_addr
-        i = 0
-        deletedfile = b''
-
-        # Read root catalog
-        while True:
-            count = self.data[RA+BS*i]
-
-            if count == 0xE5:
-                deletedfile += self.data[RA + BS*i: RA + BS*(i+1)]
-                i += 1
-                continue
-            
-            if deletedfile != b'':
-                entry.append(deletedfile)
-                deletedfile = b''
+        count = max(ceil(entity.size / self.cluster_size), 1)
+        return recover_clusters(entity.cluster, count, self.free_space().bitmap)
 
-            if count == 0x2E:
-                # hidden dir
-                pass
+    @stats.timed('extract')
+    def __extract_entity(self, entity) -> None:
+        clusters = self.clusters_of(entity)
+        if entity.deleted and not clusters:
+            print('[!] Clusters of deleted file are in use, data is overwritten')
+            exit(0)
 
-            if count == 0:
-                break
+        # Read entity by contiguous runs of clusters
+        size = entity.size
+        ranges = self.byte_ranges(clusters, size)
+        if sum(length for _, length in ranges) < size:
+            print(f'[!] Chain of {entity.name} is shorter than its size, check volume with --check')
 
-            if count > 0x40:
-                # file with 0x41, 0x42 and others bytes
-                entry.append(self.data[RA + BS*i: RA + BS*(i+count-0x3F)])
-                i += (count - 0x3F)
-            else:
-                entry.append(self.data[RA + BS*i: RA + BS*(i+1)])
-                i += 1
+        if size > 1024 or self.extract:
+            os.makedirs(self.output, exist_ok=True)
+            with open(os.path.join(self.output, self.safe_name(entity.name)), 'wb') as f:
+                for addr, length in ranges:
+                    self.image.copy_to(f.fileno(), addr, length)
 
-        self.__parse_file_entinity(entry, subdir)
+            print(f'File {entity.name} was save in {self.output}/')
+        else:
+            print(b''.join(self.image.read(addr, length) for addr, length in ranges))
 
-    def __parse_file_entinity(self, entry : list, subdir: bool) -> None:
-        for el in entry:
-            long_name  = ''
-            is_deleted = False
+    @stats.timed('carve')
+    def carve_files(self) -> None:
+        """Carve files by signatures from unallocated clusters to extracted/carved/"""
 
-            if el[0] == 0xE5:
-                is_deleted = True
+        runs = sorted((start, length) for start, length in self.free_space().length.items())
+        files = carve(self.source, self.data_addr, self.cluster_size, runs, self.workers)
 
-            filetype  = self.__get_type(el)
-            time      = self.__get_time(el)
-            shortname = self.__get_name(el)
-            size      = self.__get_size(el)
-            cluster   = self.__get_cluster(el)
+        prefix = os.path.join(self.output, 'carved')
+        os.makedirs(prefix, exist_ok=True)
+        for addr, length, ext in files:
+            path = os.path.join(prefix, f'{addr:010x}.{ext}')
+            with open(path, 'wb') as f:
+                self.image.copy_to(f.fileno(), addr, length)
+            print(f'{path} Size:{length}')
 
-            if len(el)//32 == 1:
-                long_name = shortname.lower()
-            else:
-                long_name = self.__get_long_name(el)
-            
-            parent_obj = {
-                "Type": filetype,
-                "8DOT3Name": shortname,
-                'Name' : long_name,
-                'Size' : size,
-                'CreateTime' : time,
-                'Cluster' : cluster,
-                'isDeleted' : is_deleted
-            }
-
-            if filetype == 'd':
-                parent_obj.update({'Elements': []})
-                if not subdir:
-                    self.files.append(parent_obj)
-                else:
-                    self.tmp.append(parent_obj)
-            else:
-                if not subdir:
-                    self.files.append(parent_obj)
-                else:
-                    self.tmp.append(parent_obj)
-
-    def __init_entities(self) -> None:
-        """Init all entities in file system to json dict, for nice work"""
-
-        # parse root directory
-        self.__parse_dir(self.root_addr, False)
-
-        def recursive_parse_dir(entity: dict):
-            for element in entity:
-                if element.get('Elements') == []:
-                    if element['Name'] == '.' or element['Name'] == '..':
-                        continue
-
-                    self.__parse_dir(self.data_addr + self.cluster_size * (int(element['Cluster'], 16) - 2), True)
-                    element.update({
-                        'Elements': self.tmp
-                    })
-                    self.tmp = []
-                    recursive_parse_dir(element['Elements'])
-            return entity
-            
-        # parse others directory
-        self.files = recursive_parse_dir(self.files)
-        
-    def __get_cluster(self, file) -> str:
-        """Extract data cluster from file"""
-
-        return hex(int.from_bytes(file[-6:-4], 'little'))
-
-    def __get_name(self, file) -> str:
-        """Extract file name"""
-
-        name = file[-32:-21]
-        # remove non printable characher
-        fpart = ''.join(list(filter(lambda x: x in printable, name[:8].rstrip().decode(errors='ignore'))))
-        lpart = ''.join(list(filter(lambda x: x in printable, name[8:].rstrip().decode(errors='ignore'))))
-        if not len(lpart):
-            return fpart
-        else:
-            return fpart + '.' + lpart
+        print(f'Carved {len(files)} files from {self.free_space().free_count()} free clusters')
 
-    def __get_long_name(self, file) -> str:
-        """Extract long file name"""
+    def extent_map(self) -> ExtentMap:
+        """Extents of all chains, built once from decoded FAT"""
 
-        BS = 32
-        bits = [1, 3, 5, 7, 9, 14, 16, 18, 20, 22, 24, 28, 30]
-        name = b''
-        blocks = [file[i*BS:BS*(i+1)] for i in range(len(file)//BS)]
-        for el in blocks[::-1][1:]:
-            for bit in bits:
-                name += bytes([el[bit]])
+        if self.layout is None:
+            self.layout = ExtentMap(self.decode_fat(), self.bad_cluster, self.free_space().bitmap)
+        return self.layout
 
-        return name.replace(b'\xff',b'').replace(b'\x00', b'').decode()
+    def walk_paths(self, entities: list, prefix: str, seen: set = None):
+        """Yield (path, entity) for every entity below directory"""
 
-    def __get_time(self, file) -> str:
-        """Extract time from file"""
+        seen = seen if seen is not None else set()
+        for el in entities:
+            if el.name in ('.', '..') or el.type == '?':
+                continue
+            if el.deleted and not self.show_deleted:
+                continue
 
-        date_creation = int.from_bytes(file[-16:-14], 'little')
+            path = f'{prefix}/{el.name}'
+            yield path, el
 
-        day   = str(date_creation & 0x1f)
-        month = str((date_creation>>5) & 0x0f)
-        year  = str(1980 + (date_creation >> 9))
+            if el.type == 'd' and not el.deleted and el.cluster not in seen:
+                seen.add(el.cluster)
+                yield from self.walk_paths(self.get_elements(el), path, seen)
 
-        return day + '-' + month + '-' + year
-    
-    def __get_type(self, file) -> str:
-        """Detect type of file"""
-
-        attr =  file[-21]
-        if attr == self.DIR_ATTRIBUTE:
-            return 'd'
-        elif attr == self.FILE_ATTRIBUTE:
-            return 'f'
+    def print_hashes(self, algorithms: list) -> None:
+        """Manifest of digests of every file below path, chains are streamed into hash functions"""
+
+        self.init_entities()
+        entity = self.resolve(self.catalog or '/')
+        if entity is None:
+            print('[!] File or dir not exist')
+            exit(0)
+
+        path = '/' + '/'.join(x for x in (self.catalog or '').split('/') if x)
+        if type(entity) == list:
+            entries = self.walk_paths(entity, '')
+        elif entity.type == 'd':
+            entries = self.walk_paths(self.get_elements(entity), path)
         else:
-            return '?'
-    
-    def __get_size(self, file) -> str:
-    
-        """Extract file size"""
+            entries = [(path, entity)]
 
-        size = int.from_bytes(file[-4:-1], 'little')
-        return str(size)
-    
-    def write_file(self) -> None:
+        jobs = [self.__hash_job(path, el) for path, el in entries if el.type != 'd']
+        fmt = 'ndjson' if self.ndjson else 'json' if self.json else 'csv'
+        print_inventory(self.image, jobs, algorithms, self.workers, fmt)
+        return
+
+    def __hash_job(self, path: str, el: Entry) -> tuple:
+        """(record, resident value, ranges) of file for hashing"""
+
+        value, ranges, error = self.data_stream(el)
+        record = {'path': path, 'size': el.size, 'deleted': el.deleted, 'error': error}
+        return record, value, ranges
+
+    def data_stream(self, el: Entry) -> tuple:
+        """(resident value, ranges, error) of file data, same shape as for NTFS"""
+
+        ranges = self.byte_ranges(self.clusters_of(el), el.size) if el.cluster else []
+        if sum(length for _, length in ranges) < el.size:
+            return None, ranges, 'data is overwritten' if el.deleted else 'chain shorter than size'
+        return None, ranges, None
+
+    def listing(self, path: str, show_deleted: bool = None) -> list:
         """
-        http://elm-chan.org/docs/fat_e.html#fat_determination
+        Records of directory children or of file itself, None when path not exist.
+        show_deleted overrides -d for one call, fs shared by threads is not changed.
         """
-        self.file_entity = {
-            "Type": "f",
-            "8DOT3Name": "",
-            'Name' : "",
-            'Size' : 0,
-            'CreateTime' : "",
-            'Cluster' : "",
-            'isDeleted' : False
-        }
+        show_deleted = self.show_deleted if show_deleted is None else show_deleted
+        entity = self.resolve(path)
+        if entity is None:
+            return None
 
-        fname = pathlib.Path(self.file_for_write)
-        if not fname.exists():
-            print('[!] File for write in FAT not exists')
-            exit(0)
-        
-        # get base info about file
-        fstat = fname.stat()
-        # filename
-        filename = fname.parts[-1]
-        if len(filename) > 8:
-            short_name = (filename[:6] + '~1' + fname.suffix[1:4].ljust(3, ' ')).upper()
+        prefix = '/' + '/'.join(x for x in path.split('/') if x)
+        if type(entity) == list:
+            prefix = ''
+        elif entity.type == 'd':
+            entity = self.get_elements(entity)
         else:
-            short_name = filename.upper().ljust(8, ' ')
-
-        # file size
-        size = fstat.st_size
-        # fat_time 
-        modification_time = self.__convert_date_to_fat(datetime.fromtimestamp(fstat.st_mtime))
-        last_access = self.__convert_date_to_fat(datetime.fromtimestamp(fstat.st_atime))
-        status_change = self.__convert_date_to_fat(datetime.fromtimestamp(fstat.st_ctime))
-
-        self.file_entity.update({
-            "8DOT3Name": short_name,
-            'Name': filename,
-            'Size' : size,
-            'ModificationTime' : modification_time,
-            'LastAccessTime' : last_access,
-            'StatusChangeTime' : status_change
-        })
+            return [entity.to_record(prefix)]
 
-        """
-        need get free cluster, if filesize > 0x800 than allocate new clasters in fat table
-        else put in fat 0xffff
-        """
-        # craft fat table
-        cluster = self.__edit_fat_tables()
-        self.file_entity.update({'Cluster': hex(cluster)})
+        return [el.to_record(f'{prefix}/{el.name}') for el in entity
+                if el.name not in ('.', '..') and (show_deleted or not el.deleted)]
 
-        self.__craft_record(cluster)
+    def extents(self, clusters: list) -> list:
+        """Coalesce cluster list into (first cluster, count) runs"""
 
-        # make record in some sectors
+        runs = []
+        for cluster in clusters:
+            if runs and runs[-1][0] + runs[-1][1] == cluster:
+                runs[-1][1] += 1
+            else:
+                runs.append([cluster, 1])
 
-    def __craft_record(self, cluster: int) -> None:
-        bits = [1, 3, 5, 7, 9, 14, 16, 18, 20, 22, 24, 28, 30]
-        count_records = ceil(len(self.file_entity['Name']) / 15)
+        return [tuple(run) for run in runs]
 
-        # template
-        template = [0x43,0x74,0x00,0x00,0x00,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0x0F,0x00,0xB0,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0xFF,0x00,0x00,0xFF,0xFF,0xFF,0xFF]
-        tmp = []
-        lfn_sum = self.__create_sum(self.file_entity['8DOT3Name'])
+    def byte_ranges(self, clusters: list, size: int) -> list:
+        """Convert clusters of file to (address, length) ranges cut by file size"""
 
-        # craft template for long name
-        k = 0
-        for i in range(1, count_records + 1):
-            if i == count_records:
-                template[0] = 0x40 + i
-            else:
-                template[0] = i
-
-            template[13] = lfn_sum
-
-            for j, bit in enumerate(bits):
-                string = self.file_entity['Name']
-                if k >= len(string):
-                    template[bit] = 0xFF
-                else:
-                    template[bit] = ord(string[k])
-                k += 1
-
-            tmp.append(b''.join([bytes([x]) for x in template]))
-        
-        out = b''.join(tmp[::-1])
-
-        # init template for short name
-        out += self.file_entity['8DOT3Name'].encode()   #name
-        out += bytes([self.FILE_ATTRIBUTE])             #file attr
-        out += b'\x00'                                  #reserved byte
-        out += b'\x64'                                  #crt_time_tenth optional
-        out += int.to_bytes(self.file_entity['ModificationTime'], 2, 'little')
-        out += int.to_bytes(self.file_entity['StatusChangeTime'], 2, 'little')
-        out += int.to_bytes(self.file_entity['LastAccessTime'], 2, 'little')
-        out += b'\x00\x00'
-        out += int.to_bytes(self.file_entity['ModificationTime'], 2, 'little')
-        out += int.to_bytes(self.file_entity['ModificationTime'], 2, 'little')
-        out += int.to_bytes(cluster, 2, 'little')
-        out += int.to_bytes(self.file_entity['Size'], 4, 'little')
-
-        BS = 32
-        i = 0
-        record = -1
-        while record != 0x00:
-            record = self.data[self.root_addr + BS*i]
-            i += 1
-
-        i -= 1        
-
-        data = list(self.data)
-
-        # create records in root dir
-        for j, el in enumerate(out):
-            data[self.root_addr + BS*i + j] = out[j]
-        
-        with open(self.file_for_write, 'rb') as f:
-            file_data = f.read()
-        
-        for i, el in enumerate(file_data):
-            data[self.data_addr + (cluster - 2)*self.cluster_size + i] = file_data[i]
-
-        self.data = bytes(data)
-        with open('edited_fat.img', 'wb') as f:
-            f.write(self.data)
-
-        print('File was write in `edited_fat.img`')
-
-    def __create_sum(self, name) -> int:
-        s = 0
-        for el in name:
-            s = ((s >> 1) + (s << 7) + ord(el) ) % 0x100
-        return s
-
-    def __edit_fat_tables(self) -> int:
-        fat = self.data[self.f_fat_table: self.f_fat_table + self.fat_size]
+        ranges = []
+        for cluster, count in self.extents(clusters):
+            if size <= 0:
+                break
+            length = min(count * self.cluster_size, size)
+            ranges.append((self.data_addr + self.cluster_size * (cluster - 2), length))
+            size -= length
+
+        return ranges
+
+    def read_dir(self, cluster: int) -> bytes:
+        """Read directory table by its cluster chain until end marker"""
+
+        if cluster == 0:
+            if self.fs_type != 'FAT32':
+                return self.image.read(self.root_addr, self.number_of_root * 0x20)
+            cluster = self.root_cluster
+
+        chunks = []
+        for cluster in self.chain(cluster):
+            chunk = self.image.read(self.data_addr + self.cluster_size * (cluster - 2), self.cluster_size)
+            chunks.append(chunk)
+            # stop on first free entry in cluster
+            if 0 in chunk[::0x20]:
+                break
 
-        if self.fs_type == 'FAT16':
-            new_record = fat.rindex(b'\xff\xff') + 2
-
-            free_cluster = new_record // 0x2 + 1
-            if self.file_entity['Size'] > self.cluster_size:
-                clusters = int.to_bytes(free_cluster, 2, 'little')
-                for i in range(free_cluster, free_cluster + self.file_entity['Size'] // self.cluster_size):
-                    clusters += int.to_bytes(i, 2, 'little')
-                clusters += b'\xff\xff'
-            else:
-                clusters = b'\xff\xff'
+        return b''.join(chunks)
 
-            data = list(self.data)
+    @stats.timed('dir_parse')
+    def __parse_dir(self, cluster: int) -> list:
+        """Parse directory table in one batch, cluster 0 means root directory"""
 
-            for i in range(len(clusters)):
-                data[self.f_fat_table + new_record + i] = clusters[i]
-                data[self.s_fat_table + new_record + i] = clusters[i]
+        data = self.read_dir(cluster)
+        data = data[:len(data) - len(data) % 0x20]
+        entities = []
+        lfn = []
+        lfn_entries = 0
 
-            self.data = bytes(data)
-            return free_cluster - 1
+        # same records seen as short entries and as LFN entries
+        for short, long in zip(DIR_ENTRY.iter_unpack(data), LFN_ENTRY.iter_unpack(data)):
+            name, attr, _, _, ctime, cdate, adate, high, mtime, mdate, low, size = short
+            if name[0] == 0:
+                break
 
-        elif self.fs_type == 'FAT12':
-            print('[!] I can\'t write in FAT12')
-            exit(0)
+            if attr & 0x3F == LFN_ATTRIBUTE:
+                # parts are stored from last to first one
+                if long[0] & 0x40 and long[0] != 0xE5:
+                    lfn = []
+                lfn.append(long)
+                lfn_entries += 1
+                continue
 
-            self.__get_fat12_clusters()
-            free_cluster = len(self.fat12_clusters) + 1
+            deleted = name[0] == 0xE5
+            long_name = self.__get_long_name(lfn, name, deleted)
+            lfn = []
+
+            shortname = self.__get_name(name)
+            if self.fs_type != 'FAT32':
+                high = 0
+
+            # subdirectory is parsed on first access, see get_elements
+            entities.append(Entry(
+                attr       = attr,
+                name       = long_name or shortname.lower(),
+                short_name = shortname,
+                size       = size,
+                cluster    = high << 16 | low,
+                created    = cdate << 16 | ctime,
+                modified   = mdate << 16 | mtime,
+                accessed   = adate << 16,
+                deleted    = deleted
+            ))
+
+        stats.count('dirs_parsed')
+        stats.count('entries', len(entities))
+        stats.count('lfn_entries', lfn_entries)
+        return entities
+
+    def init_entities(self) -> None:
+        """Init root entities, subdirectories are parsed lazily"""
+
+        if self.files is None:
+            self.files = self.load_dir(0)
+
+    def get_elements(self, entity: Entry) -> list:
+        """Return children of directory, parse it on first access"""
+
+        if entity.elements is None:
+            entity.elements = self.load_dir(entity.cluster)
+        return entity.elements
+
+    def children(self, directory) -> list:
+        """Entries of directory, parsed one is taken from tree, others are not kept"""
+
+        if type(directory) == list:
+            return directory
+        if directory.elements is not None:
+            return directory.elements
+        return self.load_dir(directory.cluster) if directory.cluster else []
+
+    def load_dir(self, cluster: int) -> list:
+        """Take directory from index when it is opened, else parse it"""
+
+        if self.index is not None:
+            entries = self.index.load_dir(cluster)
+            if entries is not None:
+                return entries
+        return self.__parse_dir(cluster)
+
+    def __load_all(self, entities: list) -> None:
+        """Parse all directories below entities, needed for full json dump"""
 
-            try:
-                index = fat.rfind(b'\x0f\xff')
-            except ValueError:
-                index = fat.rfind(b'\xf0\xff')
+        for entity in entities:
+            if entity.type == 'd':
+                self.__load_all(self.get_elements(entity))
 
-            print(list(map(hex, self.fat12_clusters)))
-            clusters = b''
-            if self.file_entity['Size'] > self.cluster_size:
-                for i in range(free_cluster, free_cluster + self.file_entity['Size'] // self.cluster_size):
-                    clusters += int.to_bytes(i, 2, 'little')
-                clusters += b'\xff\xff\x0f'
-            else:
-                clusters = b'\xff\x0f'
-            exit(0)
-            data = list(self.data)
-
-            for i in range(len(clusters)):
-                data[self.f_fat_table + new_record + i] = clusters[i]
-                data[self.s_fat_table + new_record + i] = clusters[i]
-            
-            free_cluster += 1
-            self.data = bytes(data)
-            return free_cluster
-
-        elif self.fs_type == 'FAT32':
-            print('not realized')
-            exit(0)
-            return -1
+    def __get_name(self, name: bytes) -> str:
+        """Make 8.3 name from 11 bytes of entry"""
+
+        # remove non printable characher
+        fpart = name[:8].rstrip().translate(None, NOT_PRINTABLE).decode()
+        lpart = name[8:].rstrip().translate(None, NOT_PRINTABLE).decode()
+        if not len(lpart):
+            return fpart
+        else:
+            return fpart + '.' + lpart
 
-    def __create_folder_entry(self) -> None:
+    def __get_long_name(self, parts: list, name: bytes, deleted: bool) -> str:
         """
+        Join LFN parts of entry, empty name means no valid LFN.
+        Parts must have checksum of short name and go in order N..1,
+        for deleted entries first byte is lost, so only checksums of
+        parts are compared with each other.
         """
-        pass
-
-    # Fix this time isn't correct
-    def __convert_date_to_fat(self, objdate) -> int:
-        num = ((objdate.year - 80) << 25) % 0x10000 | \
-              ((objdate.month + 1) << 21)% 0x10000 | \
-              (objdate.day << 16)% 0x10000 |       \
-              (objdate.hour << 11)% 0x10000 |      \
-              (objdate.minute << 5)% 0x10000 |     \
-              (objdate.second >> 1)% 0x10000
-        return num
-
-    def __get_fat12_clusters(self) -> None:
-        counter = 0
-        cluster_1 = -1
-        cluster_2 = -1
-        clusters = []
-        while cluster_1 != 0x0 and cluster_2 != 0:
-            # grab three bytes
-            bits = self.data[self.f_fat_table + counter: self.f_fat_table + counter+3]
-            byte1 = bits[0]
-            byte2 = bits[1]
-            byte3 = bits[2]
+        if not parts:
+            return ''
+
+        if deleted:
+            if len(set(part[4] for part in parts)) != 1:
+                return ''
+        else:
+            checksum = lfn_checksum(name)
+            count = parts[0][0] & 0x3F
+            if len(parts) != count or any(part[4] != checksum or part[0] & 0x3F != count - i
+                                          for i, part in enumerate(parts)):
+                return ''
 
-            cluster_1 = ((bits[1] & 0x0f) << 8) | bits[0] & 0xff
-            cluster_2 = ((bits[2] & 0xff) << 4) |  ( bits[1] & 0xf0 ) >> 4
+        raw = b''.join(part[1] + part[5] + part[7] for part in reversed(parts))
+        return raw.decode('utf-16-le', errors='replace').split('\x00')[0].replace('\uffff', '')
 
-            clusters.append(cluster_1)
-            clusters.append(cluster_2)
+    def free_space(self) -> FreeSpace:
+        """Index of free clusters, built once from decoded FAT"""
 
-            counter += 3
+        if self.free_index is None:
+            bitmap = self.index.load_free() if self.index is not None else None
+            self.free_index = FreeSpace(self.decode_fat(), bitmap=bitmap)
+        return self.free_index
 
-        clusters.pop()
-        clusters.pop()
-        self.fat12_clusters = clusters
\ No newline at end of file
+    def encode_fat(self, first: int, last: int) -> tuple:
+        """Encode entries first..last of decoded FAT back to (offset, bytes)"""
+
+        table = self.decode_fat()
+
+        if self.fs_type == 'FAT12':
+            # entries are packed by pairs in 3 bytes
+            first -= first % 2
+            last += 1 - last % 2
+            raw = bytearray()
+            for i in range(first, last + 1, 2):
+                a = table[i]
+                b = table[i + 1] if i + 1 < len(table) else 0
+                raw += bytes([a & 0xFF, (a >> 8) | ((b & 0x0F) << 4), b >> 4])
+            return first * 3 // 2, bytes(raw)
+
+        part = table[first:last + 1]
+        if sys.byteorder == 'big':
+            part.byteswap()
+        if self.fs_type == 'FAT16':
+            return first * 2, part.tobytes()
+
+        # keep reserved high bits of FAT32 entries
+        old = array('I')
+        old.frombytes(self.image.read(self.f_fat_table + first * 4, len(part) * 4))
+        if sys.byteorder == 'big':
+            old.byteswap()
+        raw = array('I', [x | (y & 0xF0000000) for x, y in zip(part, old)])
+        if sys.byteorder == 'big':
+            raw.byteswap()
+        return first * 4, raw.tobytes()
@@ -0,0 +1,185 @@
+# Index of free clusters for allocating space in FAT
+import heapq
+from array import array
+from bisect import bisect_left, insort
+
+# zero byte of entry means free cluster
+FREE_FLAG = bytes([1]) + bytes(255)
+
+# runs up to this length are counted in Fenwick tree over lengths, longer runs
+# are kept in sorted list, there are at most free clusters / SMALL_RUNS of them
+SMALL_RUNS = 1 << 16
+
+
+def heap_smallest(heap: list, count: int) -> list:
+    """Count smallest items of heap, only branches leading to them are visited"""
+
+    found = []
+    frontier = [(heap[0], 0)] if heap else []
+    while frontier and len(found) < count:
+        value, i = heapq.heappop(frontier)
+        found.append(value)
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+    return found
+
+
+class FreeSpace(object):
+    """
+    Free clusters of decoded FAT as bitmap plus runs grouped by length.
+    Fenwick tree counts runs of every length, so best fitting run is found,
+    taken and put back in O(log SMALL_RUNS). Starts of runs of one length
+    are heap, run with the lowest start is taken first.
+    """
+
+    def __init__(self, table: array, first: int = 2, bitmap: bytearray = None):
+        self.bitmap   = bitmap if bitmap is not None else self.__build_bitmap(table)
+        self.length   = {}
+        self.starts   = {}
+        self.counts   = array('I', bytes(4 * (SMALL_RUNS + 1)))
+        self.small    = 0
+        self.long     = []
+        self.free     = 0
+
+        # walk runs of free clusters with bytes.find, not cluster by cluster,
+        # starts come in order, so lists of starts are heaps already
+        pos = self.bitmap.find(1, first)
+        while pos != -1:
+            end = self.bitmap.find(0, pos)
+            if end == -1:
+                end = len(self.bitmap)
+            length = end - pos
+            self.length[pos] = length
+            self.free += length
+            if length > SMALL_RUNS:
+                self.long.append((length, pos))
+            else:
+                self.starts.setdefault(length, []).append(pos)
+                self.counts[length] += 1
+                self.small += 1
+            pos = self.bitmap.find(1, end)
+
+        self.long.sort()
+        # Fenwick tree is built from counts in one pass
+        for i in range(1, SMALL_RUNS + 1):
+            j = i + (i & -i)
+            if j <= SMALL_RUNS:
+                self.counts[j] += self.counts[i]
+
+    def __build_bitmap(self, table: array) -> bytearray:
+        """One byte per cluster, 1 for free, 0 for used"""
+
+        raw = table.tobytes()
+        size = table.itemsize
+        used = 0
+        for i in range(size):
+            used |= int.from_bytes(raw[i::size], 'little')
+
+        return bytearray(used.to_bytes(len(table), 'little').translate(FREE_FLAG))
+
+    def __update(self, length: int, delta: int) -> None:
+        self.small += delta
+        while length <= SMALL_RUNS:
+            self.counts[length] += delta
+            length += length & -length
+
+    def __prefix(self, length: int) -> int:
+        """Number of short runs not longer than length"""
+
+        total = 0
+        while length > 0:
+            total += self.counts[length]
+            length -= length & -length
+        return total
+
+    def __kth(self, k: int) -> int:
+        """Length of k-th shortest short run, found by descent over Fenwick tree"""
+
+        pos = 0
+        step = 1 << SMALL_RUNS.bit_length()
+        while step:
+            if pos + step <= SMALL_RUNS and self.counts[pos + step] < k:
+                pos += step
+                k -= self.counts[pos]
+            step >>= 1
+        return pos + 1
+
+    def __add(self, start: int, length: int) -> None:
+        self.length[start] = length
+        self.free += length
+        if length > SMALL_RUNS:
+            insort(self.long, (length, start))
+            return
+        heapq.heappush(self.starts.setdefault(length, []), start)
+        self.__update(length, 1)
+
+    def __take(self, need: int) -> tuple:
+        """
+        (start, length) of the shortest run of at least need clusters,
+        the longest run when there is no such one. Run leaves the index.
+        """
+        length = None
+        if need <= SMALL_RUNS:
+            k = self.__prefix(need - 1) + 1
+            if k <= self.small:
+                length = self.__kth(k)
+        if length is None:
+            i = bisect_left(self.long, (need, 0))
+            if i == len(self.long) and self.long:
+                i = bisect_left(self.long, (self.long[-1][0], 0))
+            if i < len(self.long) or not self.small:
+                length, start = self.long.pop(i)
+                del self.length[start]
+                self.free -= length
+                return start, length
+            length = self.__kth(self.small)
+
+        starts = self.starts[length]
+        start = heapq.heappop(starts)
+        if not starts:
+            del self.starts[length]
+        self.__update(length, -1)
+        del self.length[start]
+        self.free -= length
+        return start, length
+
+    def free_count(self) -> int:
+        return self.free
+
+    def largest(self, count: int = 1) -> list:
+        """
+        Largest free runs as (start, length), runs of one length go from the
+        lowest start. Long runs are sorted, short ones are found from Fenwick tree.
+        """
+        runs = [(start, length) for length, start in sorted(self.long, key=lambda x: (-x[0], x[1]))[:count]]
+        k = self.small
+        while len(runs) < count and k > 0:
+            length = self.__kth(k)
+            starts = self.starts[length]
+            runs.extend((start, length) for start in heap_smallest(starts, count - len(runs)))
+            k -= len(starts)
+        return runs
+
+    def allocate(self, count: int) -> list:
+        """
+        Take count clusters, from one extent when it is possible,
+        else from the biggest extents to keep file less fragmented
+        """
+        if count <= 0:
+            return []
+        if count > self.free:
+            raise ValueError(f'Not enough free clusters: {count} requested')
+
+        clusters = []
+        while len(clusters) < count:
+            need = count - len(clusters)
+            start, length = self.__take(need)
+            take = min(length, need)
+            if take < length:
+                self.__add(start + take, length - take)
+
+            self.bitmap[start:start + take] = bytes(take)
+            clusters.extend(range(start, start + take))
+
+        return clusters
@@ -0,0 +1,318 @@
+# Backends for random access to disk images
+import bisect
+import mmap
+import os
+import struct
+
+
+class Image(object):
+    """Base image backend, subclasses implement read() and write()"""
+
+    # biggest piece moved by one syscall in copy_to
+    COPY_CHUNK = 8 << 20
+
+    def __init__(self, filename: str, writable: bool = False):
+        self.filename    = filename
+        self.writable    = writable
+        self.fd          = os.open(filename, os.O_RDWR if writable else os.O_RDONLY)
+        self.size        = os.lseek(self.fd, 0, os.SEEK_END)
+        self.copy_method = 'copy_file_range'
+
+    def read(self, offset: int, size: int) -> bytes:
+        """Read up to size bytes starting from offset"""
+        raise NotImplementedError
+
+    def write(self, offset: int, data: bytes) -> None:
+        """Patch image in place, only touched bytes are written"""
+        raise OSError(f'Image {self.filename} is opened read-only')
+
+    def flush(self) -> None:
+        if self.writable:
+            os.fsync(self.fd)
+
+    def view(self, offset: int, size: int):
+        """Bytes-like object for range, backends may avoid copy here"""
+        return self.read(offset, size)
+
+    def find(self, sub: bytes, start: int, end: int) -> int:
+        """Offset of first sub in [start, end) or -1, searched by chunks"""
+
+        end = min(end, self.size)
+        pos = start
+        while pos < end:
+            chunk = self.read(pos, min(self.COPY_CHUNK, end - pos))
+            i = chunk.find(sub)
+            if i != -1:
+                return pos + i
+            if pos + len(chunk) >= end:
+                break
+            # overlap chunks to find sub on their border
+            pos += max(len(chunk) - len(sub) + 1, 1)
+        return -1
+
+    def copy_to(self, fd: int, offset: int, size: int) -> int:
+        """Stream range of image to file descriptor, returns copied bytes"""
+
+        size = max(min(size, self.size - offset), 0)
+        done = 0
+        while done < size:
+            n = self.__copy_chunk(fd, offset + done, min(size - done, self.COPY_CHUNK))
+            if n <= 0:
+                break
+            done += n
+        return done
+
+    def __copy_chunk(self, fd: int, offset: int, count: int) -> int:
+        """Copy in kernel when possible, fall back to plain write"""
+
+        if self.copy_method == 'copy_file_range':
+            try:
+                return os.copy_file_range(self.fd, fd, count, offset)
+            except (AttributeError, OSError):
+                self.copy_method = 'sendfile'
+
+        if self.copy_method == 'sendfile':
+            try:
+                return os.sendfile(fd, self.fd, offset, count)
+            except (AttributeError, OSError):
+                self.copy_method = 'write'
+
+        return os.write(fd, self.view(offset, count))
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class PreadImage(Image):
+    """Image read with pread(2), works for pipes-like files where mmap fails"""
+
+    def read(self, offset: int, size: int) -> bytes:
+        if offset >= self.size or size <= 0:
+            return b''
+        return os.pread(self.fd, min(size, self.size - offset), offset)
+
+    def write(self, offset: int, data: bytes) -> None:
+        if not self.writable:
+            super().write(offset, data)
+        if offset + len(data) > self.size:
+            raise OSError(f'Write out of image {self.filename}')
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+
+class MmapImage(Image):
+    """Image mapped read-only in memory, pages are loaded on first touch"""
+
+    def __init__(self, filename: str, writable: bool = False):
+        super().__init__(filename, writable)
+        try:
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # mmap can't map empty files and some special files
+            self.close()
+            raise
+
+    def read(self, offset: int, size: int) -> bytes:
+        if size <= 0:
+            return b''
+        return self.map[offset:offset + size]
+
+    def view(self, offset: int, size: int):
+        return memoryview(self.map)[offset:offset + max(size, 0)]
+
+    def write(self, offset: int, data: bytes) -> None:
+        if not self.writable:
+            super().write(offset, data)
+        if offset + len(data) > self.size:
+            raise OSError(f'Write out of image {self.filename}')
+        self.map[offset:offset + len(data)] = data
+
+    def find(self, sub: bytes, start: int, end: int) -> int:
+        return self.map.find(sub, start, min(end, self.size))
+
+    def flush(self) -> None:
+        if self.writable:
+            self.map.flush()
+
+    def close(self) -> None:
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        super().close()
+
+
+class OverlayImage(Image):
+    """
+    Copy-on-write overlay over other image, base image is never modified.
+    Overlay file is header and records of (block number, block data),
+    records are rewritten in place when block is changed again.
+    """
+
+    MAGIC  = b'FATOVL1\n'
+    BLOCK  = 4096
+    RECORD = struct.Struct('<Q')
+
+    def __init__(self, base: Image, filename: str, writable: bool = False):
+        self.base        = base
+        self.filename    = filename
+        self.writable    = writable
+        self.size        = base.size
+        self.copy_method = 'write'
+        self.blocks      = {}
+        self.sorted      = []
+
+        flags = os.O_RDWR | os.O_CREAT if writable else os.O_RDONLY
+        self.fd = os.open(filename, flags, 0o644)
+        header = os.pread(self.fd, len(self.MAGIC), 0)
+        if header == b'' and writable:
+            os.pwrite(self.fd, self.MAGIC, 0)
+        elif header != self.MAGIC:
+            os.close(self.fd)
+            raise ValueError(f'{filename} is not overlay file')
+
+        # load index of stored blocks
+        step = self.RECORD.size + self.BLOCK
+        end = os.lseek(self.fd, 0, os.SEEK_END)
+        for pos in range(len(self.MAGIC), end - step + 1, step):
+            block, = self.RECORD.unpack(os.pread(self.fd, self.RECORD.size, pos))
+            self.blocks[block] = pos + self.RECORD.size
+        self.sorted = sorted(self.blocks)
+
+    def __read_block(self, block: int) -> bytes:
+        if block in self.blocks:
+            return os.pread(self.fd, self.BLOCK, self.blocks[block])
+        return self.base.read(block * self.BLOCK, self.BLOCK).ljust(self.BLOCK, b'\x00')
+
+    def read(self, offset: int, size: int) -> bytes:
+        size = max(min(size, self.size - offset), 0)
+        first = offset // self.BLOCK
+        last = (offset + size - 1) // self.BLOCK
+
+        # fast path, range untouched by overlay
+        i = bisect.bisect_left(self.sorted, first)
+        if size == 0 or i == len(self.sorted) or self.sorted[i] > last:
+            return self.base.read(offset, size)
+
+        data = b''.join(self.__read_block(block) for block in range(first, last + 1))
+        start = offset - first * self.BLOCK
+        return data[start:start + size]
+
+    def write(self, offset: int, data: bytes) -> None:
+        if not self.writable:
+            super().write(offset, data)
+        if offset + len(data) > self.size:
+            raise OSError(f'Write out of image {self.filename}')
+
+        done = 0
+        while done < len(data):
+            block, start = divmod(offset + done, self.BLOCK)
+            length = min(self.BLOCK - start, len(data) - done)
+            content = bytearray(self.__read_block(block))
+            content[start:start + length] = data[done:done + length]
+
+            if block not in self.blocks:
+                pos = os.lseek(self.fd, 0, os.SEEK_END)
+                os.pwrite(self.fd, self.RECORD.pack(block), pos)
+                self.blocks[block] = pos + self.RECORD.size
+                bisect.insort(self.sorted, block)
+            os.pwrite(self.fd, bytes(content), self.blocks[block])
+            done += length
+
+    def close(self) -> None:
+        super().close()
+        self.base.close()
+
+
+class VolumeImage(Image):
+    """
+    Window over part of other image, e.g. one partition of disk.
+    Offsets are translated, data is never copied.
+    """
+
+    def __init__(self, base: Image, offset: int, size: int):
+        self.base     = base
+        self.filename = base.filename
+        self.writable = base.writable
+        self.fd       = base.fd
+        self.offset   = offset
+        self.size     = max(min(size, base.size - offset), 0)
+
+    def __clamp(self, offset: int, size: int) -> int:
+        return max(min(size, self.size - offset), 0)
+
+    def read(self, offset: int, size: int) -> bytes:
+        return self.base.read(self.offset + offset, self.__clamp(offset, size))
+
+    def view(self, offset: int, size: int):
+        return self.base.view(self.offset + offset, self.__clamp(offset, size))
+
+    def write(self, offset: int, data: bytes) -> None:
+        if offset + len(data) > self.size:
+            raise OSError(f'Write out of volume of {self.filename}')
+        self.base.write(self.offset + offset, data)
+
+    def find(self, sub: bytes, start: int, end: int) -> int:
+        pos = self.base.find(sub, self.offset + start, self.offset + min(end, self.size))
+        return pos if pos == -1 else pos - self.offset
+
+    def copy_to(self, fd: int, offset: int, size: int) -> int:
+        return self.base.copy_to(fd, self.offset + offset, self.__clamp(offset, size))
+
+    def flush(self) -> None:
+        self.base.flush()
+
+    def close(self) -> None:
+        self.base.close()
+
+
+BACKENDS = {
+    'mmap': MmapImage,
+    'pread': PreadImage,
+}
+
+
+def open_image(filename: str, backend: str = None, writable: bool = False, overlay: str = None,
+               volume: tuple = None) -> Image:
+    """
+    Open image with requested backend, by default mmap with pread fallback.
+    Gzip and zstd images are read through their seek index whatever backend.
+    Volume (offset, size) limits image to one partition of disk.
+    """
+    if volume is not None:
+        return VolumeImage(open_image(filename, backend, writable, overlay), *volume)
+
+    if overlay is not None:
+        return OverlayImage(open_image(filename, backend), overlay, writable)
+
+    # imported here, compressed images are built on Image
+    from lib.compressed import CONTAINERS, compression_of
+    container = compression_of(filename)
+    if container is not None:
+        return CONTAINERS[container](filename, writable)
+
+    if backend is not None:
+        return BACKENDS[backend](filename, writable)
+
+    try:
+        return MmapImage(filename, writable)
+    except (ValueError, OSError):
+        return PreadImage(filename, writable)
+
+
+def clone_image(source: str, target: str) -> str:
+    """Copy image in kernel (reflink on CoW filesystems), returns target"""
+
+    with open_image(source) as image, open(target, 'wb') as f:
+        image.copy_to(f.fileno(), 0, image.size)
+    return target
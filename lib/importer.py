@@ -0,0 +1,451 @@
+# Planning of new files and directories and bulk writing of them into FAT
+import os
+import stat
+import time
+from datetime import datetime
+from math import ceil
+
+from lib.entry import DIR_ATTRIBUTE, DIR_ENTRY, FILE_ATTRIBUTE, LFN_ATTRIBUTE, LFN_ENTRY, lfn_checksum
+from lib.stats import stats
+
+# characters allowed in 8.3 names besides letters and digits
+SHORT_CHARS   = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%\'-_@~`!(){}^#&')
+
+# characters forbidden in long names
+BAD_CHARS     = set('"*/:<>?\\|') | set(chr(x) for x in range(0x20))
+
+# utf-16 units of name in one LFN record
+LFN_UNITS     = 13
+
+# size field of entry is 32 bits
+MAX_SIZE      = 0xFFFFFFFF
+
+DOT           = b'.'.ljust(11)
+DOTDOT        = b'..'.ljust(11)
+
+
+class Node(object):
+    """File or directory to be created, host is None for new empty directory"""
+
+    __slots__ = ('name', 'host', 'is_dir', 'size', 'stamp', 'children', 'short', 'lfn', 'clusters')
+
+    def __init__(self, name: str, host: str, is_dir: bool, size: int = 0, stamp: tuple = (0, 0)):
+        self.name     = name
+        self.host     = host
+        self.is_dir   = is_dir
+        self.size     = size
+        self.stamp    = stamp
+        self.children = []
+        self.short    = None
+        self.lfn      = False
+        self.clusters = []
+
+    def records(self) -> int:
+        """Directory records taken by entry in its parent"""
+        return -(-len(self.name.encode('utf-16-le')) // (LFN_UNITS * 2)) + 1 if self.lfn else 1
+
+    def walk(self):
+        """Node and all nodes below it, directory goes before its children"""
+
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def fat_stamp(timestamp: float) -> tuple:
+    """(date, time) of FAT for host timestamp, dates before 1980 are clamped"""
+
+    t = datetime.fromtimestamp(timestamp)
+    if t.year < 1980:
+        return (0 << 9) | (1 << 5) | 1, 0
+    return ((min(t.year, 2107) - 1980) << 9) | (t.month << 5) | t.day, \
+           (t.hour << 11) | (t.minute << 5) | (t.second // 2)
+
+
+def scan_tree(path: str, problems: list) -> Node:
+    """
+    Node of host file or of directory with everything below it. Names
+    which FAT can't keep and files which are not regular go to problems.
+    """
+    st = os.stat(path)
+    name = os.path.basename(os.path.normpath(path))
+    if not stat.S_ISDIR(st.st_mode):
+        return Node(name, path, False, st.st_size, fat_stamp(st.st_mtime))
+
+    node = Node(name, path, True, 0, fat_stamp(st.st_mtime))
+    with os.scandir(path) as it:
+        children = sorted(it, key=lambda x: x.name)
+
+    for child in children:
+        reason = name_problem(child.name)
+        if reason is None and not (child.is_dir() or child.is_file()):
+            reason = 'not regular file'
+        if reason is not None:
+            problems.append(f'{child.path}: {reason}')
+            continue
+        el = scan_tree(child.path, problems)
+        if el.size > MAX_SIZE:
+            problems.append(f'{child.path}: file is bigger than 4 GiB')
+            continue
+        node.children.append(el)
+    return node
+
+
+def name_problem(name: str) -> str:
+    """Reason why name can't be long name of FAT entry, None for good name"""
+
+    if name in ('.', '..') or not name.strip(' .'):
+        return 'empty name'
+    if any(c in BAD_CHARS for c in name):
+        return 'forbidden character in name'
+    if len(name.encode('utf-16-le')) // 2 > 255:
+        return 'name is longer than 255 characters'
+    return None
+
+
+def short_name(name: str, taken: set, tails: dict = None) -> tuple:
+    """
+    (11 bytes 8.3 name, LFN is needed) unique among taken names of directory.
+    Name which does not fit 8.3 or loses characters gets ~N tail, N is the
+    smallest free number. Names which differ from their 8.3 form keep LFN.
+    Tails keeps last N of every base, so many similar names are not quadratic.
+    """
+    stripped = name.lstrip('.')
+    base, _, ext = stripped.rpartition('.') if '.' in stripped else (stripped, '', '')
+
+    # leading dots are dropped from 8.3 name
+    lossy = stripped != name
+    parts = []
+    for part in (base, ext):
+        out = []
+        for c in part.upper():
+            if c in ' .':
+                lossy = True
+            elif c in SHORT_CHARS:
+                out.append(c)
+            else:
+                lossy = True
+                out.append('_')
+        parts.append(''.join(out))
+    base, ext = parts
+
+    fits = not lossy and len(base) <= 8 and len(ext) <= 3 and base
+    short = (base[:8].ljust(8) + ext[:3].ljust(3)).encode()
+    if fits and short not in taken:
+        return short, name != (base + '.' + ext if ext else base)
+
+    base = base or '_'
+    key = (base[:8], ext[:3])
+    start = tails.get(key, 1) if tails is not None else 1
+    for n in range(start, 1000000):
+        tail = f'~{n}'
+        short = ((base[:8 - len(tail)] + tail).ljust(8) + ext[:3].ljust(3)).encode()
+        if short not in taken:
+            if tails is not None:
+                tails[key] = n
+            return short, True
+    raise ValueError(f'No free short name for {name}')
+
+
+def name_conflicts(nodes: list, names: set, path: str) -> list:
+    """Paths of nodes which repeat names in their directory, case is ignored as in FAT"""
+
+    conflicts = []
+    for node in nodes:
+        key = node.name.casefold()
+        if key in names:
+            conflicts.append(path + node.name)
+        names.add(key)
+        if node.is_dir:
+            conflicts.extend(name_conflicts(node.children, set(), path + node.name + '/'))
+    return conflicts
+
+
+def assign_names(nodes: list, taken: set) -> None:
+    """Short names of entries of one directory, taken is filled with them"""
+
+    tails = {}
+    for node in nodes:
+        node.short, node.lfn = short_name(node.name, taken, tails)
+        taken.add(node.short)
+
+
+def lfn_records(name: str, short: bytes) -> bytes:
+    """LFN parts of name in on-disk order, last part goes first"""
+
+    units = name.encode('utf-16-le')
+    if len(units) // 2 % LFN_UNITS:
+        units += b'\x00\x00'
+    units += b'\xff' * (-len(units) % (LFN_UNITS * 2))
+
+    checksum = lfn_checksum(short)
+    count = len(units) // (LFN_UNITS * 2)
+    parts = []
+    for n in range(count):
+        part = units[n * LFN_UNITS * 2:(n + 1) * LFN_UNITS * 2]
+        order = n + 1 | (0x40 if n + 1 == count else 0)
+        parts.append(LFN_ENTRY.pack(order, part[:10], LFN_ATTRIBUTE, 0, checksum, part[10:22], 0, part[22:]))
+    return b''.join(reversed(parts))
+
+
+def short_record(short: bytes, attr: int, cluster: int, size: int, stamp: tuple) -> bytes:
+    date, time = stamp
+    return DIR_ENTRY.pack(short, attr, 0, 0, time, date, date, cluster >> 16, time, date, cluster & 0xFFFF, size)
+
+
+def entry_records(node: Node) -> bytes:
+    """LFN parts and 8.3 record of node for table of its parent"""
+
+    cluster = node.clusters[0] if node.clusters else 0
+    record = short_record(node.short, DIR_ATTRIBUTE if node.is_dir else FILE_ATTRIBUTE,
+                          cluster, 0 if node.is_dir else node.size, node.stamp)
+    if node.lfn:
+        return lfn_records(node.name, node.short) + record
+    return record
+
+
+def directory_table(node: Node, parent: int) -> bytes:
+    """Table of new directory with `.` and `..`, parent 0 is root"""
+
+    return short_record(DOT, DIR_ATTRIBUTE, node.clusters[0], 0, node.stamp) + \
+           short_record(DOTDOT, DIR_ATTRIBUTE, parent, 0, node.stamp) + \
+           b''.join(entry_records(child) for child in node.children)
+
+
+@stats.timed('write')
+def write_file(fs) -> None:
+    """Write one host file into root directory"""
+
+    if not os.path.isfile(fs.file_for_write):
+        print('[!] File for write in FAT not exists')
+        exit(0)
+    node = scan_tree(fs.file_for_write, [])
+    check_names(fs.file_for_write, name_problem(node.name), node.size)
+
+    import_nodes(fs, [node], '/')
+    print(f'File was write in {fs.target}')
+
+
+@stats.timed('import')
+def import_tree(fs, source: str, path: str) -> None:
+    """
+    Copy host directory with everything below it into directory of image,
+    with trailing slash only its content is copied as by rsync.
+    """
+    if not os.path.isdir(source):
+        print('[!] Directory for import not exists')
+        exit(0)
+    problems = []
+    root = scan_tree(source, problems)
+    if problems:
+        for problem in problems:
+            print(f'[!] {problem}')
+        exit(0)
+    if not source.endswith('/'):
+        check_names(source, name_problem(root.name))
+
+    nodes = root.children if source.endswith('/') else [root]
+    import_nodes(fs, nodes, path)
+    files = sum(1 for node in nodes for el in node.walk() if not el.is_dir)
+    print(f'Imported {files} files and {sum(1 for node in nodes for el in node.walk()) - files} '
+          f'directories in {fs.target}')
+
+
+def make_directory(fs, path: str) -> None:
+    """Create empty directory, its parent must exist"""
+
+    parent, _, name = path.rstrip('/').rpartition('/')
+    check_names(path, name_problem(name))
+    import_nodes(fs, [Node(name, None, True, 0, fat_stamp(time.time()))], parent or '/')
+    print(f'Directory was created in {fs.target}')
+
+
+def check_names(path: str, problem: str, size: int = 0) -> None:
+    """Stop on bad name of new file or directory"""
+
+    if problem is None and size > MAX_SIZE:
+        problem = 'file is bigger than 4 GiB'
+    if problem is not None:
+        print(f'[!] {path}: {problem}')
+        exit(0)
+
+
+def import_nodes(fs, nodes: list, path: str) -> None:
+    """
+    Plan names and clusters of all nodes up front, allocate them at once,
+    then write FAT, directory tables and data in one pass in order of
+    address on image. Nothing is written when plan fails.
+    """
+    if fs.fs_type == 'FAT32':
+        print('[!] Writing is supported only for FAT12 and FAT16')
+        exit(0)
+
+    target = fs.resolve(path)
+    if target is None or type(target) != list and target.type != 'd':
+        print(f'[!] Directory {path} not exists')
+        exit(0)
+    cluster = 0 if type(target) == list else target.cluster
+    existing = target if type(target) == list else fs.get_elements(target)
+
+    # new names must differ from long and 8.3 names of directory
+    names = {x for el in existing if not el.deleted for x in (el.name.casefold(), el.short_name.casefold())}
+    conflicts = name_conflicts(nodes, names, path.rstrip('/') + '/')
+    if conflicts:
+        for conflict in conflicts:
+            print(f'[!] {conflict} already exists')
+        exit(0)
+
+    # raw table of target, new records go after its last used one
+    chain = fs.chain(cluster) if cluster else []
+    if cluster:
+        table = b''.join(fs.image.read(cluster_addr(fs, x), fs.cluster_size) for x in chain)
+    else:
+        table = fs.image.read(fs.root_addr, fs.number_of_root * 0x20)
+    used = table[::0x20].find(0)
+    used = len(table) // 0x20 if used == -1 else used
+    assign_names(nodes, {table[i:i + 11] for i in range(0, used * 0x20, 0x20)
+                         if table[i] != 0xE5 and table[i + 0xB] & 0x3F != LFN_ATTRIBUTE})
+
+    need = sum(node.records() for node in nodes) - (len(table) // 0x20 - used)
+    if need > 0 and not cluster:
+        print(f'[!] Root directory is full, {need} more records are needed')
+        exit(0)
+    grow = ceil(max(need, 0) * 0x20 / fs.cluster_size)
+
+    # clusters of directory tables and files, counted before any write
+    counts = []
+    for node in nodes:
+        for el in node.walk():
+            if el.is_dir:
+                assign_names(el.children, {DOT, DOTDOT})
+                counts.append(max(ceil((2 + sum(x.records() for x in el.children)) * 0x20 / fs.cluster_size), 1))
+            else:
+                counts.append(ceil(el.size / fs.cluster_size))
+
+    try:
+        pool = fs.free_space().allocate(grow + sum(counts))
+    except ValueError as e:
+        print(f'[!] {e}')
+        exit(0)
+
+    # directory goes before its files, so writes go along the volume
+    growth, pos = pool[:grow], grow
+    chains = [chain[-1:] + growth] if growth else []
+    for el, count in zip((el for node in nodes for el in node.walk()), counts):
+        el.clusters = pool[pos:pos + count]
+        pos += count
+        if el.clusters:
+            chains.append(el.clusters)
+
+    pieces = link_chains(fs, chains)
+
+    records = b''.join(entry_records(node) for node in nodes)
+    if cluster:
+        # only clusters from first changed one are written
+        chain += growth
+        table += bytes(grow * fs.cluster_size)
+        first = used * 0x20 // fs.cluster_size
+        data = table[:used * 0x20] + records
+        data += bytes(len(table) - len(data))
+        pieces += table_pieces(fs, chain[first:], data[first * fs.cluster_size:])
+    else:
+        data = records + bytes(min(len(table) - used * 0x20 - len(records), 0x20))
+        pieces.append((fs.root_addr + used * 0x20, data))
+
+    for node in nodes:
+        pieces += node_pieces(fs, node, cluster)
+
+    commit(fs, pieces)
+
+
+def cluster_addr(fs, cluster: int) -> int:
+    return fs.data_addr + fs.cluster_size * (cluster - 2)
+
+
+def node_pieces(fs, node: Node, parent: int) -> list:
+    """Pieces of directory tables and file data of node and nodes below it"""
+
+    if not node.is_dir:
+        pieces = []
+        offset = 0
+        for addr, length in fs.byte_ranges(node.clusters, node.size):
+            for pos in range(0, length, fs.image.COPY_CHUNK):
+                count = min(fs.image.COPY_CHUNK, length - pos)
+                pieces.append((addr + pos, (node.host, offset + pos, count)))
+            offset += length
+        return pieces
+
+    data = directory_table(node, parent)
+    pieces = table_pieces(fs, node.clusters, data + bytes(len(node.clusters) * fs.cluster_size - len(data)))
+    for child in node.children:
+        pieces += node_pieces(fs, child, node.clusters[0])
+    return pieces
+
+
+def table_pieces(fs, clusters: list, data: bytes) -> list:
+    pieces = []
+    offset = 0
+    for addr, length in fs.byte_ranges(clusters, len(data)):
+        pieces.append((addr, data[offset:offset + length]))
+        offset += length
+    return pieces
+
+
+def link_chains(fs, chains: list) -> list:
+    """Link clusters of every chain in decoded FAT, pieces of changed entries for all FATs"""
+
+    table = fs.decode_fat()
+    for clusters in chains:
+        for cluster, following in zip(clusters, clusters[1:] + [fs.end_of_file]):
+            table[cluster] = following
+
+    # one piece per contiguous run of changed entries
+    pieces = []
+    for first, count in fs.extents(sorted(set(x for clusters in chains for x in clusters))):
+        offset, raw = fs.encode_fat(first, first + count - 1)
+        for n in range(fs.number_of_fat):
+            pieces.append((fs.f_fat_table + n*fs.fat_size + offset, raw))
+    return pieces
+
+
+@stats.timed('commit')
+def commit(fs, pieces: list) -> None:
+    """
+    Write (address, bytes or (host file, offset, length)) pieces in order
+    of address, neighbour pieces are joined into one write.
+    """
+    pieces.sort(key=lambda x: x[0])
+
+    # host file is opened on its first piece and closed after its last one
+    left, files = {}, {}
+    for addr, data in pieces:
+        if type(data) == tuple:
+            left[data[0]] = left.get(data[0], 0) + 1
+
+    start, buffer = None, bytearray()
+    for addr, data in pieces:
+        if type(data) == tuple:
+            path, offset, length = data
+            if path not in files:
+                files[path] = os.open(path, os.O_RDONLY)
+            data = read_host(files[path], offset, length)
+            left[path] -= 1
+            if not left[path]:
+                os.close(files.pop(path))
+        if start is not None and addr == start + len(buffer) and len(buffer) < fs.image.COPY_CHUNK:
+            buffer += data
+            continue
+        if buffer:
+            fs.image.write(start, bytes(buffer))
+        start, buffer = addr, bytearray(data)
+    if buffer:
+        fs.image.write(start, bytes(buffer))
+    stats.count('import_pieces', len(pieces))
+    fs.image.flush()
+
+
+def read_host(fd: int, offset: int, length: int) -> bytes:
+    """Piece of opened host file, short read is padded by zeros like truncated file"""
+
+    data = os.pread(fd, length, offset)
+    return data + bytes(length - len(data))
@@ -0,0 +1,110 @@
+# Persistent sidecar index with parsed metadata of image
+import hashlib
+import json
+import os
+import sqlite3
+from array import array
+
+from lib.entry import Entry
+
+
+class MetadataIndex(object):
+    """
+    SQLite file next to image with parsed directories, decoded FAT and
+    free map. Warm open compares only size, mtime and hash of boot sector
+    and sampled pages of FAT, hash of whole FAT is taken when they differ.
+    Stale index is rebuilt from scratch.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db   = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, data BLOB);
+            CREATE TABLE IF NOT EXISTS dirs (cluster INTEGER PRIMARY KEY, entries TEXT);
+        ''')
+
+    @staticmethod
+    def fingerprint(boot: bytes, fat: bytes) -> str:
+        return hashlib.blake2b(boot + fat, digest_size=20).hexdigest()
+
+    def __meta(self) -> dict:
+        return dict(self.db.execute('SELECT key, value FROM meta'))
+
+    def is_fresh(self, size: int, mtime: int, sample: str) -> bool:
+        meta = self.__meta()
+        return meta.get('version') == str(self.VERSION) and \
+               meta.get('size') == str(size) and \
+               meta.get('mtime') == str(mtime) and \
+               meta.get('sample') == sample
+
+    def same_content(self, fingerprint: str) -> bool:
+        """Image was touched or copied, but boot sector and FAT are the same"""
+
+        meta = self.__meta()
+        return meta.get('version') == str(self.VERSION) and meta.get('fingerprint') == fingerprint
+
+    def touch(self, size: int, mtime: int, sample: str) -> None:
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [
+                ('size', str(size)),
+                ('mtime', str(mtime)),
+                ('sample', sample),
+            ])
+
+    def rebuild(self, size: int, mtime: int, sample: str, fingerprint: str,
+                table: array, bitmap: bytes, dirs) -> None:
+        """Replace content of index, dirs is iterable of (cluster, entries)"""
+
+        with self.db:
+            self.db.execute('DELETE FROM meta')
+            self.db.execute('DELETE FROM blobs')
+            self.db.execute('DELETE FROM dirs')
+            self.db.executemany('INSERT INTO blobs VALUES (?, ?)', [
+                ('fat', table.typecode.encode() + table.tobytes()),
+                ('free', bytes(bitmap)),
+            ])
+            self.db.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                                ((cluster, json.dumps([el.to_row() for el in entries])) for cluster, entries in dirs))
+            # meta is written last, interrupted build stays stale
+            self.db.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('version', str(self.VERSION)),
+                ('size', str(size)),
+                ('mtime', str(mtime)),
+                ('sample', sample),
+                ('fingerprint', fingerprint),
+            ])
+
+    def __blob(self, name: str) -> bytes:
+        row = self.db.execute('SELECT data FROM blobs WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def load_fat(self) -> array:
+        raw = self.__blob('fat')
+        if raw is None:
+            return None
+        table = array(raw[:1].decode())
+        table.frombytes(raw[1:])
+        return table
+
+    def load_free(self) -> bytearray:
+        raw = self.__blob('free')
+        return None if raw is None else bytearray(raw)
+
+    def load_dir(self, cluster: int) -> list:
+        row = self.db.execute('SELECT entries FROM dirs WHERE cluster = ?', (cluster,)).fetchone()
+        return None if row is None else [Entry.from_row(el) for el in json.loads(row[0])]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def default_index_path(filename: str, volume: tuple = None) -> str:
+    """Index of image, every partition of disk has own one"""
+
+    if volume is not None:
+        return f'{os.path.abspath(filename)}.{volume[0]:x}.fatidx'
+    return os.path.abspath(filename) + '.fatidx'
@@ -0,0 +1,118 @@
+# Hash inventory of files streamed from image, nothing is written to disk
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.stats import stats
+
+ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+# piece of file given to hash functions at once, hashlib releases GIL on big buffers
+HASH_CHUNK = 1 << 20
+ZEROS      = bytes(HASH_CHUNK)
+
+
+def parse_algorithms(value: str) -> list:
+    """Names of hash functions from comma separated list"""
+
+    names = [x.strip().lower() for x in value.split(',') if x.strip()]
+    unknown = [x for x in names if x not in hashlib.algorithms_available]
+    if unknown or not names:
+        print(f'[!] Unknown hash function {", ".join(unknown)}, use {",".join(ALGORITHMS)}')
+        exit(0)
+    return list(dict.fromkeys(names))
+
+
+def first_address(job: tuple) -> int:
+    """Files are hashed in order of their first cluster on disk"""
+
+    for addr, _ in job[2]:
+        if addr is not None:
+            return addr
+    return 0
+
+
+def hash_stream(image, value: bytes, ranges: list, algorithms: list) -> dict:
+    """
+    Digests of file given by resident value or by (address, length) ranges,
+    address None is sparse range of zeros. Ranges are hashed by views of image.
+    """
+    hashers = [hashlib.new(name) for name in algorithms]
+    size = 0
+    if value is not None:
+        for h in hashers:
+            h.update(value)
+        size = len(value)
+
+    for addr, length in ranges:
+        for pos in range(0, length, HASH_CHUNK):
+            count = min(HASH_CHUNK, length - pos)
+            chunk = ZEROS[:count] if addr is None else image.view(addr + pos, count)
+            for h in hashers:
+                h.update(chunk)
+            size += count
+
+    stats.count('bytes_hashed', size)
+    return {name: h.hexdigest() for name, h in zip(algorithms, hashers)}
+
+
+@stats.timed('hash')
+def print_inventory(image, jobs: list, algorithms: list, workers: int, fmt: str) -> None:
+    """
+    Hash files of jobs (record, resident value, ranges) in pool of threads
+    and print manifest as csv, json lines or json. Files are read in order
+    of their place on disk, manifest goes in the same order.
+    """
+    jobs.sort(key=first_address)
+    total = sum(job[0]['size'] for job in jobs)
+    progress = {'files': 0, 'bytes': 0, 'time': 0}
+    lock = threading.Lock()
+
+    def hash_file(job):
+        record, value, ranges = job
+        if record['error'] is None:
+            record.update(hash_stream(image, value, ranges, algorithms))
+
+        with lock:
+            progress['files'] += 1
+            progress['bytes'] += record['size']
+            now = time.monotonic()
+            if now - progress['time'] > 0.5 or progress['files'] == len(jobs):
+                progress['time'] = now
+                print(f"\r[*] Hashed {progress['files']}/{len(jobs)} files, "
+                      f"{progress['bytes'] / 2**20:.1f}/{total / 2**20:.1f} MiB",
+                      end='', file=sys.stderr, flush=True)
+        return record
+
+    columns = ['path', 'size', 'deleted'] + algorithms + ['error']
+    if fmt == 'csv':
+        writer = csv.DictWriter(sys.stdout, columns, restval='', lineterminator='\n')
+        writer.writeheader()
+
+    records = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for record in pool.map(hash_file, jobs):
+                record = {x: record.get(x) for x in columns}
+                if fmt == 'csv':
+                    # bool is written as 1/0, not as True/False of python
+                    writer.writerow({**record, 'deleted': int(record['deleted'])})
+                elif fmt == 'ndjson':
+                    sys.stdout.write(json.dumps(record) + '\n')
+                else:
+                    records.append(record)
+        except BrokenPipeError:
+            # reader like head closed pipe, files left are not hashed
+            pool.shutdown(wait=False, cancel_futures=True)
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return
+
+    if jobs:
+        print(file=sys.stderr)
+    if fmt == 'json':
+        print(json.dumps(records))
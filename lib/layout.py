@@ -0,0 +1,398 @@
+# Extent map of cluster chains, built from decoded FAT in one pass, and reports made from it
+import json
+from array import array
+from bisect import bisect_left
+from math import ceil
+from operator import eq, ne
+
+from lib.entry import DIR_ATTRIBUTE, Entry
+from lib.stats import stats
+
+# flags made from one byte per cluster with bytes.translate
+ZERO_FLAG     = bytes([1]) + bytes(255)
+MANY_FLAG     = bytes(2) + bytes([1]) * 254
+# in-degree saturates at 255
+SATURATED_ADD = bytes(min(x + 1, 255) for x in range(256))
+
+# items of one kind listed in check report, all of them are counted
+REPORT_LIMIT  = 1000
+
+
+def positions(flags: bytes):
+    """Yield indexes of 1 in flags, searched with bytes.find"""
+
+    pos = flags.find(1)
+    while pos != -1:
+        yield pos
+        pos = flags.find(1, pos + 1)
+
+
+def mask_and(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') & int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def mask_and_not(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') & ~int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+class ExtentMap(object):
+    """
+    All chains of FAT split into extents (first cluster, count).
+    Runs of entries pointing to the next cluster are found with bytes.find,
+    so chains are followed by extents instead of cluster by cluster.
+    In-degree of every cluster shows heads of chains and cross-links.
+    """
+
+    def __init__(self, table: array, bad_cluster: int, free: bytearray):
+        self.table    = table
+        self.bad      = bad_cluster
+        self.limit    = min(len(table), bad_cluster)
+        self.forward  = self.__forward()
+        self.used     = self.__used(free)
+        self.indegree = self.__indegree()
+        self.many     = self.indegree.translate(MANY_FLAG)
+        self.visited  = bytearray(len(table))
+
+        # chains start at used clusters nothing points to
+        self.chains = {}
+        for head in positions(mask_and(self.used, self.indegree.translate(ZERO_FLAG))):
+            self.chains[head] = self.follow(head)
+
+        # used clusters not reached from any head are closed loops
+        self.cycles = {}
+        for cluster in positions(mask_and_not(self.used, self.visited)):
+            if not self.visited[cluster]:
+                self.cycles[cluster] = self.follow(cluster)
+
+    def __forward(self) -> bytearray:
+        """1 where entry points to the next cluster"""
+
+        forward = bytearray(map(eq, self.table, range(1, len(self.table) + 1)))
+        forward[:2] = bytes(len(forward[:2]))
+        return forward
+
+    def __used(self, free: bytearray) -> bytearray:
+        """1 for allocated cluster, reserved entries and bad clusters are not used"""
+
+        used = bytearray(bytes(free).translate(ZERO_FLAG))
+        used[:2] = bytes(len(used[:2]))
+        pos = self.__find(self.bad, 2)
+        while pos != -1:
+            used[pos] = 0
+            pos = self.__find(self.bad, pos + 1)
+        return used
+
+    def __find(self, value: int, start: int) -> int:
+        try:
+            return self.table.index(value, start)
+        except ValueError:
+            return -1
+
+    def __indegree(self) -> bytearray:
+        """
+        Number of entries pointing to every cluster. Links to the next
+        cluster come from shifted forward flags, only jumps are looped over.
+        """
+        indegree = bytearray(len(self.table))
+        indegree[1:] = self.forward[:-1]
+
+        for end in positions(mask_and_not(self.used, self.forward)):
+            target = self.table[end]
+            if 2 <= target < self.limit:
+                indegree[target] = SATURATED_ADD[indegree[target]]
+        return indegree
+
+    def follow(self, cluster: int) -> tuple:
+        """
+        Extents of chain from cluster and problem which stopped it:
+        None for proper end of chain or one of 'loop', 'free cluster in chain',
+        'bad cluster in chain', 'invalid entry'.
+        """
+        extents = []
+        starts = set()
+        while True:
+            if not 2 <= cluster < self.limit:
+                # values above bad cluster mark end of chain
+                return extents, None if cluster > self.bad else 'invalid entry'
+            if not self.used[cluster]:
+                return extents, 'bad cluster in chain' if self.table[cluster] == self.bad else 'free cluster in chain'
+            if cluster in starts:
+                return extents, 'loop'
+            starts.add(cluster)
+
+            end = self.forward.find(0, cluster)
+            if end == -1:
+                end = len(self.table) - 1
+            elif not self.used[end]:
+                # run leads into free or bad cluster
+                self.__add(extents, cluster, end - cluster)
+                cluster = end
+                continue
+
+            self.__add(extents, cluster, end + 1 - cluster)
+            cluster = self.table[end]
+
+    def __add(self, extents: list, start: int, count: int) -> None:
+        if count <= 0:
+            return
+        self.visited[start:start + count] = b'\x01' * count
+        if extents and sum(extents[-1]) == start:
+            extents[-1] = (extents[-1][0], extents[-1][1] + count)
+        else:
+            extents.append((start, count))
+
+    def is_cross_linked(self, extents: list) -> bool:
+        """Some cluster of extents has more than one entry pointing to it"""
+
+        return any(self.many.find(1, start, start + count) != -1 for start, count in extents)
+
+    def invalid(self) -> list:
+        """
+        Used clusters whose entry points outside of data region. Only ends of
+        runs are looked at, entries inside runs point to the next cluster.
+        """
+        ends = list(positions(mask_and_not(self.used, self.forward)))
+        last = len(self.table) - 1
+        if last >= 2 and self.used[last] and self.forward[last]:
+            # entry of last cluster points past the table
+            ends.append(last)
+
+        return [x for x in ends if self.table[x] < 2 or self.limit <= self.table[x] < self.bad]
+
+
+@stats.timed('layout')
+def print_extents(fs) -> None:
+    """
+    Json report of extents of every file and directory below path,
+    fragmentation of volume, cross-linked and lost chains, largest free runs
+    """
+    fs.init_entities()
+    entity = fs.resolve(fs.catalog or '/')
+    if entity is None:
+        print('[!] File or dir not exist')
+        exit(0)
+
+    if type(entity) == list:
+        entries = list(fs.walk_paths(entity, ''))
+        if fs.fs_type == 'FAT32':
+            entries.insert(0, ('/', Entry(DIR_ATTRIBUTE, '', '', 0, fs.root_cluster)))
+    elif entity.type == 'd':
+        path = '/' + '/'.join(x for x in fs.catalog.split('/') if x)
+        entries = [(path, entity)] + list(fs.walk_paths(fs.get_elements(entity), path))
+    else:
+        entries = [('/' + '/'.join(x for x in fs.catalog.split('/') if x), entity)]
+
+    files, first_clusters = extent_records(fs, entries)
+    shared = shared_clusters(fs, files, first_clusters)
+
+    # chains which no entry points to, whole volume is needed to tell it
+    orphans = lost_chains(fs, first_clusters) if fs.catalog in (None, '', '/') else []
+
+    live = [x for x in files if x['type'] == 'f' and x['clusters'] and not x['deleted']]
+    extents = sum(len(x['extents']) for x in live)
+    fragmented = [x for x in live if len(x['extents']) > 1]
+    free = fs.free_space()
+    used = fs.clusters_count - free.free_count()
+
+    report = {
+        'volume': {
+            'fs_type': fs.fs_type,
+            'cluster_size': fs.cluster_size,
+            'clusters': fs.clusters_count,
+            'used': used,
+            'free': free.free_count(),
+        },
+        'summary': {
+            'files': sum(1 for x in files if x['type'] == 'f' and not x['deleted']),
+            'directories': sum(1 for x in files if x['type'] == 'd' and not x['deleted']),
+            'fragmented_files': len(fragmented),
+            'fragmentation': round(100 * len(fragmented) / len(live), 2) if live else 0.0,
+            'extents': extents,
+            'extents_per_file': round(extents / len(live), 3) if live else 0.0,
+            'mean_extent_bytes': sum(x['clusters'] for x in live) * fs.cluster_size // extents if extents else 0,
+            # jumps between extents when files are read one by one in listing order
+            'seeks': extents - len(live),
+            'seek_clusters': sum(x['seek_clusters'] for x in live),
+            'most_fragmented': [{'path': x['path'], 'extents': len(x['extents'])}
+                                for x in sorted(fragmented, key=lambda x: -len(x['extents']))[:10]],
+            'problems': sum(1 for x in files if x['issues']),
+            'free_runs': len(free.length),
+        },
+        'cross_linked': [{'cluster': cluster, 'owners': owners} for cluster, owners in sorted(shared.items())],
+        'orphans': orphans,
+        'largest_free': [{'first_cluster': start, 'clusters': length, 'bytes': length * fs.cluster_size}
+                         for start, length in free.largest(10)],
+        'files': files,
+    }
+    print(json.dumps(report))
+    return
+
+
+@stats.timed('check')
+def print_check(fs) -> None:
+    """
+    Json report of consistency of whole volume: copies of FAT against first one,
+    entries pointing outside of data region, cross-linked clusters, lost chains
+    and cycles, sizes of files against length of their chains. Chains are taken
+    from extent map of one decoded FAT, so time depends on number of entries.
+    """
+    fs.init_entities()
+    table = fs.decode_fat()
+    layout = fs.extent_map()
+
+    entries = [(path, el) for path, el in fs.walk_paths(fs.files, '') if not el.deleted]
+    if fs.fs_type == 'FAT32':
+        entries.insert(0, ('/', Entry(DIR_ATTRIBUTE, '', '', 0, fs.root_cluster)))
+    files, first_clusters = extent_records(fs, entries)
+    shared = shared_clusters(fs, files, first_clusters)
+    orphans = lost_chains(fs, first_clusters)
+
+    copies = [compare_copy(fs, number, table) for number in range(1, fs.number_of_fat)]
+    invalid = layout.invalid()
+    broken = [x for x in files if x['issues']]
+    media = fs.image.read(0x15, 1)[0]
+
+    summary = {
+        'entries': len(files),
+        'fat_mismatches': sum(x['mismatches'] for x in copies),
+        'media_mismatch': bool(len(table)) and table[0] & 0xFF != media,
+        'invalid_entries': len(invalid),
+        'cross_linked': len(shared),
+        'lost_chains': sum(1 for x in orphans if x['reason'].startswith('lost chain')),
+        'lost_clusters': sum(x['clusters'] for x in orphans),
+        'cycles': sum(1 for x in orphans if x['reason'].startswith('cycle')) +
+                  sum(1 for x in files if 'loop' in x['issues']),
+        'size_mismatches': sum(1 for x in files if {'chain shorter than size', 'chain longer than size'} &
+                               set(x['issues'])),
+        'broken_entries': len(broken),
+        'bad_clusters': table.count(fs.bad_cluster),
+    }
+
+    report = {
+        'volume': {
+            'fs_type': fs.fs_type,
+            'cluster_size': fs.cluster_size,
+            'clusters': fs.clusters_count,
+            'number_of_fat': fs.number_of_fat,
+        },
+        'clean': not any(v for k, v in summary.items() if k not in ('entries', 'bad_clusters')),
+        'summary': summary,
+        'fat_copies': copies,
+        'invalid_entries': [{'cluster': x, 'value': table[x]} for x in invalid[:REPORT_LIMIT]],
+        'cross_linked': [{'cluster': cluster, 'owners': owners}
+                         for cluster, owners in sorted(shared.items())[:REPORT_LIMIT]],
+        'lost_chains': orphans[:REPORT_LIMIT],
+        'entries': broken[:REPORT_LIMIT],
+    }
+    print(json.dumps(report))
+
+
+def compare_copy(fs, number: int, table: array) -> dict:
+    """Entries of FAT copy which differ from first FAT, equal tables are compared as whole"""
+
+    copy = fs.decode_table(fs.f_fat_table + fs.fat_size * number)
+    if copy == table:
+        clusters = []
+    else:
+        clusters = list(positions(bytearray(map(ne, table, copy))))
+        clusters.extend(range(len(copy), len(table)))
+
+    return {'copy': number + 1, 'mismatches': len(clusters), 'clusters': clusters[:REPORT_LIMIT]}
+
+
+def extent_records(fs, entries: list) -> tuple:
+    """Records of (path, entry) pairs and records of live entries by their first cluster"""
+
+    files = []
+    first_clusters = {}
+    for path, el in entries:
+        record = extent_record(fs, path, el)
+        files.append(record)
+        if not el.deleted and el.cluster:
+            first_clusters.setdefault(el.cluster, []).append(record)
+    return files, first_clusters
+
+
+def shared_clusters(fs, files: list, first_clusters: dict) -> dict:
+    """
+    Paths of records owning every cluster reached by more than one entry of FAT,
+    by entry of FAT and entry of directory or by several entries of directories
+    """
+    layout = fs.extent_map()
+    shared = {cluster: [] for cluster in positions(layout.many)}
+    for cluster, records in first_clusters.items():
+        if len(records) > 1 or 2 <= cluster < len(layout.indegree) and layout.indegree[cluster]:
+            shared.setdefault(cluster, [])
+    if not shared:
+        return shared
+
+    clusters = sorted(shared)
+    for record in files:
+        for start, count in record['extents']:
+            for cluster in clusters[bisect_left(clusters, start):bisect_left(clusters, start + count)]:
+                shared[cluster].append(record['path'])
+                if 'cross-linked' not in record['issues']:
+                    record['issues'].append('cross-linked')
+    return shared
+
+
+def lost_chains(fs, first_clusters: dict) -> list:
+    """Chains and closed loops of FAT which no entry of volume points to"""
+
+    layout = fs.extent_map()
+    owned = set(first_clusters)
+    if fs.fs_type == 'FAT32':
+        owned.add(fs.root_cluster)
+
+    orphans = []
+    for reason, chains in (('lost chain', layout.chains), ('cycle', layout.cycles)):
+        for head, (extents, problem) in chains.items():
+            if head not in owned:
+                orphans.append({
+                    'first_cluster': head,
+                    'clusters': sum(count for _, count in extents),
+                    'extents': extents,
+                    'reason': reason if problem is None else f'{reason}, {problem}'
+                })
+    return orphans
+
+
+def extent_record(fs, path: str, el: Entry) -> dict:
+    """Extents of one entry with problems of its chain"""
+
+    layout = fs.extent_map()
+    issues = []
+    if el.deleted:
+        # data of deleted file is guessed from free clusters
+        extents = fs.extents(fs.clusters_of(el)) if el.cluster else []
+        if el.size and not extents:
+            issues.append('overwritten')
+    elif el.cluster == 0:
+        extents = []
+    else:
+        extents, problem = layout.chains.get(el.cluster) or layout.follow(el.cluster)
+        if problem is not None:
+            issues.append(problem)
+        if 2 <= el.cluster < len(layout.indegree) and layout.indegree[el.cluster] or \
+                layout.is_cross_linked(extents):
+            issues.append('cross-linked')
+
+    clusters = sum(count for _, count in extents)
+    if el.type == 'f' and not el.deleted:
+        expected = ceil(el.size / fs.cluster_size)
+        if clusters < expected:
+            issues.append('chain shorter than size')
+        elif clusters > expected:
+            issues.append('chain longer than size')
+
+    return {
+        'path': path,
+        'type': el.type,
+        'size': el.size,
+        'deleted': el.deleted,
+        'first_cluster': el.cluster,
+        'clusters': clusters,
+        'extents': extents,
+        'seek_clusters': sum(abs(b[0] - a[0] - a[1]) for a, b in zip(extents, extents[1:])),
+        'issues': issues
+    }
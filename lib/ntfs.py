@@ -1 +1,724 @@
-# Functions for work with NTFS image
\ No newline at end of file
+# Functions for work with NTFS image
+import json
+import os
+import struct
+from datetime import datetime, timedelta
+
+from lib.entry import DIR_ATTRIBUTE, FILE_ATTRIBUTE, Entry
+from lib.image import open_image
+from lib.inventory import print_inventory
+from lib.stats import CountingImage, stats
+from lib.volume import FileSystem
+
+# headers of MFT record, attribute and index structures
+RECORD_HEADER  = struct.Struct('<4sHHQHHHHIIQHHI')
+ATTR_HEADER    = struct.Struct('<IIBBHHH')
+RESIDENT       = struct.Struct('<IH')
+NON_RESIDENT   = struct.Struct('<QQHH4xQQQ')
+FILE_NAME      = struct.Struct('<QQQQQQQIIBB')
+INDEX_ENTRY    = struct.Struct('<QHHB')
+LIST_ENTRY     = struct.Struct('<IHBBQQH')
+
+# types of attributes
+STANDARD_INFORMATION = 0x10
+ATTRIBUTE_LIST       = 0x20
+FILE_NAME_ATTR       = 0x30
+DATA                 = 0x80
+INDEX_ROOT           = 0x90
+INDEX_ALLOCATION     = 0xA0
+BITMAP               = 0xB0
+END_OF_ATTRIBUTES    = 0xFFFFFFFF
+
+# record flags and namespaces of names
+IN_USE       = 0x01
+DIRECTORY    = 0x02
+DOS_NAME     = 2
+ROOT_RECORD  = 5
+
+# update sequence protects every 512 bytes of record whatever sector size is
+FIXUP_STRIDE = 512
+
+# records read by one chunk of MFT scan
+SCAN_CHUNK   = 4 << 20
+
+EPOCH        = datetime(1601, 1, 1)
+
+
+class Attribute(object):
+    """Attribute of MFT record, resident value or run list of non-resident one"""
+
+    __slots__ = ('type', 'name', 'flags', 'value', 'runs', 'size', 'start_vcn')
+
+    def __init__(self, type: int, name: str, flags: int, value: bytes = None,
+                 runs: list = None, size: int = 0, start_vcn: int = 0):
+        self.type      = type
+        self.name      = name
+        self.flags     = flags
+        self.value     = value
+        self.runs      = runs
+        self.size      = size
+        self.start_vcn = start_vcn
+
+
+def decode_runs(data: bytes) -> list:
+    """Run list to (lcn, count) pairs, lcn is None for sparse run"""
+
+    runs = []
+    pos = 0
+    lcn = 0
+    while pos < len(data) and data[pos]:
+        length_size, offset_size = data[pos] & 0x0F, data[pos] >> 4
+        pos += 1
+        count = int.from_bytes(data[pos:pos + length_size], 'little')
+        pos += length_size
+        if offset_size:
+            lcn += int.from_bytes(data[pos:pos + offset_size], 'little', signed=True)
+            runs.append((lcn, count))
+        else:
+            runs.append((None, count))
+        pos += offset_size
+
+    return runs
+
+
+def parse_attributes(record: bytes) -> list:
+    """Attributes of fixed up record"""
+
+    attributes = []
+    pos = RECORD_HEADER.unpack_from(record)[6]
+    while pos + ATTR_HEADER.size <= len(record):
+        type, length, non_resident, name_length, name_offset, flags, _ = ATTR_HEADER.unpack_from(record, pos)
+        if type == END_OF_ATTRIBUTES or length < ATTR_HEADER.size or pos + length > len(record):
+            break
+
+        name = record[pos + name_offset:pos + name_offset + 2*name_length].decode('utf-16-le', errors='replace')
+        if non_resident:
+            start_vcn, _, runs_offset, _, _, size, _ = NON_RESIDENT.unpack_from(record, pos + 0x10)
+            runs = decode_runs(record[pos + runs_offset:pos + length])
+            attributes.append(Attribute(type, name, flags, runs=runs, size=size, start_vcn=start_vcn))
+        else:
+            value_length, value_offset = RESIDENT.unpack_from(record, pos + 0x10)
+            value = bytes(record[pos + value_offset:pos + value_offset + value_length])
+            attributes.append(Attribute(type, name, flags, value=value, size=value_length))
+        pos += length
+
+    return attributes
+
+
+def usa_sane(usa_offset: int, usa_count: int, size: int) -> bool:
+    """Update sequence and sectors it protects lie inside record"""
+
+    return usa_count >= 1 and usa_offset + 2*usa_count <= size and (usa_count - 1) * FIXUP_STRIDE <= size
+
+
+def fixup(record: bytearray, offset: int = 0) -> bool:
+    """Put back protected bytes of one record or index block, False if it is torn"""
+
+    usa_offset, usa_count = struct.unpack_from('<HH', record, offset + 4)
+    if not usa_sane(usa_offset, usa_count, len(record) - offset):
+        return False
+    check = record[offset + usa_offset:offset + usa_offset + 2]
+    for i in range(1, usa_count):
+        end = offset + i*FIXUP_STRIDE - 2
+        if record[end:end + 2] != check:
+            return False
+        record[end:end + 2] = record[offset + usa_offset + 2*i:offset + usa_offset + 2*i + 2]
+    return True
+
+
+def fixup_records(chunk: bytearray, size: int) -> set:
+    """
+    Apply fixups to all records of chunk at once with strided slices,
+    returns numbers of torn records. Records with other update sequence
+    offset than the first record are fixed one by one, all of them when
+    update sequence of the first record is broken.
+    """
+    count = len(chunk) // size
+    file_records = [i for i in range(count) if chunk[i*size:i*size + 4] == b'FILE']
+    if not file_records:
+        return set()
+
+    # update sequence of first record is taken for whole chunk
+    first = file_records[0] * size
+    usa_offset, usa_count = struct.unpack_from('<HH', chunk, first + 4)
+    batch = usa_sane(usa_offset, usa_count, size)
+    others = [i for i in file_records if not batch or chunk[i*size + 4:i*size + 8] != chunk[first + 4:first + 8]]
+    saved = {i: chunk[i*size:(i + 1)*size] for i in others}
+    torn = set()
+
+    if batch:
+        for n in range(1, usa_count):
+            end = n*FIXUP_STRIDE - 2
+            for byte in (0, 1):
+                if chunk[end + byte::size] != chunk[usa_offset + byte::size]:
+                    plane, check = chunk[end + byte::size], chunk[usa_offset + byte::size]
+                    torn.update(i for i in range(count) if plane[i] != check[i])
+                chunk[end + byte::size] = chunk[usa_offset + 2*n + byte::size]
+
+    for i, record in saved.items():
+        torn.discard(i)
+        if not fixup(record):
+            torn.add(i)
+        chunk[i*size:(i + 1)*size] = record
+
+    return torn.intersection(file_records)
+
+
+def filetime_to_fat(filetime: int) -> int:
+    """NTFS time to packed FAT date << 16 | time, entries keep FAT timestamps"""
+
+    if not filetime:
+        return 0
+    try:
+        date = EPOCH + timedelta(microseconds=filetime // 10)
+    except OverflowError:
+        return 0
+    if not 1980 <= date.year < 2108:
+        return 0
+
+    return ((date.year - 1980) << 9 | date.month << 5 | date.day) << 16 | \
+           (date.hour << 11 | date.minute << 5 | date.second // 2)
+
+
+class NTFS(FileSystem):
+
+    ADDRESS = 'Record'
+
+    @stats.timed('boot')
+    def __init__(self, args):
+        super().__init__(args)
+        self.image = self.__open_image(args)
+        data = self.image.read(0, 0x200)
+
+        self.oem              = data[0x3:0xB].decode()
+        self.sector_size      = int.from_bytes(data[0xB:0xD], 'little')
+        self.cluster_size     = self.sector_size * self.__scale(data[0xD])
+        self.total_sectors    = int.from_bytes(data[0x28:0x30], 'little')
+        self.mft_cluster      = int.from_bytes(data[0x30:0x38], 'little')
+        self.mirror_cluster   = int.from_bytes(data[0x38:0x40], 'little')
+        self.record_size      = self.__size_of(data[0x40])
+        self.index_size       = self.__size_of(data[0x44])
+        self.serial           = int.from_bytes(data[0x48:0x50], 'little')
+        self.mft_addr         = self.mft_cluster * self.cluster_size
+        self.deleted_map      = None
+
+        # $MFT describes itself, its first record is read from boot sector address
+        record = bytearray(self.image.read(self.mft_addr, self.record_size))
+        if record[:4] != b'FILE' or not fixup(record):
+            print('[!] $MFT record is damaged')
+            exit(0)
+
+        data_attr = self.__data_of(parse_attributes(record))
+        if data_attr is None:
+            print('[!] $MFT record is damaged')
+            exit(0)
+        self.mft_runs         = data_attr.runs
+        self.mft_size         = data_attr.size
+        # runs can continue in extension records, see $ATTRIBUTE_LIST
+        data_attr = self.__data_of(self.__attributes(0))
+        if data_attr is None:
+            print('[!] $MFT record is damaged')
+            exit(0)
+        self.mft_runs         = data_attr.runs
+        self.records_count    = self.mft_size // self.record_size
+
+    def __open_image(self, args):
+        """Open image read-only, with --stats bytes moved through it are counted"""
+
+        image = open_image(args.file, getattr(args, 'backend', None), overlay=getattr(args, 'overlay', None),
+                           volume=getattr(args, 'volume', None))
+        if stats.enabled:
+            return CountingImage(image, stats)
+        return image
+
+    def __scale(self, value: int) -> int:
+        """Sectors per cluster, values above 0x80 are negative powers of two"""
+
+        return 1 << (256 - value) if value > 0x80 else value
+
+    def __size_of(self, value: int) -> int:
+        """Size of MFT record or index block, negative value is power of two in bytes"""
+
+        if value > 0x7F:
+            return 1 << (256 - value)
+        return value * self.cluster_size
+
+    def info(self) -> dict:
+        """Parameters of file system for json output"""
+
+        return {
+            'fs_type': 'NTFS',
+            'oem': self.oem,
+            'sector_size': self.sector_size,
+            'cluster_size': self.cluster_size,
+            'total_sectors': self.total_sectors,
+            'record_size': self.record_size,
+            'index_size': self.index_size,
+            'mft_addr': self.mft_addr,
+            'mftmirr_addr': self.mirror_cluster * self.cluster_size,
+            'mft_size': self.mft_size,
+            'records': self.records_count,
+            'serial': f'{self.serial:016X}',
+        }
+
+    def print_info(self) -> None:
+        if self.json:
+            print(json.dumps(self.info()))
+            return
+
+        info =   'Информация о файловой системе\n\n'
+        info += f'Имя OEM: {self.oem}\n'
+        info += f'Размер сектора: {hex(self.sector_size)}\n'
+        info += f'Размер кластера: {hex(self.cluster_size)}\n'
+        info += f'Количество секторов: {hex(self.total_sectors)}\n'
+        info += f'Размер записи MFT: {hex(self.record_size)}\n'
+        info += f'Размер индексной записи: {hex(self.index_size)}\n'
+        info += f'Тип файловой системы: NTFS\n'
+        info += f'Адрес $MFT: {hex(self.mft_addr)}\n'
+        info += f'Адрес $MFTMirr: {hex(self.mirror_cluster * self.cluster_size)}\n'
+        info += f'Размер $MFT: {hex(self.mft_size)}\n'
+        info += f'Количество записей MFT: {hex(self.records_count)}\n'
+        info += f'Серийный номер тома: {self.serial:016X}'
+
+        print(info)
+
+    def byte_ranges(self, runs: list, size: int, offset: int = 0) -> list:
+        """
+        Map [offset, offset + size) of non-resident stream to (address, length)
+        ranges of image, address is None for sparse parts
+        """
+        ranges = []
+        vcn = 0
+        end = offset + size
+        for lcn, count in runs:
+            start, stop = vcn * self.cluster_size, (vcn + count) * self.cluster_size
+            vcn += count
+            if stop <= offset:
+                continue
+            if start >= end:
+                break
+
+            first, last = max(start, offset), min(stop, end)
+            addr = None if lcn is None else lcn * self.cluster_size + first - start
+            ranges.append((addr, last - first))
+
+        return ranges
+
+    def __read_stream(self, runs: list, offset: int, size: int) -> bytes:
+        """Read part of non-resident stream, sparse parts are zeros"""
+
+        return b''.join(bytes(length) if addr is None else self.image.read(addr, length).ljust(length, b'\x00')
+                        for addr, length in self.byte_ranges(runs, size, offset))
+
+    def __read_record(self, number: int) -> bytearray:
+        """Fixed up MFT record or None when it is not valid"""
+
+        if not 0 <= number < max(self.mft_size // self.record_size, 1):
+            return None
+
+        record = bytearray(self.__read_stream(self.mft_runs, number * self.record_size, self.record_size))
+        if record[:4] != b'FILE' or not fixup(record):
+            return None
+        return record
+
+    def __attributes(self, number: int, record: bytearray = None) -> list:
+        """Attributes of base record together with ones from extension records"""
+
+        record = record if record is not None else self.__read_record(number)
+        if record is None:
+            return []
+
+        attributes = parse_attributes(record)
+        attribute_list = [x for x in attributes if x.type == ATTRIBUTE_LIST]
+        if not attribute_list:
+            return attributes
+
+        value = self.__value_of(attribute_list[0])
+        extensions = []
+        pos = 0
+        while pos + LIST_ENTRY.size <= len(value):
+            type, length, _, _, _, reference, _ = LIST_ENTRY.unpack_from(value, pos)
+            if length == 0:
+                break
+            extension = reference & 0xFFFFFFFFFFFF
+            if extension != number and extension not in extensions:
+                extensions.append(extension)
+            pos += length
+
+        for extension in extensions:
+            record = self.__read_record(extension)
+            if record is not None:
+                attributes.extend(parse_attributes(record))
+
+        return attributes
+
+    def __value_of(self, attribute: Attribute) -> bytes:
+        if attribute.value is not None:
+            return attribute.value
+        return self.__read_stream(attribute.runs, 0, attribute.size)
+
+    def __data_of(self, attributes: list, name: str = '') -> Attribute:
+        """
+        Unnamed $DATA, parts of non-resident one from extension records
+        are merged in order of their first VCN
+        """
+        parts = sorted((x for x in attributes if x.type == DATA and x.name == name), key=lambda x: x.start_vcn)
+        if not parts:
+            return None
+
+        data = parts[0]
+        if data.runs is None or len(parts) == 1:
+            return data
+
+        runs = [run for part in parts for run in part.runs]
+        return Attribute(DATA, name, data.flags, runs=runs, size=data.size)
+
+    def __entry(self, number: int, attributes: list, flags: int) -> tuple:
+        """Entry of record and number of its parent directory"""
+
+        created = modified = accessed = 0
+        name = short_name = ''
+        parent = None
+        for attribute in attributes:
+            if attribute.type == STANDARD_INFORMATION and attribute.value:
+                created, modified, _, accessed = struct.unpack_from('<QQQQ', attribute.value)
+            elif attribute.type == FILE_NAME_ATTR and attribute.value:
+                value_parent, name_value, namespace = self.__file_name(attribute.value)
+                if namespace == DOS_NAME:
+                    short_name = name_value
+                elif not name:
+                    name, parent = name_value, value_parent
+                if parent is None:
+                    parent = value_parent
+
+        data = self.__data_of(attributes)
+        entry = Entry(
+            attr       = DIR_ATTRIBUTE if flags & DIRECTORY else FILE_ATTRIBUTE,
+            name       = name or short_name,
+            short_name = short_name or name.upper(),
+            size       = data.size if data is not None and not flags & DIRECTORY else 0,
+            cluster    = number,
+            created    = filetime_to_fat(created),
+            modified   = filetime_to_fat(modified),
+            accessed   = filetime_to_fat(accessed) & 0xFFFF0000,
+            deleted    = not flags & IN_USE
+        )
+        return entry, parent
+
+    def __file_name(self, value: bytes) -> tuple:
+        """(parent record, name, namespace) of $FILE_NAME value"""
+
+        fields = FILE_NAME.unpack_from(value)
+        length, namespace = fields[-2], fields[-1]
+        name = value[FILE_NAME.size:FILE_NAME.size + 2*length].decode('utf-16-le', errors='replace')
+        return fields[0] & 0xFFFFFFFFFFFF, name, namespace
+
+    def __load_entry(self, number: int) -> Entry:
+        record = self.__read_record(number)
+        if record is None:
+            return None
+
+        flags = RECORD_HEADER.unpack_from(record)[7]
+        return self.__entry(number, self.__attributes(number, record), flags)[0]
+
+    def __index_entries(self, node: bytes, offset: int) -> list:
+        """(record, namespace, name) from entries of index node header at offset"""
+
+        entries_offset, total = struct.unpack_from('<II', node, offset)
+        pos, end = offset + entries_offset, min(offset + total, len(node))
+        found = []
+        while pos + INDEX_ENTRY.size <= end:
+            reference, length, stream_length, flags = INDEX_ENTRY.unpack_from(node, pos)
+            # last entry has no key, it only points to subnode
+            if flags & 0x02 or length == 0:
+                break
+            if stream_length >= FILE_NAME.size:
+                parent, name, namespace = self.__file_name(node[pos + 0x10:pos + 0x10 + stream_length])
+                found.append((reference & 0xFFFFFFFFFFFF, namespace, name))
+            pos += length
+
+        return found
+
+    @stats.timed('dir_parse')
+    def children(self, directory: Entry, show_deleted: bool = None) -> list:
+        """
+        Entries of directory from $I30 index. Index blocks are read one
+        after other instead of walking B-tree, result is sorted by name.
+        Deleted entries are taken from scan of MFT, see __deleted_children
+        """
+        found = []
+        if not directory.deleted:
+            attributes = self.__attributes(directory.cluster)
+            index = {x.type: x for x in attributes if x.name == '$I30'}
+
+            if INDEX_ROOT in index:
+                found.extend(self.__index_entries(index[INDEX_ROOT].value, 0x10))
+
+            if INDEX_ALLOCATION in index:
+                allocation = index[INDEX_ALLOCATION]
+                bitmap = self.__value_of(index[BITMAP]) if BITMAP in index else None
+                for block in range(allocation.size // self.index_size):
+                    if bitmap is not None and not bitmap[block // 8] >> (block % 8) & 1:
+                        continue
+                    node = bytearray(self.__read_stream(allocation.runs, block * self.index_size, self.index_size))
+                    if node[:4] != b'INDX' or not fixup(node):
+                        continue
+                    found.extend(self.__index_entries(node, 0x18))
+
+        # every file has one entry per name, DOS name is taken as 8.3 name
+        names = {}
+        short = {}
+        for number, namespace, name in found:
+            if number == directory.cluster:
+                continue
+            if namespace == DOS_NAME:
+                short[number] = name
+            elif number not in names:
+                names[number] = name
+            stats.count('entries')
+
+        entries = []
+        for number, name in names.items():
+            entry = self.__load_entry(number)
+            if entry is None or entry.deleted:
+                continue
+            entries.append(Entry(entry.attr, name, short.get(number, entry.short_name), entry.size, number,
+                                 entry.created, entry.modified, entry.accessed, entry.deleted))
+
+        entries.sort(key=lambda x: x.name.upper())
+        if self.show_deleted if show_deleted is None else show_deleted:
+            entries.extend(self.__deleted_children(directory.cluster))
+
+        stats.count('dirs_parsed')
+        return entries
+
+    def iter_records(self, deleted_only: bool = False):
+        """
+        Stream records of MFT by big chunks with fixups applied in batch,
+        yields (number, record). Only one chunk is kept in memory.
+        """
+        in_use = bytes(0 if x & IN_USE else 1 for x in range(256))
+        magic = bytes(1 if x == ord('F') else 0 for x in range(256))
+        size = self.record_size
+        step = max(SCAN_CHUNK // size, 1) * size
+
+        for offset in range(0, self.mft_size, step):
+            chunk = bytearray(self.__read_stream(self.mft_runs, offset, min(step, self.mft_size - offset)))
+            chunk = chunk[:len(chunk) - len(chunk) % size]
+            count = len(chunk) // size
+            first = offset // size
+
+            # pick records by flags and first byte of magic without loop in python
+            candidates = int.from_bytes(bytes(chunk[0::size]).translate(magic), 'little')
+            if deleted_only:
+                candidates &= int.from_bytes(bytes(chunk[0x16::size]).translate(in_use), 'little')
+            if not candidates:
+                continue
+
+            torn = fixup_records(chunk, size)
+            marks = candidates.to_bytes(count, 'little')
+            i = marks.find(1)
+            while i != -1:
+                record = chunk[i*size:(i + 1)*size]
+                if i not in torn and record[:4] == b'FILE':
+                    yield first + i, record
+                i = marks.find(1, i + 1)
+
+    @stats.timed('mft_scan')
+    def __scan_deleted(self) -> dict:
+        """Deleted base records grouped by parent directory, done once"""
+
+        if self.deleted_map is not None:
+            return self.deleted_map
+
+        self.deleted_map = {}
+        for number, record in self.iter_records(deleted_only=True):
+            header = RECORD_HEADER.unpack_from(record)
+            # extension records belong to other records
+            if header[10] & 0xFFFFFFFFFFFF:
+                continue
+            entry, parent = self.__entry(number, parse_attributes(record), header[7])
+            if parent is not None and entry.name:
+                self.deleted_map.setdefault(parent, []).append(entry)
+
+        return self.deleted_map
+
+    def __deleted_children(self, number: int) -> list:
+        return sorted(self.__scan_deleted().get(number, []), key=lambda x: x.name.upper())
+
+    def __root(self) -> Entry:
+        return Entry(DIR_ATTRIBUTE, '', '', 0, ROOT_RECORD)
+
+    def resolve(self, path: str, show_deleted: bool = None) -> Entry:
+        """
+        Find entry by full path, long and DOS names are accepted, case is ignored.
+        show_deleted overrides -d for one call, fs shared by threads is not changed.
+        """
+
+        entity = self.__root()
+        for part in [x for x in path.split('/') if x]:
+            if entity.type != 'd':
+                return None
+
+            part = part.casefold()
+            children = self.children(entity, show_deleted)
+            # deleted children are among them only with -d, scan of MFT is not done for typo in path
+            matches = [x for x in children if part in (x.name.casefold(), x.short_name.casefold())]
+            if not matches:
+                return None
+            # live entry wins over deleted one with same name
+            entity = min(matches, key=lambda x: x.deleted)
+
+        return entity
+
+    def resolve_many(self, paths: list) -> dict:
+        return {path: self.resolve(path) for path in paths}
+
+    def print_catalogs(self) -> None:
+        """List specified catalog"""
+
+        entity = self.resolve(self.catalog)
+        if entity is None:
+            print('[!] File or dir not exist')
+            exit(0)
+
+        if self.ndjson:
+            self.print_records(entity)
+            return
+
+        if self.json:
+            if entity.type != 'd':
+                print(json.dumps(entity.to_dict()))
+                return
+            children = self.__load_all(entity)
+            print(json.dumps([el.to_dict() for el in children]))
+            return
+
+        if self.extract:
+            if entity.type == 'd':
+                self.extract_directory(entity)
+            else:
+                self.__extract_entity(entity)
+            return
+
+        print('Listing:', self.catalog, end='\n\n')
+        for el in self.children(entity) if entity.type == 'd' else [entity]:
+            print(self.format_entity(el))
+        return
+
+    def __load_all(self, directory: Entry) -> list:
+        """Children of directory with whole subtree attached, for json dump"""
+
+        children = self.children(directory)
+        for el in children:
+            if el.type == 'd':
+                el.elements = self.__load_all(el)
+        return children
+
+    def __data_ranges(self, entity: Entry) -> tuple:
+        """(resident value, ranges of non-resident data) of entity"""
+
+        value, ranges, error = self.data_stream(entity)
+        if error is not None:
+            print(f'[!] Data of {entity.name} {error}')
+        return value, ranges
+
+    def data_stream(self, entity: Entry) -> tuple:
+        """(resident value, ranges, error) of unnamed data stream"""
+
+        data = self.__data_of(self.__attributes(entity.cluster))
+        if data is None:
+            return b'', [], None
+        # compressed and encrypted streams are stored transformed
+        if data.flags & 0x40FF:
+            return None, [], 'is compressed or encrypted, it is not supported'
+        if data.value is not None:
+            return data.value, [], None
+
+        ranges = self.byte_ranges(data.runs, data.size)
+        # extracted file is extended to its size with zeros
+        tail = entity.size - sum(length for _, length in ranges)
+        if tail > 0:
+            ranges.append((None, tail))
+        return None, ranges, None
+
+    def listing(self, path: str, show_deleted: bool = None) -> list:
+        """Records of directory children or of file itself, None when path not exist"""
+
+        entity = self.resolve(path, show_deleted)
+        if entity is None:
+            return None
+
+        prefix = '/' + '/'.join(x for x in path.split('/') if x)
+        if entity.type != 'd':
+            return [entity.to_record(prefix)]
+        prefix = '' if prefix == '/' else prefix
+        return [el.to_record(f'{prefix}/{el.name}') for el in self.children(entity, show_deleted)]
+
+    def print_hashes(self, algorithms: list) -> None:
+        """Manifest of digests of every file below path, runs are streamed into hash functions"""
+
+        entity = self.resolve(self.catalog or '/')
+        if entity is None:
+            print('[!] File or dir not exist')
+            exit(0)
+
+        prefix = '/' + '/'.join(x for x in (self.catalog or '').split('/') if x)
+        jobs = []
+        if entity.type != 'd':
+            jobs.append(self.__hash_job(prefix, entity))
+
+        stack = [('' if prefix == '/' else prefix, entity)] if entity.type == 'd' else []
+        seen = {entity.cluster}
+        while stack:
+            path, directory = stack.pop()
+            for el in self.children(directory):
+                full = path + '/' + el.name
+                if el.type != 'd':
+                    jobs.append(self.__hash_job(full, el))
+                elif el.cluster not in seen:
+                    seen.add(el.cluster)
+                    stack.append((full, el))
+
+        fmt = 'ndjson' if self.ndjson else 'json' if self.json else 'csv'
+        print_inventory(self.image, jobs, algorithms, self.workers, fmt)
+        return
+
+    def __hash_job(self, path: str, el: Entry) -> tuple:
+        """(record, resident value, ranges) of file for hashing"""
+
+        value, ranges, error = self.data_stream(el)
+        record = {'path': path, 'size': el.size, 'deleted': el.deleted, 'error': None}
+        if error is not None:
+            record['error'] = f'data {error}'
+        return record, value, ranges
+
+    @stats.timed('extract')
+    def __extract_entity(self, entity: Entry) -> None:
+        value, ranges = self.__data_ranges(entity)
+
+        if entity.size > 1024 or self.extract:
+            os.makedirs(self.output, exist_ok=True)
+            path = os.path.join(self.output, self.safe_name(entity.name))
+            with open(path, 'wb') as f:
+                self.__write_data(f.fileno(), value, ranges, entity.size)
+            print(f'File {entity.name} was save in {self.output}/')
+        else:
+            if value is None:
+                value = b''.join(bytes(length) if addr is None else self.image.read(addr, length)
+                                 for addr, length in ranges)
+            print(value)
+
+    def __write_data(self, fd: int, value: bytes, ranges: list, size: int) -> None:
+        if value is not None:
+            os.write(fd, value)
+            return
+
+        offset = 0
+        for addr, length in ranges:
+            if addr is not None:
+                os.lseek(fd, offset, os.SEEK_SET)
+                self.image.copy_to(fd, addr, length)
+            offset += length
+        # sparse tail is made by truncate
+        os.ftruncate(fd, size)
@@ -0,0 +1,182 @@
+# Partition tables of disk images: MBR with extended partitions and GPT
+import struct
+import uuid
+import zlib
+
+SECTOR = 512
+
+# status, CHS of first sector, type, CHS of last sector, first LBA, number of sectors
+MBR_ENTRY = struct.Struct('<B3sB3sII')
+
+# signature, revision, header size, crc32, reserved, current LBA, backup LBA,
+# first usable LBA, last usable LBA, disk GUID, entries LBA, entries count, entry size, entries crc32
+GPT_HEADER = struct.Struct('<8sIII4xQQQQ16sQIII')
+
+# type GUID, partition GUID, first LBA, last LBA, attributes, name
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+EXTENDED = {0x05, 0x0F, 0x85}
+PROTECTIVE = 0xEE
+
+MBR_TYPES = {
+    0x01: 'FAT12', 0x04: 'FAT16', 0x06: 'FAT16', 0x07: 'NTFS/exFAT', 0x0B: 'FAT32',
+    0x0C: 'FAT32 LBA', 0x0E: 'FAT16 LBA', 0x11: 'Hidden FAT12', 0x14: 'Hidden FAT16',
+    0x17: 'Hidden NTFS', 0x1B: 'Hidden FAT32', 0x1C: 'Hidden FAT32 LBA', 0x27: 'Windows RE',
+    0x82: 'Linux swap', 0x83: 'Linux', 0x8E: 'Linux LVM', 0xA5: 'FreeBSD', 0xEF: 'EFI System',
+}
+
+GPT_TYPES = {
+    'c12a7328-f81f-11d2-ba4b-00a0c93ec93b': 'EFI System',
+    'e3c9e316-0b5c-4db8-817d-f92df00215ae': 'Microsoft reserved',
+    'ebd0a0a2-b9e5-4433-87c0-68b6b72699c7': 'Basic data',
+    'de94bba4-06d1-4d40-a16a-bfd50179d6ac': 'Windows RE',
+    '0fc63daf-8483-4772-8e79-3d69d8477de4': 'Linux',
+    '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f': 'Linux swap',
+    '21686148-6449-6e6f-744e-656564454649': 'BIOS boot',
+}
+
+# broken chain of extended partitions must not loop forever
+MAX_LOGICAL = 128
+
+
+class Partition(object):
+    """Volume of disk, start and size are in bytes"""
+
+    __slots__ = ('number', 'scheme', 'type', 'start', 'size', 'name')
+
+    def __init__(self, number: int, scheme: str, type: str, start: int, size: int, name: str = ''):
+        self.number = number
+        self.scheme = scheme
+        self.type   = type
+        self.start  = start
+        self.size   = size
+        self.name   = name
+
+    @property
+    def volume(self) -> tuple:
+        """(offset, size) for open_image()"""
+        return self.start, self.size
+
+    def __str__(self) -> str:
+        name = f' "{self.name}"' if self.name else ''
+        return f'{self.number:2}  {self.scheme:3}  {self.type:20} start:{hex(self.start):>12}  ' \
+               f'size:{hex(self.size):>12}{name}'
+
+
+def filesystem_of(boot: bytes) -> str:
+    """'NTFS', 'FAT' or None by signatures of boot sector"""
+
+    if boot[0x03:0x07] == b'NTFS':
+        return 'NTFS'
+    if b'FAT' in boot[0x36:0x3B] or b'FAT' in boot[0x52:0x57]:
+        return 'FAT'
+    return None
+
+
+def read_partitions(image) -> list:
+    """
+    Partitions of disk image, empty list when image is one volume
+    without partition table. Numbers follow Linux: 1-4 are primary
+    MBR entries, logical ones start from 5, GPT entries from 1.
+    """
+    mbr = image.read(0, SECTOR)
+    if len(mbr) < SECTOR or mbr[510:512] != b'\x55\xAA' or filesystem_of(mbr):
+        return []
+
+    entries = [MBR_ENTRY.unpack_from(mbr, 0x1BE + 16*i) for i in range(4)]
+    # boot code of volume has no valid status bytes in place of table
+    if any(status not in (0x00, 0x80) for status, *_ in entries):
+        return []
+
+    if any(type == PROTECTIVE for _, _, type, _, _, _ in entries):
+        partitions = read_gpt(image)
+        if partitions is not None:
+            return partitions
+
+    partitions = []
+    for i, (_, _, type, _, first, count) in enumerate(entries):
+        if type == 0 or count == 0:
+            continue
+        if type in EXTENDED:
+            partitions.extend(read_logical(image, first))
+            continue
+        partitions.append(Partition(i + 1, 'MBR', MBR_TYPES.get(type, hex(type)), first * SECTOR, count * SECTOR))
+
+    return sorted(partitions, key=lambda x: x.number)
+
+
+def read_logical(image, extended: int) -> list:
+    """
+    Logical partitions from chain of EBRs. Start of logical partition
+    is relative to its EBR, link to next EBR to start of extended one.
+    """
+    partitions = []
+    ebr = extended
+    seen = set()
+    while ebr not in seen and len(partitions) < MAX_LOGICAL:
+        seen.add(ebr)
+        data = image.read(ebr * SECTOR, SECTOR)
+        if len(data) < SECTOR or data[510:512] != b'\x55\xAA':
+            break
+
+        _, _, type, _, first, count = MBR_ENTRY.unpack_from(data, 0x1BE)
+        if type != 0 and count != 0:
+            partitions.append(Partition(5 + len(partitions), 'MBR', MBR_TYPES.get(type, hex(type)),
+                                        (ebr + first) * SECTOR, count * SECTOR))
+
+        _, _, type, _, first, _ = MBR_ENTRY.unpack_from(data, 0x1CE)
+        if type not in EXTENDED or first == 0:
+            break
+        ebr = extended + first
+
+    return partitions
+
+
+def read_gpt(image) -> list:
+    """GPT partitions, backup header is used when primary is damaged. None if both are bad"""
+
+    for sector in (SECTOR, 4096):
+        header = gpt_header(image, sector, 1)
+        if header is None:
+            # backup header is in last sector of disk
+            header = gpt_header(image, sector, image.size // sector - 1)
+        if header is not None:
+            break
+    else:
+        return None
+
+    entries_lba, count, entry_size, entries_crc = header[9:13]
+    table = image.read(entries_lba * sector, count * entry_size)
+    if entry_size < GPT_ENTRY.size or len(table) < count * entry_size or zlib.crc32(table) != entries_crc:
+        return None
+
+    partitions = []
+    for i in range(count):
+        type, _, first, last, _, name = GPT_ENTRY.unpack_from(table, i * entry_size)
+        if type == bytes(16) or last < first:
+            continue
+        guid = str(uuid.UUID(bytes_le=type))
+        name = name.decode('utf-16-le', errors='replace').split('\x00')[0]
+        partitions.append(Partition(i + 1, 'GPT', GPT_TYPES.get(guid, guid), first * sector,
+                                    (last - first + 1) * sector, name))
+
+    return partitions
+
+
+def gpt_header(image, sector: int, lba: int) -> tuple:
+    """Fields of GPT header at lba or None when signature or crc32 is wrong"""
+
+    data = image.read(lba * sector, sector)
+    if len(data) < GPT_HEADER.size or data[:8] != b'EFI PART':
+        return None
+
+    header = GPT_HEADER.unpack_from(data)
+    size = header[2]
+    if not GPT_HEADER.size <= size <= sector:
+        return None
+    # crc32 of header is counted with its own field zeroed
+    raw = bytearray(data[:size])
+    raw[16:20] = bytes(4)
+    if zlib.crc32(raw) != header[3]:
+        return None
+    return header
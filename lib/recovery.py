@@ -0,0 +1,111 @@
+# Recovery of deleted files and carving of unallocated clusters
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.image import open_image
+
+# extension, header, footer, bytes after footer, max size of file
+SIGNATURES = [
+    ('jpg', b'\xff\xd8\xff',       b'\xff\xd9',           0,  32 << 20),
+    ('png', b'\x89PNG\r\n\x1a\n',  b'IEND\xaeB`\x82',     0,  32 << 20),
+    ('gif', b'GIF87a',             b'\x00\x3b',           0,  16 << 20),
+    ('gif', b'GIF89a',             b'\x00\x3b',           0,  16 << 20),
+    ('pdf', b'%PDF-',              b'%%EOF',              0, 128 << 20),
+    ('zip', b'PK\x03\x04',         b'PK\x05\x06',        18, 128 << 20),
+]
+
+# first bytes of headers, used to pick candidate clusters with one regex pass
+HEAD_BYTES = re.compile(b'[' + b''.join(re.escape(bytes([x])) for x in {sig[1][0] for sig in SIGNATURES}) + b']')
+
+# clusters scanned by one job of carver
+CHUNK_SIZE = 64 << 20
+
+
+def recover_clusters(first: int, count: int, bitmap: bytearray) -> list:
+    """
+    Guess clusters of deleted file. Delete zeroes its chain in FAT, so
+    free clusters are taken from first one forward, allocated are skipped.
+    Empty list means first cluster is in use and data is overwritten.
+    """
+    if not 2 <= first < len(bitmap) or not bitmap[first]:
+        return []
+
+    clusters = []
+    cluster = first
+    while len(clusters) < count and cluster < len(bitmap):
+        if bitmap[cluster]:
+            clusters.append(cluster)
+        cluster += 1
+
+    return clusters
+
+
+def scan_chunk(source: tuple, data_addr: int, cluster_size: int, chunk: tuple) -> list:
+    """
+    Job of carver, look for headers at starts of free clusters
+    from chunk (first, count, end of free run) and for footers up to end
+    of free run. Returns (address, length, extension) of found files.
+    """
+    first, count, end = chunk
+    limit = data_addr + cluster_size * (end - 2)
+    found = []
+
+    with open_image(*source) as image:
+        base = data_addr + cluster_size * (first - 2)
+        heads = bytes(image.view(base, count * cluster_size)[::cluster_size])
+
+        for match in HEAD_BYTES.finditer(heads):
+            addr = base + match.start() * cluster_size
+            head = image.read(addr, 16)
+
+            for ext, header, footer, tail, max_size in SIGNATURES:
+                if not head.startswith(header):
+                    continue
+
+                stop = min(addr + max_size, limit)
+                pos = image.find(footer, addr + len(header), stop)
+                if pos == -1:
+                    # footer is lost, keep everything up to end of free run
+                    length = stop - addr
+                else:
+                    length = min(pos + len(footer) + tail, stop) - addr
+                found.append((addr, length, ext))
+                break
+
+    return found
+
+
+def free_chunks(runs: list, cluster_size: int) -> list:
+    """Split free runs (start, length) into jobs (first, count, end of run)"""
+
+    step = max(CHUNK_SIZE // cluster_size, 1)
+    chunks = []
+    for start, length in runs:
+        for first in range(start, start + length, step):
+            chunks.append((first, min(step, start + length - first), start + length))
+
+    return chunks
+
+
+def carve(source: tuple, data_addr: int, cluster_size: int, runs: list, workers: int = 1) -> list:
+    """
+    Scan free runs with pool of processes, every worker maps image by itself,
+    so pages are shared through page cache instead of pickled. Results are
+    sorted by address, headers inside already carved file are dropped.
+    """
+    chunks = free_chunks(runs, cluster_size)
+    if workers <= 1 or len(chunks) <= 1:
+        results = [scan_chunk(source, data_addr, cluster_size, chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(scan_chunk, *zip(*[(source, data_addr, cluster_size, chunk) for chunk in chunks])))
+
+    files = []
+    end = 0
+    for addr, length, ext in sorted(x for result in results for x in result):
+        if addr < end:
+            continue
+        files.append((addr, length, ext))
+        end = addr + length
+
+    return files
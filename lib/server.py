@@ -0,0 +1,387 @@
+# Resident query service: images are opened once, requests come as json lines over socket
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import signal
+import stat
+import sys
+import threading
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.batch import expand_images
+from lib.cache import LRUCache
+from lib.image import open_image
+from lib.inventory import ALGORITHMS, hash_stream
+from lib.partition import read_partitions
+from lib.util import open_filesystem
+
+# file bigger than this is extracted only to target on host, not inline
+INLINE_LIMIT = 1 << 20
+
+# directory listings kept ready for repeated requests
+LISTINGS     = 4096
+
+# tcp addresses served without --allow-remote
+LOOPBACK     = ('', 'localhost', '127.0.0.1', '::1', '[::1]')
+
+
+class RequestError(Exception):
+    """Request can't be answered, message is sent to client"""
+
+
+class Volume(object):
+    """
+    Opened file system with lock for parsing and caches of it. Reads of
+    file data go without lock, users counts requests which still read.
+    """
+
+    __slots__ = ('fs', 'lock', 'users', 'evicted', 'closed')
+
+    def __init__(self, fs):
+        self.fs      = fs
+        self.lock    = threading.Lock()
+        self.users   = 0
+        self.evicted = False
+        self.closed  = False
+
+
+class Server(object):
+    """
+    Answers list, stat, extract, hash and info requests for images given at start.
+    Parsed volumes and directory listings live in bounded LRU caches,
+    blocking work runs in pool of threads while event loop serves sockets.
+    """
+
+    def __init__(self, args):
+        self.args     = args
+        self.images   = expand_images(args.batch) if args.batch else [args.file]
+        self.output   = os.path.realpath(getattr(args, 'output', None) or 'extracted')
+        self.volumes  = LRUCache(args.cache, self.__close)
+        self.listings = LRUCache(LISTINGS)
+        self.opening  = threading.Lock()
+        self.pool     = ThreadPoolExecutor(max_workers=args.workers or os.cpu_count() or 1)
+
+    def __close(self, volume: Volume) -> None:
+        """Evicted volume is closed when the last request which reads it ends"""
+
+        with volume.lock:
+            volume.evicted = True
+            if not volume.users:
+                volume.closed = True
+                volume.fs.image.close()
+
+    def image_of(self, name: str) -> str:
+        """
+        Image from request by path given at start, or by its file name
+        when only one served image has it
+        """
+        if name is None:
+            if len(self.images) != 1:
+                raise RequestError('Choose image, server has ' + str(len(self.images)))
+            return self.images[0]
+        for image in self.images:
+            if name == image or os.path.abspath(name) == os.path.abspath(image):
+                return image
+
+        found = [x for x in self.images if os.path.basename(x) == name]
+        if len(found) > 1:
+            raise RequestError(f'Image name {name} is ambiguous, give its path')
+        if not found:
+            raise RequestError(f'Image {name} is not served')
+        return found[0]
+
+    def target_of(self, target: str) -> str:
+        """Path on host for extracted file, only relative paths below output directory are accepted"""
+
+        if type(target) != str or not target or os.path.isabs(target) or \
+                '..' in target.replace('\\', '/').split('/') or '\x00' in target:
+            raise RequestError('Target must be relative path without ..')
+
+        path = os.path.realpath(os.path.join(self.output, target))
+        if os.path.commonpath([path, self.output]) != self.output or path == self.output:
+            raise RequestError('Target is outside of output directory')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def volume(self, image: str, partition) -> Volume:
+        """Opened file system of image or its partition, opened once and cached"""
+
+        partition = None if partition is None else str(partition)
+        key = (image, partition)
+        volume = self.volumes.get(key)
+        if volume is not None:
+            return volume
+
+        with self.opening:
+            volume = self.volumes.get(key)
+            if volume is None:
+                volume = Volume(self.__open(image, partition))
+                self.volumes.put(key, volume)
+                self.listings.drop(lambda x: x[:2] == key)
+        return volume
+
+    def __open(self, image: str, partition: str):
+        args = Namespace(**vars(self.args))
+        args.file      = image
+        args.batch     = None
+        args.list      = '/'
+        args.json      = True
+        args.ndjson    = False
+        args.extract   = False
+        args.deleted   = False
+        args.write     = None
+        args.volume    = None
+        args.partition = partition
+
+        with open_image(image, args.backend) as data:
+            partitions = read_partitions(data)
+        if partitions:
+            chosen = [x for x in partitions if str(x.number) == partition]
+            if not chosen:
+                raise RequestError(f'Partition {partition} not found' if partition else
+                                   'Image has partition table, choose partition')
+            args.volume = chosen[0].volume
+        elif partition is not None:
+            raise RequestError('Image has no partition table')
+
+        try:
+            fs = open_filesystem(args)
+        except SystemExit:
+            raise RequestError('Unknown file system')
+        # first listing decodes FAT and root directory
+        fs.listing('/')
+        return fs
+
+    def handle(self, request: dict):
+        """Answer one request, runs in thread of pool"""
+
+        op = request.get('op')
+        if op == 'images':
+            return self.images
+        if op == 'stats':
+            return {'volumes': len(self.volumes.items), 'volume_hits': self.volumes.hits,
+                    'listings': len(self.listings.items), 'listing_hits': self.listings.hits,
+                    'listing_misses': self.listings.misses}
+
+        image = self.image_of(request.get('image'))
+        if op == 'partitions':
+            with open_image(image, self.args.backend) as data:
+                return [{'number': x.number, 'scheme': x.scheme, 'type': x.type, 'start': x.start,
+                         'size': x.size, 'name': x.name} for x in read_partitions(data)]
+
+        partition = request.get('partition', self.args.partition)
+        path = request.get('path', '/')
+        deleted = bool(request.get('deleted', False))
+        if op == 'list':
+            key = (image, None if partition is None else str(partition), path, deleted)
+            records = self.listings.get(key)
+            if records is None:
+                records = self.__with_volume(image, partition, lambda fs: fs.listing(path, deleted))
+                if records is None:
+                    raise RequestError('File or dir not exist')
+                self.listings.put(key, records)
+            return records
+
+        if op == 'info':
+            return self.__with_volume(image, partition, lambda fs: fs.info())
+        if op == 'stat':
+            return self.__with_volume(image, partition, lambda fs: self.__stat(fs, path, deleted))
+        if op == 'hash':
+            algorithms = request.get('algorithms', list(ALGORITHMS))
+            if type(algorithms) == str:
+                algorithms = [x.strip() for x in algorithms.split(',') if x.strip()]
+            unknown = [x for x in algorithms if x not in hashlib.algorithms_available]
+            if unknown or not algorithms:
+                raise RequestError(f'Unknown hash function {", ".join(unknown)}')
+            return self.__with_volume(image, partition, lambda fs: self.__file(fs, path, deleted),
+                                      lambda fs, found: self.__hash(fs, found, algorithms))
+        if op == 'extract':
+            target = request.get('target')
+            if target is not None:
+                target = self.target_of(target)
+            return self.__with_volume(image, partition, lambda fs: self.__file(fs, path, deleted),
+                                      lambda fs, found: self.__extract(fs, found, target))
+
+        raise RequestError(f'Unknown operation {op}')
+
+    def __with_volume(self, image: str, partition, parse, read=None):
+        """
+        parse(fs) works with metadata and caches of volume under its lock,
+        read(fs, parsed) streams file data in parallel with other requests
+        """
+        while True:
+            volume = self.volume(image, partition)
+            with volume.lock:
+                # volume was evicted and closed after it was taken from cache
+                if volume.closed:
+                    continue
+                found = parse(volume.fs)
+                if read is None:
+                    return found
+                volume.users += 1
+            break
+
+        try:
+            return read(volume.fs, found)
+        finally:
+            with volume.lock:
+                volume.users -= 1
+                if volume.evicted and not volume.users:
+                    volume.closed = True
+                    volume.fs.image.close()
+
+    def __file(self, fs, path: str, deleted: bool) -> tuple:
+        """(path, entity, resident value, ranges) of file, data itself is not read"""
+
+        entity = fs.resolve(path, deleted)
+        if entity is None:
+            raise RequestError('File or dir not exist')
+        if type(entity) == list or entity.type == 'd':
+            raise RequestError(f'{path} is directory')
+        value, ranges, error = fs.data_stream(entity)
+        if error is not None:
+            raise RequestError(error)
+        return path, entity, value, ranges
+
+    def __stat(self, fs, path: str, deleted: bool) -> dict:
+        entity = fs.resolve(path, deleted)
+        if entity is None:
+            raise RequestError('File or dir not exist')
+        if type(entity) == list:
+            return {'path': '/', 'type': 'd'}
+        return entity.to_record('/' + '/'.join(x for x in path.split('/') if x))
+
+    def __hash(self, fs, found: tuple, algorithms: list) -> dict:
+        path, entity, value, ranges = found
+        return {'path': path, 'size': entity.size, **hash_stream(fs.image, value, ranges, algorithms)}
+
+    def __extract(self, fs, found: tuple, target: str) -> dict:
+        """Data of file inline as base64 or written to target below output directory"""
+
+        path, entity, value, ranges = found
+
+        if target is None:
+            if entity.size > INLINE_LIMIT:
+                raise RequestError(f'File is bigger than {INLINE_LIMIT} bytes, give target for it')
+            data = value if value is not None else \
+                b''.join(bytes(length) if addr is None else fs.image.read(addr, length) for addr, length in ranges)
+            return {'path': path, 'size': entity.size, 'data': base64.b64encode(data).decode()}
+
+        # symlink put in place of target after check is not followed
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0), 0o644)
+        try:
+            if value is not None:
+                os.write(fd, value)
+            offset = 0
+            for addr, length in ranges:
+                if addr is not None:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    fs.image.copy_to(fd, addr, length)
+                offset += length
+            if value is None:
+                os.ftruncate(fd, entity.size)
+        finally:
+            os.close(fd)
+        return {'path': path, 'size': entity.size, 'target': os.path.relpath(target, self.output)}
+
+    async def client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Requests of one connection run concurrently, every response
+        carries id of its request and goes as soon as it is ready.
+        """
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(self.answer(line, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, line: bytes, writer: asyncio.StreamWriter, lock: asyncio.Lock) -> None:
+        started = time.perf_counter()
+        request = {}
+        try:
+            request = json.loads(line)
+            if type(request) != dict:
+                raise RequestError('Request must be json object')
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, self.handle, request)
+            response = {'id': request.get('id'), 'ok': True, 'result': result}
+        except RequestError as e:
+            response = {'id': request.get('id'), 'ok': False, 'error': str(e)}
+        except SystemExit:
+            response = {'id': request.get('id'), 'ok': False, 'error': 'Request failed'}
+        except Exception as e:
+            response = {'id': request.get('id'), 'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        response['seconds'] = round(time.perf_counter() - started, 6)
+
+        async with lock:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+    async def serve(self, address: str) -> None:
+        """Listen on unix socket path or on host:port"""
+
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.client, host or '127.0.0.1', int(port))
+        else:
+            # socket left by previous run
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+            server = await asyncio.start_unix_server(self.client, address)
+
+        # stop on Ctrl-C and on kill, socket file is removed by serve()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, server.close)
+
+        print(f'[*] Serving {len(self.images)} images on {address}', file=sys.stderr, flush=True)
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+
+def serve(args) -> None:
+    """Open images once and answer json lines requests until interrupted"""
+
+    server = Server(args)
+    if args.write or args.import_dir or args.mkdir:
+        print('[!] Writing is not supported in server mode')
+        exit(0)
+    if ':' in args.serve and args.serve.rsplit(':', 1)[0] not in LOOPBACK and not args.allow_remote:
+        # requests are not authenticated, anyone who reaches port reads images
+        print('[!] Server listens only on loopback address, use --allow-remote for other hosts')
+        exit(0)
+
+    # images without partition table are opened at start
+    for image in server.images:
+        try:
+            server.volume(image, args.partition)
+        except RequestError as e:
+            print(f'[!] {image}: {e}', file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve(args.serve))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown(wait=False, cancel_futures=True)
+        if ':' not in args.serve and os.path.exists(args.serve):
+            os.unlink(args.serve)
@@ -0,0 +1,156 @@
+# Instrumentation of phases and I/O, enabled by --stats
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+
+class Stats(object):
+    """
+    Wall and CPU time of phases and counters of work. It is disabled
+    by default, then timed() and count() cost one attribute check.
+    Phases may be nested, e.g. extraction includes parsing of directories.
+    """
+
+    def __init__(self):
+        self.enabled  = False
+        self.phases   = {}
+        self.counters = {}
+        self.lock     = threading.Lock()
+        self.started  = None
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.started = (time.perf_counter(), time.process_time())
+
+    def reset(self) -> None:
+        """Drop collected numbers, worker of batch reports every image apart"""
+
+        with self.lock:
+            self.phases   = {}
+            self.counters = {}
+        self.started = (time.perf_counter(), time.process_time())
+
+    def count(self, name: str, value: int = 1) -> None:
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_phase(self, name: str, wall: float, cpu: float) -> None:
+        with self.lock:
+            phase = self.phases.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            phase['calls'] += 1
+            phase['wall'] += wall
+            phase['cpu'] += cpu
+
+    def timed(self, name: str):
+        """Decorator, adds time of every call of function to phase"""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+
+                wall, cpu = time.perf_counter(), time.process_time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add_phase(name, time.perf_counter() - wall, time.process_time() - cpu)
+            return wrapper
+        return decorator
+
+    def report(self) -> dict:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        report = {
+            'wall': time.perf_counter() - self.started[0],
+            'cpu': time.process_time() - self.started[1],
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            'peak_rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+            'phases': self.phases,
+            'counters': self.counters,
+        }
+        if tracemalloc.is_tracing():
+            report['peak_traced'] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def print_report(self, fmt: str = 'text') -> None:
+        report = self.report()
+        if fmt == 'json':
+            print(json.dumps(report), file=sys.stderr)
+            return
+
+        out = f"[*] Total: wall {report['wall']:.4f}s, cpu {report['cpu']:.4f}s, " \
+              f"peak RSS {report['peak_rss'] / 2**20:.1f} MiB"
+        if 'peak_traced' in report:
+            out += f", peak traced {report['peak_traced'] / 2**20:.1f} MiB"
+        for name, phase in sorted(report['phases'].items(), key=lambda x: -x[1]['wall']):
+            out += f"\n    {name:12} wall {phase['wall']:9.4f}s  cpu {phase['cpu']:9.4f}s  calls {phase['calls']}"
+        for name, value in sorted(report['counters'].items()):
+            out += f'\n    {name:16} {value}'
+        print(out, file=sys.stderr)
+
+
+class CountingImage(object):
+    """Proxy of image backend which counts bytes moved through it"""
+
+    def __init__(self, image, stats: Stats):
+        self.image = image
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.image, name)
+
+    def read(self, offset: int, size: int) -> bytes:
+        data = self.image.read(offset, size)
+        self.stats.count('bytes_read', len(data))
+        return data
+
+    def view(self, offset: int, size: int):
+        data = self.image.view(offset, size)
+        self.stats.count('bytes_read', len(data))
+        return data
+
+    def write(self, offset: int, data: bytes) -> None:
+        self.image.write(offset, data)
+        self.stats.count('bytes_written', len(data))
+
+    def copy_to(self, fd: int, offset: int, size: int) -> int:
+        done = self.image.copy_to(fd, offset, size)
+        self.stats.count('bytes_copied', done)
+        return done
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.image.close()
+
+
+# one collector for process, FAT reports into it
+stats = Stats()
+
+
+def run_with_stats(func, args, fmt: str = 'text', profile: str = None) -> None:
+    """Run command under instrumentation, report is printed even on exit()"""
+
+    stats.enable()
+    if profile == 'tracemalloc':
+        tracemalloc.start()
+    profiler = cProfile.Profile() if profile == 'cprofile' else None
+
+    try:
+        if profiler is not None:
+            profiler.runcall(func, args)
+        else:
+            func(args)
+    finally:
+        sys.stdout.flush()
+        stats.print_report(fmt)
+        if profiler is not None:
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
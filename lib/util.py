@@ -1,25 +1,147 @@
+from argparse import Namespace
+
+from lib.diff import print_diff
 from lib.fat import *
+from lib.importer import import_tree, make_directory, write_file as import_file
+from lib.inventory import parse_algorithms
+from lib.layout import print_check, print_extents
+from lib.ntfs import NTFS
+from lib.partition import filesystem_of, read_partitions
+
+
+def open_filesystem(args):
+    """FAT or NTFS object for image or its partition, chosen by boot sector"""
+
+    with open_image(args.file, getattr(args, 'backend', None), volume=getattr(args, 'volume', None)) as image:
+        fs = filesystem_of(image.read(0, 0x200))
+
+    if fs == 'NTFS':
+        return NTFS(args)
+    elif fs == 'FAT':
+        return FAT(args)
+
+    print('[!] Unknown file system')
+    exit(0)
+
+
+def open_fat(args):
+    """Operations which change image or scan clusters are only for FAT"""
+
+    obj = open_filesystem(args)
+    if type(obj) != FAT:
+        print('[!] This operation is supported only for FAT')
+        exit(0)
+    return obj
+
+
+def for_each_volume(args, func, many: bool = True) -> None:
+    """
+    Run func(args) on volume chosen by --partition, with `all` on every
+    partition in turn. Partition is opened as view over image, nothing is copied.
+    """
+    with open_image(args.file, getattr(args, 'backend', None)) as image:
+        partitions = read_partitions(image)
+        known = {x.number for x in partitions if filesystem_of(image.read(x.start, 0x200))}
+
+    choice = getattr(args, 'partition', None)
+    if not partitions:
+        # `all` of volume without partition table is volume itself
+        if choice not in (None, 'all'):
+            print('[!] Image has no partition table')
+            exit(0)
+        return func(args)
+
+    if choice is None:
+        print('Таблица разделов\n')
+        for partition in partitions:
+            print(partition)
+        print('\n[!] Choose volume with --partition N or --partition all')
+        exit(0)
+
+    if choice == 'all':
+        if not many:
+            print('[!] Choose one partition for this operation')
+            exit(0)
+        chosen = partitions
+    else:
+        chosen = [x for x in partitions if str(x.number) == choice]
+        if not chosen:
+            print(f'[!] Partition {choice} not found')
+            exit(0)
+
+    if len(chosen) == 1:
+        args.volume = chosen[0].volume
+        return func(args)
+
+    # every partition gets own directory for extracted files,
+    # headers go to stderr for json and csv output to stay parsable
+    out = sys.stderr if args.json or getattr(args, 'ndjson', False) or getattr(args, 'hash', None) else sys.stdout
+    output = getattr(args, 'output', None) or 'extracted'
+    for partition in chosen:
+        if partition.number not in known:
+            print(f'[*] Partition {partition} is skipped, unknown file system', file=out, flush=True)
+            continue
+        print(f'[*] Partition {partition}', file=out, flush=True)
+        args.volume = partition.volume
+        args.output = os.path.join(output, f'partition{partition.number}')
+        try:
+            func(args)
+        except SystemExit:
+            # methods end with exit(), it must not stop other partitions
+            pass
+        sys.stdout.flush()
 
 
 def get_info_about_filesystem(args) -> None:
-    with open(args.file, 'rb') as f:
-        data = f.read(64)
-    
-    name = data[0x36:0x3B]
-    if b'NTFS' in name:
-        name = data[0x03:0x7]
-        # ntfs.print_info(filename)
-    elif b'FAT' in name:
-        FAT(args).print_info()
-    
+    for_each_volume(args, lambda args: open_filesystem(args).print_info())
+
 
 def get_info_about_catalogs(args) -> None:
-    obj = FAT(args)
-    obj.print_catalogs()
+    for_each_volume(args, lambda args: open_filesystem(args).print_catalogs())
+
+def resolve_manifest(args) -> None:
+    for_each_volume(args, lambda args: open_filesystem(args).print_manifest(args.manifest))
+
+def carve_files(args) -> None:
+    for_each_volume(args, lambda args: open_fat(args).carve_files())
+
+def hash_files(args) -> None:
+    algorithms = parse_algorithms(args.hash)
+    for_each_volume(args, lambda args: open_filesystem(args).print_hashes(algorithms))
+
+def print_extent_map(args) -> None:
+    for_each_volume(args, lambda args: print_extents(open_fat(args)))
+
+def check_volume(args) -> None:
+    for_each_volume(args, lambda args: print_check(open_fat(args)))
+
+def snapshot_of(args) -> Namespace:
+    """Arguments for image given by --diff, partition is taken with same number"""
+
+    other = Namespace(**vars(args))
+    other.file = args.diff
+    other.volume = None
+    # explicit index file belongs to first image
+    if getattr(args, 'index', None):
+        other.index = ''
+
+    if getattr(args, 'volume', None) is not None:
+        with open_image(args.diff, getattr(args, 'backend', None)) as image:
+            chosen = [x for x in read_partitions(image) if str(x.number) == args.partition]
+        if not chosen:
+            print(f'[!] Partition {args.partition} not found in {args.diff}')
+            exit(0)
+        other.volume = chosen[0].volume
+    return other
+
+def diff_snapshots(args) -> None:
+    for_each_volume(args, lambda args: print_diff(open_fat(args), open_fat(snapshot_of(args))), many=False)
 
 def write_file(args) -> None:
-    obj = FAT(args)
-    obj.write_file()
+    for_each_volume(args, lambda args: import_file(open_fat(args)), many=False)
+
+def import_directory(args) -> None:
+    for_each_volume(args, lambda args: import_tree(open_fat(args), args.import_dir, args.list or '/'), many=False)
 
 def create_directory(args) -> None:
-    print('To be continued...')
+    for_each_volume(args, lambda args: make_directory(open_fat(args), args.mkdir), many=False)
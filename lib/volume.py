@@ -0,0 +1,188 @@
+# Output and extraction shared by FAT and NTFS parsers
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.entry import Entry
+from lib.stats import stats
+
+
+class FileSystem(object):
+    """
+    Base of FAT and NTFS. Subclass gives resolve(), resolve_many(),
+    children() and data_stream(), ADDRESS names place of entry in listing.
+    Root found by resolve() may be list of entries instead of Entry.
+    """
+
+    ADDRESS = 'Cluster'
+
+    def __init__(self, args):
+        self.catalog          = args.list
+        self.json             = args.json
+        self.ndjson           = getattr(args, 'ndjson', False)
+        self.extract          = args.extract
+        self.show_deleted     = args.deleted
+        self.workers          = getattr(args, 'workers', None) or os.cpu_count() or 1
+        self.output           = getattr(args, 'output', None) or 'extracted'
+
+    def children(self, directory) -> list:
+        """Entries of directory, parsed directory is not kept by walks"""
+        raise NotImplementedError
+
+    def print_manifest(self, filename: str) -> None:
+        """Resolve every path from manifest file, one path per line"""
+
+        with open(filename, 'r') as f:
+            paths = [line.strip() for line in f if line.strip()]
+
+        found = self.resolve_many(paths)
+        if self.json:
+            print(json.dumps({path: self.__to_dict(entity) for path, entity in found.items()}))
+            return
+
+        for path, entity in found.items():
+            if entity is None:
+                print(f'[!] {path} not exist')
+            elif type(entity) == list:
+                print(f'{path} d')
+            else:
+                print(f'{path} {self.format_entity(entity)}')
+
+    def __to_dict(self, entity):
+        """Entity without its children for compact output"""
+
+        if type(entity) == list:
+            return {'Type': 'd', 'Name': '/'}
+        return None if entity is None else entity.to_dict(recursive=False)
+
+    def format_entity(self, el: Entry) -> str:
+        """One line of listing for entity"""
+
+        directory = '/' if el.type == 'd' else ''
+        isdeleted = ' (File deleted)' if el.deleted else ''
+        return f"{el.type} {el.create_time} {el.name}{directory} ({el.short_name}) {self.ADDRESS}:{hex(el.cluster)} Size:{el.size}{isdeleted}"
+
+    def walk(self, directory, prefix: str, skip_labels: bool = False):
+        """
+        Yield (path, entity) for every entity below directory, parent goes
+        before children. Directories seen once are not entered again.
+        """
+        stack = [(prefix, directory)]
+        seen = {getattr(directory, 'cluster', 0)}
+        while stack:
+            path, directory = stack.pop()
+            subdirs = []
+            for el in self.children(directory):
+                if el.name == '.' or el.name == '..':
+                    continue
+                if el.deleted and not self.show_deleted or skip_labels and el.type == '?':
+                    continue
+
+                full = path + '/' + el.name
+                yield full, el
+                if el.type == 'd' and el.cluster not in seen:
+                    seen.add(el.cluster)
+                    subdirs.append((full, el))
+
+            # keep order of entries in output
+            stack.extend(reversed(subdirs))
+
+    def print_records(self, entity) -> None:
+        """
+        Print one json line per entity below path as directories are parsed.
+        Parsed directories are not kept in tree, memory doesn't grow with volume.
+        """
+        if entity is None:
+            print('[!] File or dir not exist')
+            exit(0)
+
+        prefix = '/' + '/'.join(x for x in self.catalog.split('/') if x)
+        if type(entity) == Entry and entity.type != 'd':
+            print(json.dumps(entity.to_record(prefix)))
+            return
+
+        try:
+            for path, el in self.walk(entity, '' if prefix == '/' else prefix):
+                sys.stdout.write(json.dumps(el.to_record(path)) + '\n')
+        except BrokenPipeError:
+            # reader like head closed pipe, drop rest of output quietly
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+    @stats.timed('extract')
+    def extract_directory(self, entity) -> None:
+        """Rebuild directory subtree in extracted/ with pool of workers"""
+
+        prefix = os.path.join(self.output, *[self.safe_name(x) for x in self.catalog.split('/') if x])
+        os.makedirs(prefix, exist_ok=True)
+
+        # every job copies one extent, jobs are sorted by address on disk
+        jobs = []
+        files = 0
+        # host path of every directory, parent is walked before its children
+        hosts = {'': prefix}
+        for path, el in self.walk(entity, '', skip_labels=True):
+            target = os.path.join(hosts[path[:-len(el.name) - 1]], self.safe_name(el.name))
+            if el.type == 'd':
+                os.makedirs(target, exist_ok=True)
+                hosts[path] = target
+                continue
+
+            value, ranges, error = self.data_stream(el)
+            if error is not None:
+                print(f'[!] Data of {el.name} {error}')
+            with open(target, 'wb') as f:
+                # resident data is written at once, sparse parts are made by truncate
+                if value is not None:
+                    f.write(value)
+                else:
+                    f.truncate(sum(length for _, length in ranges))
+            offset = 0
+            for addr, length in ranges:
+                if addr is not None:
+                    jobs.append((addr, length, target, offset))
+                offset += length
+            files += 1
+
+        jobs.sort()
+        total = sum(job[1] for job in jobs)
+        progress = {'jobs': 0, 'bytes': 0, 'time': 0}
+        lock = threading.Lock()
+
+        def copy_extent(job):
+            addr, length, path, offset = job
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                self.image.copy_to(fd, addr, length)
+            finally:
+                os.close(fd)
+
+            with lock:
+                progress['jobs'] += 1
+                progress['bytes'] += length
+                now = time.monotonic()
+                if now - progress['time'] > 0.5 or progress['jobs'] == len(jobs):
+                    progress['time'] = now
+                    print(f"\r[*] Extents {progress['jobs']}/{len(jobs)}, "
+                          f"{progress['bytes'] / 2**20:.1f}/{total / 2**20:.1f} MiB",
+                          end='', file=sys.stderr, flush=True)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for _ in pool.map(copy_extent, jobs):
+                pass
+
+        if jobs:
+            print(file=sys.stderr)
+        print(f'Directory {prefix} was save with {files} files')
+
+    @staticmethod
+    def safe_name(name: str) -> str:
+        """Don't allow names from image to escape extracted/"""
+
+        name = name.replace('/', '_').replace('\\', '_').replace('\x00', '')
+        if name in ('', '.', '..'):
+            return '_'
+        return name
@@ -1,10 +1,49 @@
 import argparse
 import sys
 
+from lib.batch import run_batch
+from lib.server import serve
+from lib.stats import run_with_stats
 from lib.util import *
 
 
 def main(args):
+    if args.serve:
+        serve(args)
+        exit(0)
+
+    if args.batch:
+        run_batch(args)
+        exit(0)
+
+    if args.manifest:
+        resolve_manifest(args)
+        exit(0)
+
+    if args.carve:
+        carve_files(args)
+        exit(0)
+
+    if args.hash:
+        hash_files(args)
+        exit(0)
+
+    if args.diff:
+        diff_snapshots(args)
+        exit(0)
+
+    if args.extents:
+        print_extent_map(args)
+        exit(0)
+
+    if args.check:
+        check_volume(args)
+        exit(0)
+
+    if args.import_dir:
+        import_directory(args)
+        exit(0)
+
     if args.list:
         get_info_about_catalogs(args)
         exit(0)
@@ -31,9 +70,63 @@ python3 main.py -f testfile.img -l /
 Print info about files in catalog:
 python3 main.py -f testfile.img -l /somecatalog/
 
+Stream all entries below directory as json lines:
+python3 main.py -f testfile.img -l /somecatalog/ --ndjson -d | jq .path
+
 Extract file from path:
 python3 main.py -f testfile.img -l /somefile.txt -e
 python3 main.py -f testfile.img -l /catalog/somefile.txt -e
+
+Extract deleted file (clusters are guessed from free space):
+python3 main.py -f testfile.img -l /deleted.txt -e -d
+
+Carve jpg, png, gif, pdf and zip files from unallocated clusters:
+python3 main.py -f testfile.img --carve --workers 8
+
+Extract directory with all subdirectories:
+python3 main.py -f testfile.img -l /catalog/ -e --workers 8
+
+Find most fragmented files, cross-linked and lost chains:
+python3 main.py -f testfile.img -x | jq .summary,.cross_linked,.orphans
+
+Forensic inventory of volume with md5, sha1 and sha256 of every file, deleted ones too:
+python3 main.py -f testfile.img --hash -d --workers 4 > manifest.csv
+python3 main.py -f testfile.img -l /catalog/ --hash sha256 --ndjson
+
+What was added, removed, modified and moved since earlier snapshot of same media:
+python3 main.py -f today.img --diff yesterday.img
+python3 main.py -f today.img --diff yesterday.img --ndjson | jq 'select(.change == "moved")'
+
+Check consistency of volume, or of many images at once:
+python3 main.py -f testfile.img --check | jq .clean,.summary
+python3 main.py -b 'images/*.img' --check | jq '.images[] | select(.result.clean == false) | .image'
+
+Info and listing of many images with one process per CPU, 60 seconds for image:
+python3 main.py -b 'images/**/*.img' --timeout 60 > report.json
+python3 main.py -b @list.txt -l / --ndjson | jq 'select(.status != "ok")'
+
+Serve images on unix socket, every request is one json line:
+python3 main.py -b 'images/*.img' --serve /tmp/fat.sock
+echo '{"id": 1, "op": "list", "image": "testfile.img", "path": "/catalog/"}' | nc -U /tmp/fat.sock
+
+Read compressed image without unpacking it, seek index is saved as testfile.img.gz.seekidx:
+python3 main.py -f testfile.img.gz -l /catalog/somefile.txt -e
+python3 main.py -f testfile.img.zst -w somefile.txt --overlay changes.ovl
+
+Copy host directory into /catalog/ of image, with trailing slash only its content:
+python3 main.py -f testfile.img --import photos -l /catalog/ --in-place
+python3 main.py -f testfile.img --import photos/ --overlay changes.ovl
+python3 main.py -f testfile.img --mkdir /catalog/new --in-place
+
+Show partition table of disk image and list root of its second partition:
+python3 main.py -f disk.img -i
+python3 main.py -f disk.img -p 2 -l /
+
+Extract directory from every partition to extracted/partition<N>/:
+python3 main.py -f disk.img -p all -l /catalog/ -e
+
+Show where time goes while listing whole volume:
+python3 main.py -f testfile.img -l / -j --stats > /dev/null
 """
     parser = argparse.ArgumentParser(
         description='Help menu for program',
@@ -41,13 +134,56 @@ python3 main.py -f testfile.img -l /catalog/somefile.txt -e
         formatter_class=argparse.RawTextHelpFormatter
     )
 
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+
+    source.add_argument(
         '-f', '--file',
-        required=True,
         type=str,
         help='Provide file for analyze'
     )
 
+    source.add_argument(
+        '-b', '--batch',
+        metavar='pattern',
+        nargs='+',
+        help='Process many images (glob patterns or @file with list of paths)\n'
+             'with pool of processes, print one json report (--ndjson: line per image)'
+    )
+
+    parser.add_argument(
+        '--timeout',
+        metavar='seconds',
+        type=float,
+        help='Limit of time for one image in batch mode'
+    )
+
+    parser.add_argument(
+        '--serve',
+        metavar='address',
+        help='Keep images given by -f or -b open and answer json lines requests\n'
+             '(list, stat, extract, hash, info) on unix socket path or host:port'
+    )
+
+    parser.add_argument(
+        '--allow-remote',
+        action='store_true',
+        help='Let server listen on address other than loopback, requests are not authenticated'
+    )
+
+    parser.add_argument(
+        '--cache',
+        metavar='N',
+        type=int,
+        default=8,
+        help='Number of volumes kept parsed in server mode (default: 8)'
+    )
+
+    parser.add_argument(
+        '-p', '--partition',
+        metavar='N',
+        help='Work with partition N of disk image or with `all` of them'
+    )
+
     parser.add_argument(
         '-i', '--info',
         action='store_true',
@@ -66,6 +202,12 @@ python3 main.py -f testfile.img -l /catalog/somefile.txt -e
         help='Print data in json'
     )
 
+    parser.add_argument(
+        '--ndjson',
+        action='store_true',
+        help='Stream listing as json lines, one record per entry below path'
+    )
+
     parser.add_argument(
         '-e', '--extract',
         action='store_true',
@@ -78,10 +220,122 @@ python3 main.py -f testfile.img -l /catalog/somefile.txt -e
         help='Show deleted files'
     )
 
+    parser.add_argument(
+        '-c', '--carve',
+        action='store_true',
+        help='Carve files by signatures from unallocated clusters'
+    )
+
+    parser.add_argument(
+        '-x', '--extents',
+        action='store_true',
+        help='Print json map of extents of every file below path (default: /) with fragmentation,\n'
+             'cross-linked and lost chains and largest free runs of volume'
+    )
+
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help='Check consistency of FAT volume, print json report of differences between FAT copies,\n'
+             'invalid entries, cross-linked clusters, lost chains, cycles and sizes not matching chains'
+    )
+
+    parser.add_argument(
+        '--hash',
+        metavar='algorithms',
+        nargs='?',
+        const='md5,sha1,sha256',
+        help='Print csv manifest with digests of every file below path (default: /),\n'
+             'data is streamed from image by pool of threads (default: md5,sha1,sha256,\n'
+             '--ndjson: json lines, -j: json, -d: deleted files too)'
+    )
+
+    parser.add_argument(
+        '--diff',
+        metavar='file',
+        help='Compare with earlier snapshot of same FAT volume, print added, removed,\n'
+             'modified and moved entries (-j: json report, --ndjson: line per change)'
+    )
+
+    parser.add_argument(
+        '-m', '--manifest',
+        metavar='file',
+        help='Resolve every path listed in file (one per line)'
+    )
+
     parser.add_argument(
         '-w', '--write',
         metavar='file',
-        help='Write file to file system (ONLY FAT16)'
+        help='Write file to file system (FAT12 and FAT16)'
+    )
+
+    parser.add_argument(
+        '--import',
+        dest='import_dir',
+        metavar='dir',
+        help='Copy host directory with all subdirectories into directory given by -l (default: /),\n'
+             'with trailing slash only its content is copied (FAT12 and FAT16)'
+    )
+
+    parser.add_argument(
+        '--mkdir',
+        metavar='path',
+        help='Create empty directory in image (FAT12 and FAT16)'
+    )
+
+    parser.add_argument(
+        '--index',
+        metavar='file',
+        nargs='?',
+        const='',
+        help='Cache parsed metadata in sidecar index (default: <image>.fatidx)'
+    )
+
+    parser.add_argument(
+        '--in-place',
+        action='store_true',
+        help='Patch image itself instead of writing edited_fat.img'
+    )
+
+    parser.add_argument(
+        '--overlay',
+        metavar='file',
+        help='Keep changes in copy-on-write overlay file, image stays untouched'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        metavar='dir',
+        help='Directory for extracted files, in server mode the only place for extract targets\n'
+             '(default: extracted)'
+    )
+
+    parser.add_argument(
+        '--workers',
+        metavar='N',
+        type=int,
+        help='Number of workers for extracting directories, carving and batch mode (default: CPU count)'
+    )
+
+    parser.add_argument(
+        '--backend',
+        choices=['mmap', 'pread'],
+        help='How to read image (default: mmap, pread if mmap fails),\n'
+             'gzip and zstd images are found by content and read through seek index'
+    )
+
+    parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='text',
+        choices=['text', 'json'],
+        help='Print time of phases, counters of I/O and peak memory to stderr'
+    )
+
+    parser.add_argument(
+        '--profile',
+        choices=['cprofile', 'tracemalloc'],
+        help='Run command under cProfile or tracemalloc, implies --stats'
     )
 
     if len(sys.argv) < 2:
@@ -90,4 +344,7 @@ python3 main.py -f testfile.img -l /catalog/somefile.txt -e
 
     args = parser.parse_args()
     # Run main function
-    main(args)
\ No newline at end of file
+    if args.stats or args.profile:
+        run_with_stats(main, args, args.stats or 'text', args.profile)
+    else:
+        main(args)
\ No newline at end of file
@@ -0,0 +1,75 @@
+# Images generated by bench/ scripts and helpers to run main.py on them
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# options of bench/mkimage.py, images are small so suite runs in seconds
+FAT_IMAGES = {
+    'FAT12': dict(files=40, dirs=5, depth=2, deleted=0.2, max_size=6000, cluster_size=1024),
+    'FAT16': dict(files=60, dirs=6, depth=3, deleted=0.2, fragment=0.2, max_size=20000, cluster_size=2048),
+    'FAT32': dict(files=60, dirs=6, depth=3, deleted=0.2, max_size=20000, cluster_size=512),
+}
+
+
+def run(*args, check=True) -> str:
+    """Output of main.py with given arguments"""
+
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'main.py'), *args],
+                            cwd=ROOT, capture_output=True, text=True)
+    if check:
+        assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def run_json(*args):
+    return json.loads(run(*args))
+
+
+def run_ndjson(*args) -> list:
+    return [json.loads(line) for line in run(*args).splitlines() if line]
+
+
+def generate(script: str, output: str, options: dict) -> list:
+    """Make image by bench script, return its manifest"""
+
+    manifest = output + '.json'
+    command = [sys.executable, os.path.join(ROOT, 'bench', script), output, '--manifest', manifest]
+    for key, value in options.items():
+        command += ['--' + key.replace('_', '-'), str(value)]
+    subprocess.run(command, check=True, capture_output=True)
+    with open(manifest) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope='session', params=sorted(FAT_IMAGES))
+def fat_image(request, tmp_path_factory):
+    """(path, manifest) of generated FAT12, FAT16 and FAT32 image, don't change it"""
+
+    path = str(tmp_path_factory.mktemp('fat') / (request.param.lower() + '.img'))
+    return path, generate('mkimage.py', path, dict(fat=request.param, seed=1, **FAT_IMAGES[request.param]))
+
+
+@pytest.fixture(scope='session')
+def ntfs_image(tmp_path_factory):
+    """(path, manifest) of generated NTFS image, don't change it"""
+
+    path = str(tmp_path_factory.mktemp('ntfs') / 'ntfs.img')
+    return path, generate('mkntfs.py', path, dict(files=40, dirs=4, deleted=0.2, fragment=0.3, seed=1))
+
+
+@pytest.fixture
+def fat16_copy(tmp_path, tmp_path_factory):
+    """Own copy of generated FAT16 image, tests may write to it"""
+
+    original = tmp_path_factory.getbasetemp() / 'fat16-original.img'
+    if not original.exists():
+        generate('mkimage.py', str(original), dict(fat='FAT16', seed=2, **FAT_IMAGES['FAT16']))
+    path = tmp_path / 'fat16.img'
+    shutil.copyfile(original, path)
+    return str(path)
@@ -0,0 +1,170 @@
+# Reading, checking and writing of FAT images made by bench/mkimage.py
+import gzip
+import os
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from conftest import run, run_json, run_ndjson
+
+
+def fat_copies(path: str) -> tuple:
+    """Offset and size in bytes of first FAT and number of copies, FAT16 only"""
+
+    with open(path, 'rb') as f:
+        boot = f.read(512)
+    sector, reserved, number = struct.unpack_from('<H', boot, 11)[0], struct.unpack_from('<H', boot, 14)[0], boot[16]
+    size = struct.unpack_from('<H', boot, 22)[0] * sector
+    return reserved * sector, size, number
+
+
+def live_files(manifest: list) -> dict:
+    return {x['path'].casefold(): x for x in manifest if not x['deleted']}
+
+
+def test_hash_matches_manifest(fat_image):
+    path, manifest = fat_image
+    records = {x['path'].casefold(): x for x in run_ndjson('-f', path, '--hash', 'sha256', '--ndjson')}
+
+    expected = live_files(manifest)
+    assert set(records) == set(expected)
+    for key, record in records.items():
+        assert record['error'] is None
+        assert record['size'] == expected[key]['size']
+        assert record['sha256'] == expected[key]['sha256']
+
+
+def test_check_clean(fat_image):
+    report = run_json('-f', fat_image[0], '--check')
+    assert report['clean'] is True
+    assert report['summary']['fat_mismatches'] == 0
+
+
+def test_check_fat_copies_differ(fat16_copy):
+    offset, size, number = fat_copies(fat16_copy)
+    assert number == 2
+    with open(fat16_copy, 'r+b') as f:
+        # flip entry of cluster 10 in second copy only
+        f.seek(offset + size + 20)
+        value = f.read(1)[0]
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([value ^ 0xFF]))
+
+    report = run_json('-f', fat16_copy, '--check')
+    assert report['clean'] is False
+    assert report['summary']['fat_mismatches'] > 0
+    assert report['fat_copies'][0]['mismatches'] > 0
+
+
+def test_check_lost_chain(fat16_copy):
+    offset, size, number = fat_copies(fat16_copy)
+    with open(fat16_copy, 'r+b') as f:
+        f.seek(offset)
+        table = f.read(size)
+        clusters = run_json('-f', fat16_copy, '--check')['volume']['clusters']
+        free = next(n for n in range(clusters + 1, 1, -1) if struct.unpack_from('<H', table, n * 2)[0] == 0)
+        # end of chain nobody points to, same in every copy of FAT
+        for copy in range(number):
+            f.seek(offset + copy * size + free * 2)
+            f.write(struct.pack('<H', 0xFFFF))
+
+    report = run_json('-f', fat16_copy, '--check')
+    assert report['clean'] is False
+    assert report['summary']['fat_mismatches'] == 0
+    assert report['summary']['lost_chains'] == 1
+    assert report['summary']['lost_clusters'] == 1
+
+
+def make_tree(root) -> None:
+    """Host directory with long names, nested dirs and file bigger than cluster"""
+
+    nested = root / 'Nested dir long' / 'deep'
+    nested.mkdir(parents=True)
+    (root / 'big.bin').write_bytes(os.urandom(70000))
+    (root / 'Nested dir long' / 'a long file name.txt').write_bytes(b'hello\n')
+    (nested / 'empty.txt').write_bytes(b'')
+    (nested / 'x.dat').write_bytes(os.urandom(3000))
+
+
+def read_tree(root) -> dict:
+    """Content of every file below root by path relative to it, names are case folded"""
+
+    files = {}
+    for parent, _, names in os.walk(root):
+        for name in names:
+            full = os.path.join(parent, name)
+            with open(full, 'rb') as f:
+                files[os.path.relpath(full, root).casefold()] = f.read()
+    return files
+
+
+def test_import_round_trip(fat16_copy, tmp_path):
+    source = tmp_path / 'src'
+    make_tree(source)
+
+    output = run('-f', fat16_copy, '--import', str(source), '-l', '/', '--in-place')
+    assert output.startswith('Imported 4 files and 3 directories')
+
+    run('-f', fat16_copy, '-l', '/src', '-e', '-o', str(tmp_path / 'out'))
+    assert read_tree(tmp_path / 'out' / 'src') == read_tree(source)
+    assert run_json('-f', fat16_copy, '--check')['clean'] is True
+
+
+def test_mkdir(fat16_copy):
+    assert run('-f', fat16_copy, '--mkdir', '/new', '--in-place').startswith('Directory was created')
+    run('-f', fat16_copy, '--mkdir', '/new/Second level', '--in-place')
+
+    records = run_ndjson('-f', fat16_copy, '-l', '/new', '--ndjson')
+    assert [(x['path'], x['type']) for x in records] == [('/new/Second level', 'd')]
+    assert run('-f', fat16_copy, '--mkdir', '/new', '--in-place').startswith('[!] /new already exists')
+    assert run('-f', fat16_copy, '--mkdir', '/nope/x', '--in-place').startswith('[!] Directory /nope not exists')
+    assert run_json('-f', fat16_copy, '--check')['clean'] is True
+
+
+def test_diff_counts(fat16_copy, tmp_path):
+    snapshot = str(tmp_path / 'snapshot.img')
+    shutil.copyfile(fat16_copy, snapshot)
+
+    summary = run_json('-f', fat16_copy, '--diff', snapshot, '-j')['summary']
+    assert (summary['added'], summary['removed'], summary['modified'], summary['moved']) == (0, 0, 0, 0)
+
+    source = tmp_path / 'src'
+    make_tree(source)
+    run('-f', fat16_copy, '--import', str(source), '-l', '/', '--in-place')
+
+    summary = run_json('-f', fat16_copy, '--diff', snapshot, '-j')['summary']
+    assert (summary['added'], summary['removed'], summary['modified'], summary['moved']) == (7, 0, 0, 0)
+
+    summary = run_json('-f', snapshot, '--diff', fat16_copy, '-j')['summary']
+    assert (summary['added'], summary['removed'], summary['modified'], summary['moved']) == (0, 7, 0, 0)
+
+
+def compress_zstd(path: str) -> str:
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+    if zstandard is not None:
+        with open(path, 'rb') as src, open(path + '.zst', 'wb') as dst:
+            zstandard.ZstdCompressor().copy_stream(src, dst)
+    elif shutil.which('zstd'):
+        subprocess.run(['zstd', '-q', '-f', path, '-o', path + '.zst'], check=True)
+    else:
+        pytest.skip('neither zstandard module nor zstd tool is installed')
+    return path + '.zst'
+
+
+def compress_gzip(path: str) -> str:
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return path + '.gz'
+
+
+@pytest.mark.parametrize('compress', [compress_gzip, compress_zstd], ids=['gzip', 'zstd'])
+def test_compressed_same_as_raw(fat16_copy, compress):
+    packed = compress(fat16_copy)
+    for args in (['-l', '/', '--ndjson', '-d'], ['--hash', '-d'], ['-i']):
+        assert run('-f', packed, *args) == run('-f', fat16_copy, *args)
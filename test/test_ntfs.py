@@ -0,0 +1,28 @@
+# Reading of NTFS images made by bench/mkntfs.py
+from conftest import run_ndjson
+
+
+def test_hash_matches_manifest(ntfs_image):
+    path, manifest = ntfs_image
+    records = {x['path']: x for x in run_ndjson('-f', path, '--hash', 'sha256', '--ndjson')}
+
+    # metadata files like $MFT are not in manifest
+    for expected in manifest:
+        if expected['deleted']:
+            assert expected['path'] not in records
+            continue
+        record = records[expected['path']]
+        assert record['error'] is None
+        assert (record['size'], record['sha256']) == (expected['size'], expected['sha256'])
+
+
+def test_listing_shows_deleted(ntfs_image):
+    path, manifest = ntfs_image
+    live = {x['path'] for x in run_ndjson('-f', path, '-l', '/', '--ndjson')}
+    every = {x['path']: x for x in run_ndjson('-f', path, '-l', '/', '--ndjson', '-d')}
+
+    deleted = [x['path'] for x in manifest if x['deleted']]
+    assert deleted
+    for name in deleted:
+        assert name not in live
+        assert every[name]['deleted'] is True